@@ -0,0 +1,93 @@
+"""
+Measures how fast a large binary file is deployed with each copy method,
+compared to hashing it and then reading, hashing and writing it again
+(how binary files were copied before evering.copying).
+
+Run from the repository root with: python -m benchmarks.copying
+
+Use --dir to run it on a specific file system, for example one that
+supports reflinks.
+"""
+
+import argparse
+import os
+import tempfile
+import time
+from pathlib import Path
+from typing import Callable, Optional
+
+from evering.copying import CopyMethod, copy_file
+from evering.hashing import Hasher
+from evering.util import WriteFileException
+
+__all__ = ["generate_file", "main"]
+
+MB = 2**20
+
+
+def generate_file(path: Path, size: int) -> None:
+    with open(path, "wb") as f:
+        for _ in range(size // MB):
+            f.write(os.urandom(MB))
+        f.write(os.urandom(size % MB))
+
+
+def measure(function: Callable[[], None], repeat: int) -> Optional[float]:
+    """
+    Returns the best time, or None if the function can't be used here.
+    """
+
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        try:
+            function()
+        except WriteFileException:
+            return None
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-s", "--size", type=int, default=256,
+                        help="size of the file in MiB (default: "
+                        "%(default)s)")
+    parser.add_argument("-r", "--repeat", type=int, default=3)
+    parser.add_argument("-d", "--dir", type=Path,
+                        help="create the files in this directory instead "
+                        "of a temporary one")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory(dir=args.dir) as tmp_dir:
+        source = Path(tmp_dir) / "source"
+        target = Path(tmp_dir) / "target"
+        generate_file(source, args.size * MB)
+
+        def before() -> None:
+            Hasher().hash_file(source)
+            copy_file(source, target, methods=[CopyMethod.BUFFERED])
+
+        def with_methods(*methods: CopyMethod) -> Callable[[], None]:
+            def run() -> None:
+                # Binary files are hashed while they are prepared
+                source_hash = Hasher().hash_file(source)
+                copy_file(source, target, source_hash, methods)
+            return run
+
+        cases = [("before", before), ("automatic", with_methods(*CopyMethod))]
+        for method in CopyMethod:
+            cases.append((method.value, with_methods(method)))
+
+        for name, function in cases:
+            best = measure(function, args.repeat)
+            if best is None:
+                print(f"{name:>16}: not supported here")
+            else:
+                print(f"{name:>16}: {best * 1000:8.1f} ms "
+                      f"({args.size / best:,.0f} MiB/s, "
+                      f"best of {args.repeat})")
+
+
+if __name__ == "__main__":
+    main()
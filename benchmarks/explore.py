@@ -0,0 +1,74 @@
+"""
+Measures how fast config files are found in a large config dir.
+
+Run from the repository root with: python -m benchmarks.explore
+"""
+
+import argparse
+import tempfile
+import time
+from pathlib import Path
+
+from evering.explore import HEADER_FILE_SUFFIX, find_config_files
+
+__all__ = ["generate_tree", "main"]
+
+
+def generate_tree(root: Path, file_count: int) -> None:
+    """
+    Generates a config dir with file_count files, spread over nested
+    directories of 50 files each. Every tenth file has a header file.
+    """
+
+    files_per_dir = 50
+    dirs_per_dir = 4
+
+    created = 0
+    dir_index = 0
+    dirs = [root]
+    while created < file_count:
+        cur_dir = dirs[dir_index]
+        dir_index += 1
+
+        for i in range(dirs_per_dir):
+            subdir = cur_dir / f"dir{i}"
+            subdir.mkdir()
+            dirs.append(subdir)
+
+        for i in range(min(files_per_dir, file_count - created)):
+            path = cur_dir / f"file{i}.conf"
+            path.write_text(f"# {path.name}\n")
+            if i % 10 == 0:
+                header = cur_dir / (path.name + HEADER_FILE_SUFFIX)
+                header.write_text("targets = []\n")
+            created += 1
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-n", "--files", type=int, default=50_000)
+    parser.add_argument("-r", "--repeat", type=int, default=5)
+    parser.add_argument("-d", "--dir", type=Path,
+                        help="use (and if necessary generate) the tree in "
+                        "this directory instead of a temporary one")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        root = args.dir or Path(tmp_dir)
+        if not root.exists() or not any(root.iterdir()):
+            root.mkdir(parents=True, exist_ok=True)
+            generate_tree(root, args.files)
+
+        best = float("inf")
+        count = 0
+        for _ in range(args.repeat):
+            start = time.perf_counter()
+            count = sum(1 for _ in find_config_files(root))
+            best = min(best, time.perf_counter() - start)
+
+        print(f"explore: {count} files in {best * 1000:.1f} ms "
+              f"({count / best:,.0f} files/s, best of {args.repeat})")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,100 @@
+"""
+Measures how fast large known files are loaded and saved, and how much
+memory they take up once loaded.
+
+Run from the repository root with: python -m benchmarks.known_files
+"""
+
+import argparse
+import json
+import tempfile
+import time
+import tracemalloc
+from pathlib import Path
+from typing import Callable, List
+
+from evering.known_files import KnownFiles
+
+__all__ = ["generate_known_files", "main"]
+
+FILES_PER_DIR = 100
+
+
+def generate_known_files(path: Path, root: Path, count: int) -> List[Path]:
+    """
+    Writes known files with count entries for files below root (which
+    don't need to exist) and returns their paths. Every entry has a
+    stat, like the entries of targets that weren't modified recently.
+    """
+
+    files = {}
+    paths = []
+    for i in range(count):
+        target = root / f"dir{i // FILES_PER_DIR}" / f"file{i}.conf"
+        file_hash = f"sha256:{i:064x}"
+        files[str(target)] = [file_hash, 1000 + i, 10**18 + i, i, 10**18]
+        paths.append(target)
+
+    with open(path, "w") as f:
+        json.dump({"version": 2, "files": files}, f)
+
+    return paths
+
+
+def measure(function: Callable[[], None], repeat: int) -> float:
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function()
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-n", "--entries", type=int, default=1_000_000)
+    parser.add_argument("-r", "--repeat", type=int, default=3)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        path = Path(tmp_dir) / "known_files"
+        paths = generate_known_files(path, Path(tmp_dir) / "targets",
+                                     args.entries)
+
+        tracemalloc.start()
+        known_files = KnownFiles(path)
+        memory, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+
+        def load() -> None:
+            KnownFiles(path)
+
+        def lookup() -> None:
+            for target in paths:
+                known_files.get_hash(target)
+
+        def keep() -> None:
+            for target in paths:
+                known_files.keep_file(target)
+
+        def save() -> None:
+            known_files.save_final()
+
+        def forget() -> None:
+            known_files.find_forgotten_files()
+
+        cases = [("load", load), ("get_hash", lookup), ("keep_file", keep),
+                 ("save_final", save), ("forgotten", forget)]
+        for name, function in cases:
+            best = measure(function, args.repeat)
+            print(f"{name:>10}: {best * 1000:8.1f} ms "
+                  f"({args.entries / best:,.0f} entries/s, "
+                  f"best of {args.repeat})")
+
+        print(f"{'memory':>10}: {memory / 2**20:8.1f} MiB "
+              f"({memory / args.entries:.0f} bytes per entry, "
+              f"peak while loading {peak / 2**20:.1f} MiB)")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,84 @@
+"""
+Measures how fast templates are parsed.
+
+Run from the repository root with: python -m benchmarks.parse
+"""
+
+import argparse
+import time
+from typing import List
+
+from evering.parser import Line, Parser
+
+__all__ = ["generate_template", "main"]
+
+
+def generate_template(line_count: int) -> List[str]:
+    """
+    Generates a template of at least line_count lines that is mostly
+    plain text, sprinkled with expressions and (possibly nested)
+    if-blocks, like a typical shell rc file.
+    """
+
+    lines: List[str] = []
+
+    i = 0
+    while len(lines) < line_count:
+        i += 1
+        if i % 50 == 0:
+            lines.extend([
+                f"# if host == 'host{i}'",
+                f"export HOST_SPECIFIC_{i}=1",
+                "  # if user == 'root'",
+                "alias rm='rm -i'",
+                "  # endif",
+                "# elif host.startswith('laptop')",
+                f"export LAPTOP_{i}={{{{ target.name }}}}",
+                "# else",
+                "# plain comment that looks a bit like a statement",
+                "# endif",
+            ])
+        elif i % 10 == 0:
+            lines.append(f"export VAR_{i}=\"{{{{ user }}}}@{{{{ host }}}}\"")
+        else:
+            lines.append(f"alias a{i}='some command --with-flags {i}'")
+
+    return lines
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-n", "--lines", type=int, default=100_000)
+    parser.add_argument("-r", "--repeat", type=int, default=5)
+    args = parser.parse_args()
+
+    lines = generate_template(args.lines)
+
+    def parse_template() -> None:
+        Parser(lines,
+               statement_prefix="#",
+               expression_prefix="{{",
+               expression_suffix="}}")
+
+    # Only the per-line step (classifying lines and splitting them into
+    # chunks), without grouping them into blocks and compiling them
+    empty_parser = Parser([], "#", "{{", "}}")
+
+    def parse_lines() -> None:
+        for i, text in enumerate(lines):
+            Line.parse(empty_parser, text, i)
+
+    benchmarks = [("lines", parse_lines), ("template", parse_template)]
+    for name, function in benchmarks:
+        best = float("inf")
+        for _ in range(args.repeat):
+            start = time.perf_counter()
+            function()
+            best = min(best, time.perf_counter() - start)
+
+        print(f"{name:>8}: {len(lines)} lines in {best * 1000:.1f} ms "
+              f"({len(lines) / best:,.0f} lines/s, best of {args.repeat})")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,316 @@
+"""
+Measures the whole pipeline on a synthetic config tree and stores the
+results per commit, so regressions can be found by comparing commits.
+
+Run from the repository root with:
+
+    python -m benchmarks.suite run       # Measure and save the results
+    python -m benchmarks.suite list      # List the saved results
+    python -m benchmarks.suite compare OLD [NEW]
+
+Results are saved in .benchmarks/ as one JSON file per commit (with a
+"-dirty" suffix if there were uncommitted changes). OLD and NEW may be
+commit prefixes or paths to result files. NEW defaults to the current
+commit.
+"""
+
+import argparse
+import json
+import logging
+import platform
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from pathlib import Path
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+from evering.config import Config
+from evering.explore import find_config_files
+from evering.known_files import KnownFiles
+from evering.parser import Parser, split_header_and_rest
+from evering.process import Processor
+
+from .tree import TreeSpec, generate_tree
+
+__all__ = ["run_suite", "main"]
+
+RESULTS_DIR = Path(".benchmarks")
+RESULTS_VERSION = 1
+
+Result = Dict[str, float]
+
+
+def measure(function: Callable[[], Any],
+            repeat: int,
+            setup: Optional[Callable[[], Any]] = None
+            ) -> Result:
+    """
+    Runs the function repeat times, calling setup (which isn't measured)
+    before every run.
+    """
+
+    times: List[float] = []
+    for _ in range(repeat):
+        if setup is not None:
+            setup()
+        start = time.perf_counter()
+        function()
+        times.append(time.perf_counter() - start)
+
+    return {"best": min(times), "median": statistics.median(times)}
+
+
+def run_suite(spec: TreeSpec,
+              repeat: int,
+              report: Callable[[str, Result], None]
+              ) -> Dict[str, Result]:
+    results: Dict[str, Result] = {}
+
+    def run(name: str,
+            function: Callable[[], Any],
+            setup: Optional[Callable[[], Any]] = None
+            ) -> None:
+        results[name] = measure(function, repeat, setup)
+        report(name, results[name])
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        root = Path(tmp_dir)
+        config_file = generate_tree(root, spec)
+        config = Config.load_config_file(config_file)
+        out_dir = root / "out"
+
+        # Discovery
+
+        run("explore", lambda: list(find_config_files(config.config_dir)))
+        file_infos = list(find_config_files(config.config_dir))
+
+        # Parsing and evaluating, without reading any files
+
+        templates: List[Tuple[List[str], Config]] = []
+        for file_info in file_infos:
+            if file_info.header is not None:
+                continue  # Binary file
+
+            header, lines = split_header_and_rest(
+                file_info.path.read_text())
+            local_config = config.copy()
+            local_config.filename = file_info.path.name
+            local_config.execute("\n".join(header))
+            local_config.target = local_config.targets[0]
+            templates.append((lines, local_config))
+
+        def parse() -> List[Parser]:
+            return [Parser(lines, "#", "{{", "}}") for lines, _ in templates]
+
+        run("parse", parse)
+        parsers = parse()
+
+        def evaluate() -> None:
+            for parser, (_, local_config) in zip(parsers, templates):
+                parser.evaluate(local_config.local_vars)
+
+        run("evaluate", evaluate)
+
+        # Processing end to end
+
+        def reset() -> None:
+            shutil.rmtree(out_dir, ignore_errors=True)
+            config.known_files.unlink(missing_ok=True)
+
+        def process() -> None:
+            known_files = KnownFiles(config.known_files)
+            processor = Processor(config, known_files)
+            for file_info in file_infos:
+                processor.process_file(file_info.path, file_info.header,
+                                       dry_run=False)
+            known_files.save_final()
+
+        run("process (fresh)", process, setup=reset)
+        run("process (unchanged)", process)
+
+        # Known files
+
+        run("known files load", lambda: KnownFiles(config.known_files))
+        known_files = KnownFiles(config.known_files)
+        run("known files save", known_files.checkpoint)
+
+    return results
+
+
+def current_commit() -> str:
+    """
+    Returns the abbreviated hash of the current commit, with a "-dirty"
+    suffix if there are uncommitted changes.
+    """
+
+    try:
+        commit = subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"],
+            capture_output=True, text=True, check=True).stdout.strip()
+        status = subprocess.run(
+            ["git", "status", "--porcelain", "--untracked-files=no"],
+            capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+
+    return commit + "-dirty" if status else commit
+
+
+def find_results(name: str) -> Path:
+    path = Path(name)
+    if path.is_file():
+        return path
+
+    matches = sorted(RESULTS_DIR.glob(f"{name}*.json"))
+    if not matches:
+        sys.exit(f"No results found for {name!r}")
+    if len(matches) > 1:
+        exact = RESULTS_DIR / f"{name}.json"
+        if exact in matches:
+            return exact
+        sys.exit(f"Ambiguous results {name!r}: " +
+                 ", ".join(match.stem for match in matches))
+
+    return matches[0]
+
+
+def load_results(path: Path) -> Dict[str, Any]:
+    results = json.loads(path.read_text())
+    if results.get("version") != RESULTS_VERSION:
+        sys.exit(f"{str(path)!r} has an unsupported format")
+    return results
+
+
+def format_time(seconds: float) -> str:
+    return f"{seconds * 1000:.1f} ms"
+
+
+def run_command(args: Any) -> None:
+    spec = TreeSpec(
+        files=args.files,
+        template_lines=args.template_lines,
+        nesting_depth=args.nesting_depth,
+        expression_density=args.expression_density,
+        fan_out=args.fan_out,
+        binary_ratio=args.binary_ratio,
+        seed=args.seed,
+    )
+
+    def report(name: str, result: Result) -> None:
+        print(f"{name:>20}: {format_time(result['best']):>10} best, "
+              f"{format_time(result['median']):>10} median")
+
+    # Processing logs every file
+    logging.disable(logging.CRITICAL)
+    results = run_suite(spec, args.repeat, report)
+    logging.disable(logging.NOTSET)
+
+    if args.no_save:
+        return
+
+    commit = current_commit()
+    RESULTS_DIR.mkdir(exist_ok=True)
+    path = RESULTS_DIR / f"{commit}.json"
+    path.write_text(json.dumps({
+        "version": RESULTS_VERSION,
+        "commit": commit,
+        "time": time.time(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "spec": spec.to_json(),
+        "repeat": args.repeat,
+        "results": results,
+    }, indent=2))
+    print(f"Saved results to {str(path)!r}")
+
+
+def list_command(args: Any) -> None:
+    paths = sorted(RESULTS_DIR.glob("*.json"),
+                   key=lambda path: path.stat().st_mtime)
+    for path in paths:
+        results = load_results(path)
+        saved = time.strftime("%Y-%m-%d %H:%M",
+                              time.localtime(results["time"]))
+        print(f"{results['commit']:<20} {saved}  "
+              f"{results['spec']['files']} files")
+
+
+def compare_command(args: Any) -> None:
+    old = load_results(find_results(args.old))
+    new = load_results(find_results(args.new or current_commit()))
+
+    if old["spec"] != new["spec"]:
+        print("Warning: The results were measured on different trees")
+    if old["platform"] != new["platform"]:
+        print("Warning: The results were measured on different platforms")
+
+    print(f"{'':>20}  {old['commit']:>12}  {new['commit']:>12}  change")
+
+    regressions = 0
+    for name, new_result in new["results"].items():
+        old_result = old["results"].get(name)
+        if old_result is None:
+            continue
+
+        old_time = old_result["best"]
+        new_time = new_result["best"]
+        change = (new_time - old_time) / old_time if old_time else 0.0
+
+        marker = ""
+        if change > args.threshold:
+            marker = "  REGRESSION"
+            regressions += 1
+        elif change < -args.threshold:
+            marker = "  improvement"
+
+        print(f"{name:>20}  {format_time(old_time):>12}  "
+              f"{format_time(new_time):>12}  {change:+7.1%}{marker}")
+
+    if regressions:
+        sys.exit(1)
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser()
+    subparsers = parser.add_subparsers(required=True)
+
+    defaults = TreeSpec()
+    run_parser = subparsers.add_parser("run", help="run the benchmarks")
+    run_parser.set_defaults(command=run_command)
+    run_parser.add_argument("-n", "--files", type=int, default=defaults.files)
+    run_parser.add_argument("--template-lines", type=int,
+                            default=defaults.template_lines)
+    run_parser.add_argument("--nesting-depth", type=int,
+                            default=defaults.nesting_depth)
+    run_parser.add_argument("--expression-density", type=float,
+                            default=defaults.expression_density)
+    run_parser.add_argument("--fan-out", type=int, default=defaults.fan_out)
+    run_parser.add_argument("--binary-ratio", type=float,
+                            default=defaults.binary_ratio)
+    run_parser.add_argument("--seed", type=int, default=defaults.seed)
+    run_parser.add_argument("-r", "--repeat", type=int, default=5)
+    run_parser.add_argument("--no-save", action="store_true",
+                            help="don't save the results")
+
+    list_parser = subparsers.add_parser("list", help="list saved results")
+    list_parser.set_defaults(command=list_command)
+
+    compare_parser = subparsers.add_parser(
+        "compare", help="compare two saved results")
+    compare_parser.set_defaults(command=compare_command)
+    compare_parser.add_argument("old")
+    compare_parser.add_argument("new", nargs="?")
+    compare_parser.add_argument(
+        "-t", "--threshold", type=float, default=0.1,
+        help="report changes larger than this fraction (default: "
+        "%(default)s)")
+
+    args = parser.parse_args()
+    args.command(args)
+
+
+if __name__ == "__main__":
+    main()
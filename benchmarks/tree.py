@@ -0,0 +1,151 @@
+"""
+Generates synthetic config trees for the benchmarks.
+"""
+
+import random
+from dataclasses import asdict, dataclass
+from pathlib import Path
+from typing import Any, Dict, List
+
+from evering.explore import HEADER_FILE_SUFFIX
+
+__all__ = ["TreeSpec", "generate_template", "generate_tree"]
+
+FILES_PER_DIR = 50
+DIRS_PER_DIR = 4
+
+# Expressions that work with the config generate_tree() writes
+EXPRESSIONS = [
+    "user",
+    "host",
+    "target.name",
+    "n * 2",
+    "', '.join(names)",
+    "filename.upper()",
+]
+
+CONDITIONS = [
+    "user == 'root'",
+    "host.startswith('laptop')",
+    "target.suffix == '.0'",
+    "n > 5",
+    "'alpha' in names",
+]
+
+
+@dataclass
+class TreeSpec:
+    # The number of config files (text and binary)
+    files: int = 1000
+    # The number of lines of each text file's template
+    template_lines: int = 100
+    # How deeply if-blocks are nested. 0 means no if-blocks at all.
+    nesting_depth: int = 2
+    # The fraction of template lines that contain an expression
+    expression_density: float = 0.2
+    # The number of targets of each config file
+    fan_out: int = 1
+    # The fraction of config files that are copied as binary files
+    binary_ratio: float = 0.1
+    # The size of each binary file in bytes
+    binary_size: int = 4096
+    seed: int = 0
+
+    def to_json(self) -> Dict[str, Any]:
+        return asdict(self)
+
+
+def generate_template(spec: TreeSpec, rng: random.Random) -> List[str]:
+    """
+    Generates a template of at least spec.template_lines lines,
+    consisting of plain lines, lines with expressions and if-blocks
+    nested spec.nesting_depth levels deep.
+    """
+
+    lines: List[str] = []
+
+    def text_line() -> str:
+        if rng.random() < spec.expression_density:
+            expression = rng.choice(EXPRESSIONS)
+            return f"export VAR_{len(lines)}=\"{{{{ {expression} }}}}\""
+        return f"alias a{len(lines)}='some command --with-flags'"
+
+    def block(depth: int) -> None:
+        if depth == 0:
+            for _ in range(3):
+                lines.append(text_line())
+            return
+
+        indent = "  " * (spec.nesting_depth - depth)
+        lines.append(f"{indent}# if {rng.choice(CONDITIONS)}")
+        block(depth - 1)
+        lines.append(f"{indent}# elif {rng.choice(CONDITIONS)}")
+        lines.append(text_line())
+        lines.append(f"{indent}# else")
+        block(depth - 1)
+        lines.append(f"{indent}# endif")
+
+    while len(lines) < spec.template_lines:
+        for _ in range(5):
+            lines.append(text_line())
+        if spec.nesting_depth > 0:
+            block(spec.nesting_depth)
+
+    return lines
+
+
+def generate_tree(root: Path, spec: TreeSpec) -> Path:
+    """
+    Generates a config file and a config dir according to the spec in
+    the (empty) root directory and returns the path of the config file.
+    All targets are located in root/out.
+    """
+
+    rng = random.Random(spec.seed)
+
+    config_file = root / "config.py"
+    config_file.write_text(
+        'config_dir = "config"\n'
+        'known_files = "known_files"\n'
+        'template_cache = "template_cache"\n'
+        'snapshots = "snapshots"\n'
+        'names = ["alpha", "beta", "gamma"]\n'
+        'n = 7\n'
+    )
+
+    config_dir = root / "config"
+    config_dir.mkdir()
+
+    dirs = [config_dir]
+    dir_index = 0
+    created = 0
+    while created < spec.files:
+        cur_dir = dirs[dir_index]
+        dir_index += 1
+
+        for i in range(DIRS_PER_DIR):
+            subdir = cur_dir / f"dir{i}"
+            subdir.mkdir()
+            dirs.append(subdir)
+
+        for _ in range(min(FILES_PER_DIR, spec.files - created)):
+            targets = [f"out/file{created}.{i}" for i in range(spec.fan_out)]
+            targets_line = (
+                "targets = [" +
+                ", ".join(f"base_dir / {target!r}" for target in targets) +
+                "]")
+
+            if rng.random() < spec.binary_ratio:
+                path = cur_dir / f"file{created}.bin"
+                path.write_bytes(rng.randbytes(spec.binary_size))
+                header = cur_dir / (path.name + HEADER_FILE_SUFFIX)
+                header.write_text(targets_line + "\n")
+            else:
+                path = cur_dir / f"file{created}.conf"
+                template = generate_template(spec, rng)
+                path.write_text("\n".join([targets_line, "==="] + template) +
+                                "\n")
+
+            created += 1
+
+    return config_file
@@ -1,15 +1,25 @@
 import argparse
+import cProfile
+import json
 import logging
+import sys
 from pathlib import Path
-from typing import Any
+from typing import Any, Dict, Optional
 
-from .colors import style_path, style_warning
+from .colors import (set_colors_enabled, style_error, style_path,
+                     style_warning)
 from .config import DEFAULT_CONFIG, Config, ConfigurationException
 from .explore import find_config_files
 from .known_files import KnownFiles
+from .logbuffer import install_log_buffering
+from .policy import Conflict, ErrorResolution, Resolution
 from .process import Processor
-from .prompt import prompt_choice
-from .util import CatastrophicError, LessCatastrophicError
+from .profiling import Profile, phase, start_profiling, stop_profiling
+from .snapshots import Snapshots
+from .template_cache import TemplateCache
+from .util import (CatastrophicError, ReadFileException, WriteFileException,
+                   write_file)
+from .watch import watch
 
 LOG_STYLE = "{"
 LOG_FORMAT = "{levelname:>7}: {message}"
@@ -64,23 +74,43 @@ Writing problems:
 
 
 def run(args: Any) -> None:
-    config = Config.load_config_file(args.config_file
-                                     and Path(args.config_file) or None)
-    known_files = KnownFiles(config.known_files)
+    with phase("config load"):
+        config = Config.load_config_file(args.config_file
+                                         and Path(args.config_file) or None)
 
-    processor = Processor(config, known_files)
-    config_files = find_config_files(config.config_dir)
+    with phase("known files load"):
+        known_files = KnownFiles(config.known_files)
+
+    cache = None
+    if not args.no_cache:
+        cache = TemplateCache(config.template_cache,
+                              config.template_cache_size)
 
-    for file_info in config_files:
+    # Recording snapshots means reading and hashing every config file a
+    # second time, so it is only worth it for incremental runs. Targets
+    # written by other runs don't match their snapshots, so their config
+    # files are still processed.
+    snapshots = None
+    if args.incremental:
         try:
-            processor.process_file(file_info.path, file_info.header,
-                                   dry_run=args.dry_run)
-        except LessCatastrophicError as e:
-            logger.error(e)
+            environment: Optional[str] = Snapshots.describe_environment(
+                config.config_file, config.user, config.host)
+        except ReadFileException as e:
+            logger.debug(f"Could not describe environment: {e}")
+            environment = None
+        snapshots = Snapshots(config.snapshots, environment)
+
+    policy = config.policy.overridden(policy_overrides(args),
+                                      error_override(args))
+    processor = Processor(config, known_files, cache, snapshots,
+                          policy=policy, paranoid=args.paranoid,
+                          hasher=config.hasher)
 
-            if prompt_choice("[C]ontinue to the next file or [A]bort the "
-                             "program?", "Ca") == "a":
-                raise CatastrophicError("Aborted")
+    # The config dir is explored while the files are being processed
+    config_files = find_config_files(config.config_dir)
+
+    processor.process_files(config_files, dry_run=args.dry_run,
+                            jobs=args.jobs, incremental=args.incremental)
 
     if args.dry_run:
         return
@@ -91,17 +121,102 @@ def run(args: Any) -> None:
 
     known_files.save_final()
 
+    if snapshots is not None:
+        snapshots.save()
+
+    if cache is not None:
+        cache.save()
+
+
+def error_override(args: Any) -> Optional[ErrorResolution]:
+    """
+    The --on-error option, which takes precedence over the config.
+    """
+
+    if args.on_error is None:
+        return None
+    return ErrorResolution(args.on_error)
+
+
+def policy_overrides(args: Any) -> Dict[Conflict, Resolution]:
+    """
+    The resolutions set via command line options, which take precedence
+    over the config.
+    """
+
+    overrides: Dict[Conflict, Resolution] = {}
+    for conflict in Conflict:
+        value = getattr(args, conflict.value)
+        if value is not None:
+            overrides[conflict] = Resolution(value)
+
+    return overrides
+
 
 def main() -> None:
     parser = argparse.ArgumentParser()
     parser.add_argument("-c", "--config-file", type=Path)
     parser.add_argument("-v", "--verbose", action="store_true")
     parser.add_argument("-d", "--dry-run", action="store_true")
+    parser.add_argument("--no-cache", action="store_true",
+                        help="neither use nor update the template cache")
+    parser.add_argument("-i", "--incremental", action="store_true",
+                        help="skip files that didn't change since the "
+                        "last incremental run")
+    parser.add_argument("-w", "--watch", action="store_true",
+                        help="keep running and process files again "
+                        "whenever they change")
+    parser.add_argument("-j", "--jobs", type=int, default=1,
+                        help="prepare up to this many files in parallel")
+    parser.add_argument("--paranoid", action="store_true",
+                        help="always hash existing targets instead of "
+                        "trusting their size, mtime, inode and ctime")
+    parser.add_argument("--profile", action="store_true",
+                        help="print how much time was spent where")
+    parser.add_argument("--profile-json", type=Path, metavar="FILE",
+                        help="like --profile, but write the report to FILE "
+                        "as JSON")
+    parser.add_argument("--profile-top", type=int, default=10, metavar="N",
+                        help="list the N slowest config files and targets "
+                        "(default: %(default)s)")
+    parser.add_argument("--cprofile", type=Path, metavar="FILE",
+                        help="write cProfile stats of the main thread to "
+                        "FILE")
+    resolutions = [resolution.value for resolution in Resolution]
+    parser.add_argument("--on-modified", choices=resolutions,
+                        help="what to do with targets that were modified "
+                        "since they were last written (default: the "
+                        "config's on_modified)")
+    parser.add_argument("--on-unknown", choices=resolutions,
+                        help="what to do with targets evering doesn't know "
+                        "(default: the config's on_unknown)")
+    parser.add_argument("--on-unhashable", choices=resolutions,
+                        help="what to do with targets that can't be read "
+                        "(default: the config's on_unhashable)")
+    parser.add_argument("--on-error",
+                        choices=[resolution.value
+                                 for resolution in ErrorResolution],
+                        help="what to do with config files that can't be "
+                        "processed (default: the config's on_error)")
     parser.add_argument("--export-default-config", type=Path)
     args = parser.parse_args()
 
     level = logging.DEBUG if args.verbose else logging.INFO
     logging.basicConfig(level=level, style=LOG_STYLE, format=LOG_FORMAT)
+    install_log_buffering()
+
+    # Messages are styled before they reach the handler (which writes to
+    # stderr), and prompts are written to stdout, so colors are only used
+    # if both are terminals
+    set_colors_enabled(sys.stderr.isatty() and sys.stdout.isatty())
+
+    if args.jobs < 1:
+        parser.error("the number of jobs must be at least 1")
+    if args.profile_top < 0:
+        parser.error("--profile-top must not be negative")
+    if args.watch and (args.dry_run or args.incremental):
+        parser.error("--watch can't be combined with --dry-run or "
+                     "--incremental")
 
     if args.export_default_config is not None:
         logger.info("Exporting default config to "
@@ -110,12 +225,46 @@ def main() -> None:
             f.write(DEFAULT_CONFIG.to_config_file())
         return
 
+    if args.profile or args.profile_json is not None:
+        start_profiling()
+
+    cprofiler = None
+    if args.cprofile is not None:
+        cprofiler = cProfile.Profile()
+        cprofiler.enable()
+
     try:
-        run(args)
+        if args.watch:
+            watch(args.config_file, args.jobs, not args.no_cache,
+                  policy_overrides(args), error_override(args),
+                  args.paranoid)
+        else:
+            run(args)
     except CatastrophicError as e:
         logger.error(e)
     except ConfigurationException as e:
         logger.error(e)
+    finally:
+        if cprofiler is not None:
+            cprofiler.disable()
+            cprofiler.dump_stats(args.cprofile)
+
+        profile = stop_profiling()
+        if profile is not None:
+            report_profile(profile, args)
+
+
+def report_profile(profile: Profile, args: Any) -> None:
+    if args.profile:
+        print(profile.format_table(args.profile_top), file=sys.stderr)
+
+    if args.profile_json is not None:
+        text = json.dumps(profile.to_json(args.profile_top), indent=2)
+        try:
+            write_file(args.profile_json, text)
+        except WriteFileException as e:
+            logger.error(style_error("Could not write profile to ") +
+                         style_path(args.profile_json) + f": {e}")
 
 
 if __name__ == "__main__":
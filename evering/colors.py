@@ -1,6 +1,10 @@
 """
 This module includes functions to color the console output with ANSI
 escape sequences.
+
+Colors can be disabled globally (see set_colors_enabled), for example
+when the output doesn't go to a terminal. All styling functions then
+return their text unchanged.
 """
 
 from dataclasses import dataclass
@@ -14,6 +18,7 @@ __all__ = [
     "BLACK", "RED", "GREEN", "YELLOW", "BLUE", "MAGENTA", "CYAN", "WHITE",
     "BRIGHT_BLACK", "BRIGHT_RED", "BRIGHT_GREEN", "BRIGHT_YELLOW",
     "BRIGHT_BLUE", "BRIGHT_MAGENTA", "BRIGHT_CYAN", "BRIGHT_WHITE",
+    "set_colors_enabled", "colors_enabled",
     "style_sequence", "styled",
     "style_path", "style_var", "style_error", "style_warning",
 ]
@@ -57,13 +62,25 @@ BRIGHT_CYAN = Color(96, 106)
 BRIGHT_WHITE = Color(97, 107)
 
 
+_colors_enabled = True
+
+
+def set_colors_enabled(enabled: bool) -> None:
+    global _colors_enabled
+    _colors_enabled = enabled
+
+
+def colors_enabled() -> bool:
+    return _colors_enabled
+
+
 def style_sequence(*args: int) -> str:
     arglist = ";".join(str(arg) for arg in args)
     return f"{CSI}{arglist}m"
 
 
 def styled(text: str, *args: int) -> str:
-    if args:
+    if args and _colors_enabled:
         sequence = style_sequence(*args)
         reset = style_sequence()
         return f"{sequence}{text}{reset}"
@@ -9,11 +9,17 @@ including the modules loaded via "import".
 import logging
 from dataclasses import dataclass
 from pathlib import Path
-from typing import Any, Dict, List, Optional, Tuple, Union
+from types import CodeType
+from typing import (Any, Callable, Dict, List, MutableMapping, Optional,
+                    Tuple, Union)
 
 from .colors import style_error, style_path, style_var
-from .util import (ExecuteException, ReadFileException, copy_local_variables,
-                   get_host, get_user, read_file, safer_exec)
+from .hashing import ALGORITHMS, SHA256, Hasher
+from .links import BinaryMode
+from .policy import Conflict, ErrorResolution, Policy, Resolution
+from .scope import Scope
+from .util import (ExecuteException, ReadFileException, get_host, get_user,
+                   read_file, safer_exec)
 
 __all__ = [
     "DEFAULT_LOCATIONS",
@@ -111,11 +117,33 @@ DEFAULT_CONFIG.add(
     " Default: The directory the config file was loaded from",
     has_constant_value=False)
 
+DEFAULT_CONFIG.add(
+    "config_file",
+    "The config file that was loaded. Set while loading the config file",
+    has_constant_value=False)
+
 DEFAULT_CONFIG.add(
     "known_files",
     "The file where evering stores which files it is currently managing",
     value="known_files")
 
+DEFAULT_CONFIG.add(
+    "template_cache",
+    "The file where evering caches rendered templates between runs",
+    value="template_cache")
+
+DEFAULT_CONFIG.add(
+    "template_cache_size",
+    ("The approximate maximum size of the template cache in characters. "
+     "When it grows larger, the least recently used entries are evicted"),
+    value=4 * 1024 * 1024)
+
+DEFAULT_CONFIG.add(
+    "snapshots",
+    ("The file where evering remembers the state of the config files and "
+     "targets of the previous run, for --incremental"),
+    value="snapshots")
+
 DEFAULT_CONFIG.add(
     "config_dir",
     "The directory containing the config files",
@@ -133,6 +161,13 @@ DEFAULT_CONFIG.add(
      "file has no header file"),
     value=True)
 
+DEFAULT_CONFIG.add(
+    "binary_mode",
+    ("When interpreting a header file of a binary file: How the file is "
+     "deployed to its targets. Either 'copy', or 'symlink' or 'hardlink' to "
+     "make each target a link to the file in the config dir"),
+    value=BinaryMode.COPY.value)
+
 DEFAULT_CONFIG.add(
     "targets",
     ("The locations a config file should be placed in. Either a path or a "
@@ -155,6 +190,46 @@ DEFAULT_CONFIG.add(
     "Determines the delimiters for in-line expressions",
     value=("{{", "}}"))
 
+DEFAULT_CONFIG.add(
+    "hash_algorithm",
+    ("The algorithm used to recognize whether targets were modified. Either "
+     "'sha256' or 'blake2b', which is faster on most machines"),
+    value=SHA256)
+
+DEFAULT_CONFIG.add(
+    "hash_digest_size",
+    ("The size of the hashes in bytes, from 1 to 64. Only for blake2b, where "
+     "it defaults to 32"),
+    value=None)
+
+# Conflicts
+
+_RESOLUTIONS = ", ".join(repr(resolution.value) for resolution in Resolution)
+
+DEFAULT_CONFIG.add(
+    Conflict.MODIFIED.value,
+    ("What to do with targets that were modified since evering last wrote "
+     f"them. One of {_RESOLUTIONS}"),
+    value=Resolution.ASK.value)
+
+DEFAULT_CONFIG.add(
+    Conflict.UNKNOWN.value,
+    f"What to do with targets evering doesn't know. One of {_RESOLUTIONS}",
+    value=Resolution.ASK.value)
+
+DEFAULT_CONFIG.add(
+    Conflict.UNHASHABLE.value,
+    ("What to do with targets that can't be read to check whether they were "
+     f"modified. One of {_RESOLUTIONS}"),
+    value=Resolution.ASK.value)
+
+DEFAULT_CONFIG.add(
+    "on_error",
+    ("What to do with config files that can't be processed, for example "
+     "because their header raises an exception. One of 'ask', 'skip' (log "
+     "the error and continue) or 'abort'"),
+    value=ErrorResolution.ASK.value)
+
 # Compile-time info
 
 DEFAULT_CONFIG.add(
@@ -180,6 +255,25 @@ DEFAULT_CONFIG.add(
     has_constant_value=False)
 
 
+class _Resolved:
+    """
+    The properties of a Config that were already validated and
+    interpreted. A slot stays unset until its property is first accessed,
+    so invalid values only raise an exception once they are actually
+    used.
+    """
+
+    __slots__ = (
+        "base_dir", "known_files", "template_cache", "snapshots",
+        "config_dir", "action_dir", "targets", "statement_prefix",
+        "expression_delimiters", "target",
+    )
+
+
+# Setting these variables changes the value of at least one of the slots
+_RESOLVED_FROM = frozenset(_Resolved.__slots__) | {"action"}
+
+
 class Config:
     @staticmethod
     def load_config_file(path: Optional[Path]) -> "Config":
@@ -218,8 +312,14 @@ class Config:
 
         return conf
 
-    def __init__(self, local_vars: Dict[str, Any]) -> None:
+    def __init__(self,
+                 local_vars: MutableMapping[str, Any],
+                 resolved: Optional[_Resolved] = None
+                 ) -> None:
+        # Modify only via _set() and execute(), so the resolved properties
+        # are invalidated when necessary
         self.local_vars = local_vars
+        self._resolved = resolved or _Resolved()
 
     def apply_config_file(self, path: Path) -> None:
         """
@@ -229,8 +329,10 @@ class Config:
         if "base_dir" not in self.local_vars:
             self.local_vars["base_dir"] = path.parent
 
+        self.local_vars["config_file"] = path
+
         try:
-            safer_exec(read_file(path), self.local_vars)
+            self.execute(read_file(path))
         except (ReadFileException, ExecuteException) as e:
             error_msg = f"Could not load config from {style_path(path)}: {e}"
             logger.debug(error_msg)
@@ -239,7 +341,27 @@ class Config:
             logger.info(f"Loaded config from {style_path(path)}")
 
     def copy(self) -> "Config":
-        return Config(copy_local_variables(self.local_vars))
+        """
+        The copy must not be used any more once the original is modified.
+        """
+
+        # Until either of them is modified, they share the resolved
+        # properties
+        return Config(Scope(self.local_vars), self._resolved)
+
+    def execute(self, code: Union[str, CodeType]) -> None:
+        """
+        Executes code (like a header) with the config's variables as local
+        variables.
+
+        May raise: ExecuteException
+        """
+
+        try:
+            safer_exec(code, self.local_vars)
+        finally:
+            # Even failed code may have modified some variables
+            self._resolved = _Resolved()
 
     def _get(self, name: str, *types: type) -> Any:
         """
@@ -272,6 +394,24 @@ class Config:
 
     def _set(self, name: str, value: Any) -> None:
         self.local_vars[name] = value
+        if name in _RESOLVED_FROM:
+            self._resolved = _Resolved()
+
+    def _resolve(self, name: str, resolve: Callable[[], Any]) -> Any:
+        """
+        Returns the resolved property, calling resolve() only if it
+        wasn't resolved before. Exceptions aren't remembered.
+
+        May raise: ConfigurationException
+        """
+
+        resolved = self._resolved
+        try:
+            return getattr(resolved, name)
+        except AttributeError:
+            value = resolve()
+            setattr(resolved, name, value)
+            return value
 
     @staticmethod
     def _is_pathy(elem: Any) -> bool:
@@ -283,34 +423,68 @@ class Config:
 
     @property
     def base_dir(self) -> Path:
-        return Path(self._get("base_dir", str, Path)).expanduser()
+        return self._resolve(
+            "base_dir",
+            lambda: Path(self._get("base_dir", str, Path)).expanduser())
 
     @base_dir.setter
     def base_dir(self, path: Path) -> None:
         self._set("base_dir", path)
 
+    @property
+    def config_file(self) -> Path:
+        return Path(self._get("config_file", str, Path)).expanduser()
+
     def _interpret_path(self, path: Union[str, Path]) -> Path:
         path = Path(path).expanduser()
         if path.is_absolute():
-            logger.debug(f"{style_path(path)} is absolute, no interpreting "
-                         "required")
+            if logger.isEnabledFor(logging.DEBUG):
+                logger.debug(f"{style_path(path)} is absolute, no "
+                             "interpreting required")
             return path
         else:
-            logger.debug(f"{style_path(path)} is relative, interpreting as "
-                         f"{style_path(self.base_dir / path)}")
-            return self.base_dir / path
+            interpreted = self.base_dir / path
+            if logger.isEnabledFor(logging.DEBUG):
+                logger.debug(f"{style_path(path)} is relative, interpreting "
+                             f"as {style_path(interpreted)}")
+            return interpreted
 
     @property
     def known_files(self) -> Path:
-        return self._interpret_path(self._get("known_files", str, Path))
+        return self._resolve("known_files", lambda: self._interpret_path(
+            self._get("known_files", str, Path)))
+
+    @property
+    def template_cache(self) -> Path:
+        return self._resolve("template_cache", lambda: self._interpret_path(
+            self._get("template_cache", str, Path)))
+
+    @property
+    def template_cache_size(self) -> int:
+        name = "template_cache_size"
+        size = self._get(name, int)
+
+        if size < 0:
+            raise ConfigurationException(
+                style_error("Expected variable ") + style_var(name) +
+                style_error(" to not be negative"))
+
+        return size
+
+    @property
+    def snapshots(self) -> Path:
+        return self._resolve("snapshots", lambda: self._interpret_path(
+            self._get("snapshots", str, Path)))
 
     @property
     def config_dir(self) -> Path:
-        return self._interpret_path(self._get("config_dir", str, Path))
+        return self._resolve("config_dir", lambda: self._interpret_path(
+            self._get("config_dir", str, Path)))
 
     @property
     def action_dir(self) -> Path:
-        return self._interpret_path(self._get("action_dir", str, Path))
+        return self._resolve("action_dir", lambda: self._interpret_path(
+            self._get("action_dir", str, Path)))
 
     # Parsing and compiling behavior
 
@@ -318,8 +492,23 @@ class Config:
     def binary(self) -> bool:
         return self._get("binary", bool)
 
+    @property
+    def binary_mode(self) -> BinaryMode:
+        name = "binary_mode"
+        try:
+            return BinaryMode(self._get(name, str))
+        except ValueError:
+            modes = ", ".join(repr(mode.value) for mode in BinaryMode)
+            raise ConfigurationException(
+                style_error("Expected variable ") + style_var(name) +
+                style_error(f" to be one of {modes}"))
+
     @property
     def targets(self) -> List[Path]:
+        # A copy, so callers can't modify the resolved list
+        return list(self._resolve("targets", self._resolve_targets))
+
+    def _resolve_targets(self) -> List[Path]:
         name = "targets"
         targets = self._get(name)
 
@@ -351,6 +540,10 @@ class Config:
 
     @property
     def statement_prefix(self) -> str:
+        return self._resolve("statement_prefix",
+                             self._resolve_statement_prefix)
+
+    def _resolve_statement_prefix(self) -> str:
         name = "statement_prefix"
         prefix = self._get(name, str)
 
@@ -363,6 +556,10 @@ class Config:
 
     @property
     def expression_delimiters(self) -> Tuple[str, str]:
+        return self._resolve("expression_delimiters",
+                             self._resolve_expression_delimiters)
+
+    def _resolve_expression_delimiters(self) -> Tuple[str, str]:
         name = "expression_delimiters"
         delimiters = self._get(name, tuple)
 
@@ -378,6 +575,50 @@ class Config:
 
         return delimiters
 
+    @property
+    def hasher(self) -> Hasher:
+        algorithm = self._get("hash_algorithm", str)
+        digest_size = self._get("hash_digest_size", int, type(None))
+
+        if algorithm not in ALGORITHMS:
+            raise ConfigurationException(
+                style_error("Expected variable ") +
+                style_var("hash_algorithm") + style_error(
+                    " to be one of " +
+                    ", ".join(repr(name) for name in ALGORITHMS)))
+
+        try:
+            return Hasher(algorithm, digest_size)
+        except ValueError as e:
+            raise ConfigurationException(
+                style_error("Invalid variable ") +
+                style_var("hash_digest_size") + style_error(f": {e}"))
+
+    # Conflicts
+
+    @property
+    def policy(self) -> Policy:
+        resolutions: Dict[Conflict, Resolution] = {}
+        for conflict in Conflict:
+            name = conflict.value
+            try:
+                resolutions[conflict] = Resolution(self._get(name, str))
+            except ValueError:
+                raise ConfigurationException(
+                    style_error("Expected variable ") + style_var(name) +
+                    style_error(f" to be one of {_RESOLUTIONS}"))
+
+        try:
+            on_error = ErrorResolution(self._get("on_error", str))
+        except ValueError:
+            choices = ", ".join(repr(resolution.value)
+                                for resolution in ErrorResolution)
+            raise ConfigurationException(
+                style_error("Expected variable ") + style_var("on_error") +
+                style_error(f" to be one of {choices}"))
+
+        return Policy(resolutions, on_error)
+
     # Environment and file-specific information
 
     @property
@@ -390,7 +631,8 @@ class Config:
 
     @property
     def target(self) -> Path:
-        return self._interpret_path(self._get("target", str, Path))
+        return self._resolve("target", lambda: self._interpret_path(
+            self._get("target", str, Path)))
 
     @target.setter
     def target(self, path: Path) -> None:
@@ -400,7 +642,7 @@ class Config:
     def user(self) -> str:
         return self._get("user", str)
 
-    @target.setter
+    @user.setter
     def user(self, user: str) -> None:
         self._set("user", user)
 
@@ -408,6 +650,6 @@ class Config:
     def host(self) -> str:
         return self._get("host", str)
 
-    @target.setter
+    @host.setter
     def host(self, host: str) -> None:
         self._set("host", host)
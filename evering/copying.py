@@ -0,0 +1,211 @@
+"""
+This module copies binary files to their targets as cheaply as the file
+system allows.
+
+The methods are tried from cheapest to most expensive: Sharing the
+source's blocks (a reflink, on copy-on-write file systems like btrfs or
+XFS), letting the kernel copy the data (copy_file_range, then sendfile)
+and finally reading and writing it in blocks. All but the last never
+move the data through evering, so they can only be used if the source's
+hash is already known.
+"""
+
+import os
+from dataclasses import dataclass
+from enum import Enum
+from pathlib import Path
+from typing import BinaryIO, Optional, Sequence, Tuple
+
+from .hashing import Hasher
+from .profiling import BYTES_READ, BYTES_WRITTEN, count
+from .util import BLOCK_SIZE, WriteFileException
+
+try:
+    import fcntl
+except ImportError:  # Not available on Windows
+    fcntl = None  # type: ignore
+
+__all__ = ["CopyMethod", "CopyResult", "copy_file"]
+
+# From linux/fs.h
+FICLONE = 0x40049409
+
+# The amount of bytes copy_file_range and sendfile are asked to copy at
+# once. Larger files take several calls.
+CHUNK_SIZE = 2**30
+
+
+class CopyMethod(Enum):
+    REFLINK = "reflink"
+    COPY_FILE_RANGE = "copy_file_range"
+    SENDFILE = "sendfile"
+    BUFFERED = "buffered"
+
+
+@dataclass
+class CopyResult:
+    # The tagged hash of the copied bytes (see evering.hashing)
+    hash: str
+    method: CopyMethod
+    size: int
+
+
+class _Unsupported(Exception):
+    """
+    The method can't be used for these files, but another one might.
+    """
+
+
+def copy_file(source: Path,
+              target: Path,
+              source_hash: Optional[str] = None,
+              methods: Sequence[CopyMethod] = tuple(CopyMethod),
+              hasher: Optional[Hasher] = None
+              ) -> CopyResult:
+    """
+    Copies the contents of a file, trying the methods in order.
+
+    If source_hash is given, it must be the hash of the source's current
+    contents. Otherwise, the source is hashed with the hasher (SHA-256
+    by default) while it is copied, which is only possible with
+    CopyMethod.BUFFERED.
+
+    May raise: WriteFileException
+    """
+
+    try:
+        with open(source, "rb") as src:
+            # Opening the target would truncate the source if both are
+            # the same file.
+            if target.exists() and os.path.samefile(source, target):
+                raise WriteFileException(
+                    f"{str(source)!r} and {str(target)!r} are the same file")
+
+            size = os.fstat(src.fileno()).st_size
+
+            with open(target, "wb") as dst:
+                for method in methods:
+                    if method == CopyMethod.BUFFERED:
+                        file_hash, size = _copy_buffered(
+                            src, dst, hasher or Hasher())
+                        count(BYTES_READ, size)
+                        count(BYTES_WRITTEN, size)
+                        return CopyResult(file_hash, method, size)
+
+                    # Some special files claim to be empty, so their
+                    # contents can only be copied by reading them
+                    if source_hash is None or size == 0:
+                        continue
+
+                    try:
+                        _COPIERS[method](src.fileno(), dst.fileno(), size)
+                    except _Unsupported:
+                        # Start over with the next method
+                        dst.seek(0)
+                        dst.truncate()
+                        continue
+
+                    count(BYTES_WRITTEN, size)
+                    return CopyResult(source_hash, method, size)
+
+        raise WriteFileException("None of the copy methods could be used")
+
+    except OSError as e:
+        raise WriteFileException(e)
+
+
+def _copy_buffered(src: BinaryIO,
+                   dst: BinaryIO,
+                   hasher: Hasher
+                   ) -> Tuple[str, int]:
+    h = hasher.new()
+    size = 0
+
+    while True:
+        block = src.read(BLOCK_SIZE)
+        if not block:
+            break
+        h.update(block)
+        dst.write(block)
+        size += len(block)
+
+    return hasher.tag(h), size
+
+
+def _copy_reflink(src: int, dst: int, size: int) -> None:
+    """
+    May raise: OSError, _Unsupported
+    """
+
+    if fcntl is None:
+        raise _Unsupported()
+
+    try:
+        fcntl.ioctl(dst, FICLONE, src)
+    except OSError:
+        # Not a copy-on-write file system, or the files are on different
+        # file systems
+        raise _Unsupported()
+
+
+def _copy_file_range(src: int, dst: int, size: int) -> None:
+    """
+    May raise: OSError, _Unsupported
+    """
+
+    if not hasattr(os, "copy_file_range"):
+        raise _Unsupported()
+
+    offset = 0
+    while offset < size:
+        chunk = min(CHUNK_SIZE, size - offset)
+        try:
+            copied = os.copy_file_range(src, dst, chunk, offset, offset)
+        except OSError:
+            # Older kernels can't copy between file systems, and some
+            # file systems don't support it at all
+            if offset == 0:
+                raise _Unsupported()
+            raise
+
+        if copied == 0:
+            # Either the source shrank or the file system doesn't support
+            # copying it this way
+            if offset == 0:
+                raise _Unsupported()
+            break
+
+        offset += copied
+
+
+def _copy_sendfile(src: int, dst: int, size: int) -> None:
+    """
+    May raise: OSError, _Unsupported
+    """
+
+    if not hasattr(os, "sendfile"):
+        raise _Unsupported()
+
+    offset = 0
+    while offset < size:
+        chunk = min(CHUNK_SIZE, size - offset)
+        try:
+            copied = os.sendfile(dst, src, offset, chunk)
+        except OSError:
+            if offset == 0:
+                raise _Unsupported()
+            raise
+
+        if copied == 0:
+            if offset == 0:
+                raise _Unsupported()
+            break
+
+        offset += copied
+
+
+_COPIERS = {
+    CopyMethod.REFLINK: _copy_reflink,
+    CopyMethod.COPY_FILE_RANGE: _copy_file_range,
+    CopyMethod.SENDFILE: _copy_sendfile,
+}
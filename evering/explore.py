@@ -1,12 +1,14 @@
 import logging
+import os
 from dataclasses import dataclass
 from pathlib import Path
-from typing import Dict, List, Optional
+from typing import Callable, Dict, Iterator, List, Optional, Set, Tuple
 
 from .colors import style_error, style_path, style_warning
+from .profiling import DIRS_LISTED, FILES_STATED, count, phase
 from .util import CatastrophicError
 
-__all__ = ["FileInfo", "find_config_files"]
+__all__ = ["FileInfo", "find_config_files", "explore_dir", "list_dir"]
 logger = logging.getLogger(__name__)
 
 HEADER_FILE_SUFFIX = ".evering-header"
@@ -18,42 +20,127 @@ class FileInfo:
     header: Optional[Path] = None
 
 
-def find_config_files(config_dir: Path) -> List[FileInfo]:
+def find_config_files(config_dir: Path,
+                      on_dir: Optional[Callable[[Path], None]] = None
+                      ) -> Iterator[FileInfo]:
+    """
+    Yields the config files while exploring the config dir, so they can
+    already be processed while the rest of the dir is being explored.
+
+    May raise: CatastrophicError
+    """
+
     try:
-        return explore_dir(config_dir)
+        yield from explore_dir(config_dir, on_dir)
     except OSError as e:
         raise CatastrophicError(style_error("could not access config dir ") +
                                 style_path(config_dir) + f": {e}")
 
 
-def explore_dir(cur_dir: Path) -> List[FileInfo]:
-    if not cur_dir.is_dir():
-        raise CatastrophicError(style_path(cur_dir) +
+def explore_dir(root_dir: Path,
+                on_dir: Optional[Callable[[Path], None]] = None
+                ) -> Iterator[FileInfo]:
+    """
+    Finds all files in a directory and its subdirectories, along with
+    their header files. The files of a directory come before those of its
+    subdirectories. If set, on_dir is called with every directory that is
+    explored.
+
+    The files of a directory are only yielded once the whole directory
+    was listed, since a file's header file may be listed before or after
+    the file itself.
+
+    May raise: CatastrophicError, OSError
+    """
+
+    if not root_dir.is_dir():
+        raise CatastrophicError(style_path(root_dir) +
                                 style_error(" is not a directory"))
 
-    files: Dict[Path, FileInfo] = {}
-    header_files: List[Path] = []
+    # The (device, inode) pairs of all directories explored so far, so
+    # symlinks can't lead into a loop
+    visited: Set[Tuple[int, int]] = set()
+
+    # Directories still to be explored, the next one at the end. The
+    # directories are explored iteratively, so deeply nested config dirs
+    # can't exceed the recursion limit.
+    stack = [root_dir]
+    while stack:
+        cur_dir = stack.pop()
+
+        try:
+            with phase("discovery"):
+                count(FILES_STATED)
+                stat = os.stat(cur_dir)
+                if (stat.st_dev, stat.st_ino) in visited:
+                    if logger.isEnabledFor(logging.DEBUG):
+                        logger.debug(f"Already explored "
+                                     f"{style_path(cur_dir)}, skipping it")
+                    continue
+                visited.add((stat.st_dev, stat.st_ino))
+
+                # Called before listing the directory, so that anyone
+                # watching it for changes doesn't miss any
+                if on_dir is not None:
+                    on_dir(cur_dir)
+
+                files, subdirs = list_dir(cur_dir)
+        except OSError as e:
+            if cur_dir == root_dir:
+                raise
+            logger.warning(style_warning("Could not descend into folder ") +
+                           style_path(cur_dir) + f": {e}")
+            continue
+
+        yield from files
+        stack.extend(reversed(subdirs))
+
+
+def list_dir(cur_dir: Path) -> Tuple[List[FileInfo], List[Path]]:
+    """
+    Returns the files (along with their header files) and the
+    subdirectories in a single directory.
+
+    May raise: OSError
+    """
+
+    files: Dict[str, FileInfo] = {}
+    header_files: List[Tuple[str, Path]] = []
     subdirs: List[Path] = []
 
-    # 1. Sort all the files in this folder into their respective categories
-    for element in cur_dir.iterdir():
-        if element.is_dir():
-            logger.debug(f"Found subdir {style_path(element)}")
-            subdirs.append(element)
-        elif element.is_file():
-            if element.suffix == HEADER_FILE_SUFFIX:
-                logger.debug(f"Found header file {style_path(element)}")
-                header_files.append(element)
-            else:
-                logger.debug(f"Found file {style_path(element)}")
-                files[element] = FileInfo(element)
-        else:
-            logger.debug(f"{style_path(element)} is neither a dir nor a file")
+    # 1. Sort all the files in this folder into their respective
+    # categories. The entries' types usually come with the directory
+    # listing, so this only needs to stat symlinks.
+    # Checked once per directory instead of building a message per entry
+    debug = logger.isEnabledFor(logging.DEBUG)
+
+    count(DIRS_LISTED)
+    with os.scandir(cur_dir) as entries:
+        for entry in entries:
+            element = cur_dir / entry.name
+
+            if _is_dir(entry):
+                if debug:
+                    logger.debug(f"Found subdir {style_path(element)}")
+                subdirs.append(element)
+            elif _is_file(entry):
+                name, suffix = os.path.splitext(entry.name)
+                if suffix == HEADER_FILE_SUFFIX:
+                    if debug:
+                        logger.debug(
+                            f"Found header file {style_path(element)}")
+                    header_files.append((name, element))
+                else:
+                    if debug:
+                        logger.debug(f"Found file {style_path(element)}")
+                    files[entry.name] = FileInfo(element)
+            elif debug:
+                logger.debug(f"{style_path(element)} is neither a dir nor a "
+                             "file")
 
     # 2. Assign the header files to their respective files
-    for header_file in header_files:
-        matching_file = header_file.with_suffix("")  # Remove last suffix
-        matching_file_info = files.get(matching_file)
+    for matching_name, header_file in header_files:
+        matching_file_info = files.get(matching_name)
 
         if matching_file_info is None:
             logger.warning(
@@ -61,19 +148,24 @@ def explore_dir(cur_dir: Path) -> List[FileInfo]:
                 style_path(header_file)
             )
         else:
-            logger.debug(f"Assigned header file {style_path(header_file)} to "
-                         f"file {style_path(matching_file)}")
+            if debug:
+                logger.debug(f"Assigned header file {style_path(header_file)} "
+                             f"to file {style_path(matching_file_info.path)}")
             matching_file_info.header = header_file
 
     # 3. Collect the resulting FileInfos
-    result = list(files.values())
+    return list(files.values()), subdirs
 
-    # 4. And (try to) recursively descend into all folders
-    for subdir in subdirs:
-        try:
-            result.extend(explore_dir(subdir))
-        except OSError as e:
-            logger.warning(style_warning("Could not descend into folder ") +
-                           style_path(subdir) + f": {e}")
 
-    return result
+def _is_dir(entry: "os.DirEntry[str]") -> bool:
+    try:
+        return entry.is_dir()
+    except OSError:
+        return False
+
+
+def _is_file(entry: "os.DirEntry[str]") -> bool:
+    try:
+        return entry.is_file()
+    except OSError:
+        return False
@@ -0,0 +1,113 @@
+"""
+This module hashes the contents of targets for the known files.
+
+Hashes are tagged with their algorithm, like "blake2b:0123...", so the
+algorithm can be changed (see the hash_algorithm config variable)
+without making the hashes of existing targets meaningless. A target is
+always compared using the algorithm its known hash was made with.
+"""
+
+import hashlib
+from pathlib import Path
+from typing import Any, Optional, Tuple
+
+from .profiling import BYTES_READ, count
+from .util import BLOCK_SIZE, ReadFileException
+
+__all__ = [
+    "SHA256", "BLAKE2B", "ALGORITHMS",
+    "Hasher", "split_hash", "hasher_for",
+]
+
+SHA256 = "sha256"
+BLAKE2B = "blake2b"
+ALGORITHMS = [SHA256, BLAKE2B]
+
+
+class Hasher:
+    def __init__(self,
+                 algorithm: str = SHA256,
+                 digest_size: Optional[int] = None
+                 ) -> None:
+        """
+        The digest size (in bytes) can only be chosen for blake2b, where
+        it defaults to 32.
+
+        May raise: ValueError
+        """
+
+        if algorithm not in ALGORITHMS:
+            raise ValueError(f"Unknown hash algorithm {algorithm!r}")
+
+        if algorithm == BLAKE2B:
+            if digest_size is None:
+                digest_size = 32
+            if not 1 <= digest_size <= hashlib.blake2b.MAX_DIGEST_SIZE:
+                raise ValueError(f"Invalid digest size {digest_size}")
+        elif digest_size is not None:
+            raise ValueError(f"The digest size of {algorithm} can't be "
+                             "changed")
+
+        self.algorithm = algorithm
+        self.digest_size = digest_size
+
+    def new(self) -> Any:
+        if self.algorithm == BLAKE2B:
+            assert self.digest_size is not None
+            return hashlib.blake2b(digest_size=self.digest_size)
+        return hashlib.sha256()
+
+    def tag(self, h: Any) -> str:
+        return f"{self.algorithm}:{h.hexdigest()}"
+
+    def hash_bytes(self, data: bytes) -> str:
+        h = self.new()
+        h.update(data)
+        return self.tag(h)
+
+    def hash_file(self, path: Path) -> str:
+        """
+        May raise: ReadFileException
+        """
+
+        try:
+            h = self.new()
+            size = 0
+
+            with open(path, "rb") as f:
+                while True:
+                    block = f.read(BLOCK_SIZE)
+                    if not block:
+                        break
+                    h.update(block)
+                    size += len(block)
+
+            count(BYTES_READ, size)
+            return self.tag(h)
+
+        except OSError as e:
+            raise ReadFileException(e)
+
+
+def split_hash(tagged_hash: str) -> Tuple[str, str]:
+    """
+    Splits a tagged hash into the algorithm and the hex digest.
+    """
+
+    algorithm, _, hex_digest = tagged_hash.partition(":")
+    return algorithm, hex_digest
+
+
+def hasher_for(tagged_hash: str) -> Optional[Hasher]:
+    """
+    Returns a hasher that produces hashes comparable to the given one,
+    or None if the hash isn't a valid tagged hash.
+    """
+
+    algorithm, hex_digest = split_hash(tagged_hash)
+    try:
+        if algorithm == BLAKE2B:
+            return Hasher(algorithm, len(hex_digest) // 2)
+        return Hasher(algorithm)
+    except ValueError:
+        return None
@@ -1,79 +1,549 @@
+"""
+This module keeps track of the hashes of all files evering has written
+(or, for links, what they link to).
+
+While processing, the hashes of newly written files are appended to a
+journal next to the known files, which is much cheaper than rewriting
+the whole known files after every target. At the end of a round, the
+journal is compacted into the known files. If evering is interrupted
+before that, the journal is replayed the next time the known files are
+loaded, and compacted as soon as they are saved again.
+
+Hashes are tagged with their algorithm (see evering.hashing). Known
+files from before the format was versioned contain untagged SHA-256
+hashes, which are tagged when they are loaded. Their paths were also
+resolved completely, including the file name, so a target that is a
+symlink to another file is looked up under the path of that file if it
+isn't known under its own path (see KnownFiles._get_id).
+
+Along with the hash, the size, mtime, inode and ctime of a file can be
+remembered. As long as they don't change, the file doesn't need to be
+hashed again to know that it wasn't modified.
+
+Since there may be hundreds of thousands of known files, they are kept
+in memory as compactly as possible: Each path is stored once as a string
+and otherwise referred to by an id, and the digests and stats are packed
+into arrays indexed by that id (see _EntryTable).
+"""
+
 import json
 import logging
+import os
+import time
+from array import array
 from pathlib import Path
-from typing import Dict, Optional, Set
+from typing import IO, Any, Dict, Iterator, List, Optional, Set, Tuple
 
 from .colors import style_error, style_path
+from .hashing import ALGORITHMS, SHA256
+from .links import is_link_entry
+from .profiling import JOURNAL_APPENDS, JSON_SAVES, count, phase
 from .util import CatastrophicError, WriteFileException, write_file
 
-__all__ = ["KnownFiles"]
+__all__ = ["FileStat", "KnownFiles"]
 logger = logging.getLogger(__name__)
 
+# The size, mtime, inode and ctime of a file
+FileStat = Tuple[int, int, int, int]
+
+# Bump this whenever the format changes
+KNOWN_FILES_VERSION = 2
+
+# A file's hash and, if it can be trusted, its stat at the time
+_Entry = Tuple[str, Optional[FileStat]]
+
+# Files modified less than this long before they were stat'ed might be
+# modified again without their mtime changing, depending on the file
+# system's timestamp resolution, so their stat can't be trusted.
+RACY_WINDOW_NS = 2 * 10**9
+
+# The size of the digests stored in an _EntryTable's array. Hashes with
+# a different size are stored like irregular entries.
+DIGEST_SIZE = 32
+
+# The kinds of entries in an _EntryTable. The algorithms are numbered
+# starting at 1, in the order of ALGORITHMS.
+_ABSENT = 0
+_IRREGULAR = 0x7f
+# Set in addition to the algorithm if the entry has a stat
+_HAS_STAT = 0x80
+
+
+class _PathTable:
+    """
+    Assigns each path an id, which stays the same as long as the table
+    exists.
+    """
+
+    def __init__(self) -> None:
+        self._ids: Dict[str, int] = {}
+        self.paths: List[str] = []
+
+    def get_id(self, path: str) -> Optional[int]:
+        return self._ids.get(path)
+
+    def add(self, path: str) -> int:
+        path_id = self._ids.get(path)
+        if path_id is None:
+            path_id = len(self.paths)
+            self._ids[path] = path_id
+            self.paths.append(path)
+        return path_id
+
+
+class _EntryTable:
+    """
+    Maps path ids (see _PathTable) to entries. Regular entries, whose
+    hash has a known algorithm and DIGEST_SIZE bytes, are packed into
+    arrays with one fixed-size row per id. All other entries (like the
+    links of evering.links) are kept in a dict.
+    """
+
+    def __init__(self) -> None:
+        self._kinds = bytearray()
+        self._digests = bytearray()
+        self._stats = array("q")
+        self._irregular: Dict[int, _Entry] = {}
+
+    def _grow(self, path_id: int) -> None:
+        missing = path_id + 1 - len(self._kinds)
+        if missing > 0:
+            self._kinds.extend(bytes(missing))
+            self._digests.extend(bytes(missing * DIGEST_SIZE))
+            self._stats.extend([0] * (missing * 4))
+
+    def __contains__(self, path_id: int) -> bool:
+        return (path_id < len(self._kinds) and
+                self._kinds[path_id] != _ABSENT)
+
+    def ids(self) -> Iterator[int]:
+        return (path_id for path_id, kind in enumerate(self._kinds)
+                if kind != _ABSENT)
+
+    def get_hash(self, path_id: int) -> Optional[str]:
+        if path_id not in self:
+            return None
+
+        kind = self._kinds[path_id]
+        if kind == _IRREGULAR:
+            return self._irregular[path_id][0]
+
+        algorithm = ALGORITHMS[(kind & ~_HAS_STAT) - 1]
+        start = path_id * DIGEST_SIZE
+        digest = self._digests[start:start + DIGEST_SIZE]
+        return f"{algorithm}:{digest.hex()}"
+
+    def get_stat(self, path_id: int) -> Optional[FileStat]:
+        if path_id not in self:
+            return None
+
+        kind = self._kinds[path_id]
+        if kind == _IRREGULAR:
+            return self._irregular[path_id][1]
+        if not kind & _HAS_STAT:
+            return None
+
+        size, mtime, inode, ctime = self._stats[path_id * 4:path_id * 4 + 4]
+        return size, mtime, inode, ctime
+
+    def get(self, path_id: int) -> Optional[_Entry]:
+        file_hash = self.get_hash(path_id)
+        if file_hash is None:
+            return None
+        return file_hash, self.get_stat(path_id)
+
+    def set(self, path_id: int, entry: _Entry) -> None:
+        self._grow(path_id)
+        self._irregular.pop(path_id, None)
+
+        file_hash, stat = entry
+        algorithm, _, hex_digest = file_hash.partition(":")
+        try:
+            kind = ALGORITHMS.index(algorithm) + 1
+            digest = bytes.fromhex(hex_digest)
+            if len(digest) != DIGEST_SIZE:
+                raise ValueError("Unexpected digest size")
+            if stat is not None:
+                start = path_id * 4
+                # May raise OverflowError for inodes beyond 2**63
+                self._stats[start:start + 4] = array("q", stat)
+                kind |= _HAS_STAT
+        except (ValueError, OverflowError):
+            self._kinds[path_id] = _IRREGULAR
+            self._irregular[path_id] = entry
+            return
+
+        start = path_id * DIGEST_SIZE
+        self._digests[start:start + DIGEST_SIZE] = digest
+        self._kinds[path_id] = kind
+
+    def copy(self, path_id: int, other: "_EntryTable") -> None:
+        """
+        Copies the entry with the given id from the other table, if it
+        has one.
+        """
+
+        entry = other.get(path_id)
+        if entry is not None:
+            self.set(path_id, entry)
+
+    def remove(self, path_id: int) -> None:
+        if path_id in self:
+            self._kinds[path_id] = _ABSENT
+            self._irregular.pop(path_id, None)
+
+    def update(self, other: "_EntryTable") -> None:
+        for path_id in other.ids():
+            self.copy(path_id, other)
+
 
 class KnownFiles:
     def __init__(self, path: Path) -> None:
         self._path = path
-        self._old_known_files: Dict[Path, str] = {}
-        self._new_known_files: Dict[Path, str] = {}
+        self._paths = _PathTable()
+        self._old_known_files = _EntryTable()
+        self._new_known_files = _EntryTable()
+
+        # Append a .journal to the file name
+        self._journal_path = Path(*self._path.parts[:-1],
+                                  self._path.name + ".journal")
+        self._journal: Optional[IO[str]] = None
+        # Updates that haven't been written to the journal yet
+        self._unjournaled: List[Tuple[str, _Entry]] = []
+        # Whether the journal of an interrupted round was replayed, but
+        # not yet compacted
+        self._journal_recovered = False
+        # Ids of the entries loaded from known files from before the
+        # format was versioned, and of those that were migrated to the
+        # path of a link to them
+        self._legacy_ids: Set[int] = set()
+        self._migrated_ids: Set[int] = set()
+        # The files that were written this round through a symlink that
+        # isn't managed by evering (see was_recently_modified)
+        self._written_through_links: Set[str] = set()
 
         try:
             with open(self._path) as f:
-                self._old_known_files = self._read_known_files(f.read())
+                self._read_known_files(f.read())
         except FileNotFoundError:
             logger.debug(f"File {style_path(self._path)} does not exist, "
                          "creating a new file on the first upcoming save")
 
-    def _normalize_path(self, path: Path) -> Path:
-        return path.expanduser().resolve()
+        self._recover_journal()
+
+    def _normalize_path(self, path: Path) -> str:
+        # Targets may be links (see evering.links), which are known by
+        # their own path, not that of the file they link to
+        directory, name = os.path.split(os.path.expanduser(path))
+        return os.path.join(os.path.realpath(directory), name)
+
+    @staticmethod
+    def _normalize_saved_path(path: str,
+                              resolved_dirs: Dict[str, str]
+                              ) -> str:
+        """
+        Like _normalize_path, but for paths that were already normalized
+        when they were saved. Each directory is only resolved once, since
+        most of them contain many known files.
+        """
+
+        directory, name = os.path.split(path)
+        resolved = resolved_dirs.get(directory)
+        if resolved is None:
+            resolved = os.path.realpath(directory)
+            resolved_dirs[directory] = resolved
+        return os.path.join(resolved, name)
+
+    def _get_id(self, path: Path) -> Optional[int]:
+        """
+        Returns the id of the path's normalized form, if the path is
+        known. Migrates entries from before the format was versioned,
+        which are known by the fully resolved path.
+        """
 
-    def _read_known_files(self, text: str) -> Dict[Path, str]:
-        known_files: Dict[Path, str] = {}
+        normalized = self._normalize_path(path)
+        path_id = self._paths.get_id(normalized)
+        if not self._legacy_ids:
+            return path_id
+        if path_id is not None and (path_id in self._new_known_files or
+                                    path_id in self._old_known_files):
+            return path_id
+
+        resolved = os.path.realpath(os.path.expanduser(path))
+        legacy_id = self._paths.get_id(resolved)
+        if legacy_id is None or legacy_id not in self._legacy_ids:
+            return path_id
+
+        entry = self._old_known_files.get(legacy_id)
+        if entry is None:
+            return path_id
+
+        # The legacy entry is kept, in case the file the path links to is
+        # a target as well
+        path_id = self._paths.add(normalized)
+        self._old_known_files.set(path_id, entry)
+        self._migrated_ids.add(legacy_id)
+        return path_id
+
+    def _read_known_files(self, text: str) -> None:
         raw_known_files = json.loads(text)
 
         if not isinstance(raw_known_files, dict):
             raise CatastrophicError(style_error(
                 "Root level structure is not a dictionary"))
 
-        for path, file_hash in raw_known_files.items():
+        # Paths are absolute, so there is no file called "version"
+        version = raw_known_files.get("version")
+        legacy = version is None
+        raw_files: Any
+        if legacy:
+            raw_files = raw_known_files  # From before versioning
+        elif version == KNOWN_FILES_VERSION:
+            raw_files = raw_known_files.get("files")
+            if not isinstance(raw_files, dict):
+                raise CatastrophicError(style_error(
+                    "Files are not a dictionary"))
+        else:
+            raise CatastrophicError(style_error(
+                f"Unsupported version {version!r}"))
+
+        resolved_dirs: Dict[str, str] = {}
+        for path, raw_entry in raw_files.items():
             if not isinstance(path, str):
                 raise CatastrophicError(style_error(
                     f"Path {path!r} is not a string"))
-            if not isinstance(file_hash, str):
+
+            entry = self._entry_from_json(raw_entry)
+            if entry is None:
                 raise CatastrophicError(style_error(
-                    f"Hash {hash!r} at path {path!r} is not a string"))
+                    f"Invalid entry {raw_entry!r} at path {path!r}"))
 
-            path = self._normalize_path(Path(path))
-            known_files[path] = file_hash
+            path = self._normalize_saved_path(path, resolved_dirs)
+            path_id = self._paths.add(path)
+            self._old_known_files.set(path_id, entry)
+            if legacy:
+                self._legacy_ids.add(path_id)
 
-        return known_files
+    @staticmethod
+    def _entry_from_json(raw: Any) -> Optional[_Entry]:
+        """
+        An entry is either just a hash or a list of the hash and the
+        stat. Returns None if the entry is invalid.
+        """
+
+        stat: Optional[FileStat]
+        if isinstance(raw, str):
+            file_hash, stat = raw, None
+        elif (isinstance(raw, list) and len(raw) == 5 and
+                isinstance(raw[0], str) and
+                all(isinstance(elem, int) for elem in raw[1:])):
+            file_hash, stat = raw[0], (raw[1], raw[2], raw[3], raw[4])
+        else:
+            return None
+
+        # Before hashes were tagged, they were always SHA-256
+        if ":" not in file_hash:
+            file_hash = f"{SHA256}:{file_hash}"
+
+        return file_hash, stat
+
+    @staticmethod
+    def _entry_to_json(entry: _Entry) -> Any:
+        file_hash, stat = entry
+        if stat is None:
+            return file_hash
+        return [file_hash, *stat]
+
+    def _recover_journal(self) -> None:
+        """
+        Replays the journal of an interrupted round. It is only compacted
+        into the known files when they are saved (see
+        _compact_recovered_journal), so dry runs don't modify anything.
+        """
+
+        try:
+            with open(self._journal_path) as f:
+                lines = f.read().splitlines()
+        except FileNotFoundError:
+            return
+        except OSError as e:
+            raise CatastrophicError(
+                style_error("Could not load journal from ") +
+                style_path(self._journal_path) + f": {e}")
+
+        logger.debug(f"Recovering known files from journal "
+                     f"{style_path(self._journal_path)}")
+
+        resolved_dirs: Dict[str, str] = {}
+        for i, line in enumerate(lines):
+            try:
+                path, raw_entry = json.loads(line)
+                entry = self._entry_from_json(raw_entry)
+                if not isinstance(path, str) or entry is None:
+                    raise ValueError(f"Invalid entry {line!r}")
+            except (TypeError, ValueError) as e:
+                if i == len(lines) - 1:
+                    # The last entry may have been cut off while it was
+                    # written. The file it describes was written in full,
+                    # but nothing else, so it is treated as unknown.
+                    logger.debug(f"Ignoring incomplete journal entry "
+                                 f"{line!r}")
+                    break
+
+                raise CatastrophicError(
+                    style_error("Invalid journal ") +
+                    style_path(self._journal_path) + f": {e}")
+
+            path = self._normalize_saved_path(path, resolved_dirs)
+            self._old_known_files.set(self._paths.add(path), entry)
+
+        self._journal_recovered = True
+
+    def _compact_recovered_journal(self) -> None:
+        """
+        Saves the replayed journal as part of the known files, so the
+        next journal starts out empty. The replayed journal can't just be
+        appended to, since its last entry may have been cut off.
+        """
+
+        if self._journal_recovered:
+            self._save(self._dump(self._old_known_files))
+            self._remove_journal()
 
     def was_recently_modified(self, path: Path) -> bool:
-        return self._normalize_path(path) in self._new_known_files
+        """
+        Whether the file was modified this round, either under its own
+        path or through a symlink to it. A target that is a symlink
+        (made by the user, not by evering) is written through, so it is
+        also recently modified if the file it links to is.
+        """
+
+        normalized = self._normalize_path(path)
+        path_id = self._paths.get_id(normalized)
+        if path_id is not None and path_id in self._new_known_files:
+            return True
+        if normalized in self._written_through_links:
+            return True
+        if not os.path.islink(normalized):
+            return False
+
+        resolved = os.path.realpath(normalized)
+        if resolved in self._written_through_links:
+            return True
+        path_id = self._paths.get_id(resolved)
+        return path_id is not None and path_id in self._new_known_files
+
+    def _get_table(self, path: Path) -> Tuple[Optional[_EntryTable], int]:
+        """
+        Returns the table that contains the path's current entry (if
+        any) and the path's id.
+        """
+
+        path_id = self._get_id(path)
+        if path_id is None:
+            return None, -1
+
+        if path_id in self._new_known_files:
+            return self._new_known_files, path_id
+        if path_id in self._old_known_files:
+            return self._old_known_files, path_id
+        return None, path_id
 
     def get_hash(self, path: Path) -> Optional[str]:
-        path = self._normalize_path(path)
+        table, path_id = self._get_table(path)
+        if table is None:
+            return None
+        return table.get_hash(path_id)
+
+    def matches_stat(self, path: Path, stat: os.stat_result) -> bool:
+        """
+        Whether the file's stat is the same as when its hash was
+        recorded, so the file still has the known hash.
+        """
+
+        table, path_id = self._get_table(path)
+        if table is None:
+            return False
+
+        known_stat = table.get_stat(path_id)
+        if known_stat is None:
+            return False
+
+        return known_stat == (stat.st_size, stat.st_mtime_ns, stat.st_ino,
+                              stat.st_ctime_ns)
+
+    def update_file(self,
+                    path: Path,
+                    file_hash: str,
+                    stat: Optional[os.stat_result] = None
+                    ) -> None:
+        """
+        If given, the stat must have been taken before the file was
+        hashed, so any later modification changes it. It is ignored if
+        the file was modified so recently that it can't be trusted.
+        """
+
+        file_stat: Optional[FileStat] = None
+        if (stat is not None and
+                stat.st_mtime_ns < time.time_ns() - RACY_WINDOW_NS):
+            file_stat = (stat.st_size, stat.st_mtime_ns, stat.st_ino,
+                         stat.st_ctime_ns)
+
+        # Migrates a legacy entry, so it isn't forgotten
+        self._get_id(path)
 
-        h = self._new_known_files.get(path)
+        normalized = self._normalize_path(path)
+        entry = (file_hash, file_stat)
+        self._new_known_files.set(self._paths.add(normalized), entry)
+        self._unjournaled.append((normalized, entry))
 
-        if h is None:
-            h = self._old_known_files.get(path)
+        if not is_link_entry(file_hash) and os.path.islink(normalized):
+            self._written_through_links.add(os.path.realpath(normalized))
 
-        return h
+    def keep_file(self, path: Path) -> None:
+        """
+        Marks a file as still known even though it wasn't modified this
+        round, for example because its config file didn't change. Does
+        nothing if the file was already modified this round.
+        """
 
-    def update_file(self, path: Path, file_hash: str) -> None:
-        self._new_known_files[self._normalize_path(path)] = file_hash
+        path_id = self._get_id(path)
+        if path_id is None or path_id in self._new_known_files:
+            return
+
+        self._new_known_files.copy(path_id, self._old_known_files)
 
     def save_incremental(self) -> None:
-        to_save: Dict[str, str] = {}
-        paths = self._old_known_files.keys() | self._new_known_files.keys()
-        for path in paths:
-            if path in self._new_known_files:
-                to_save[str(path)] = self._new_known_files[path]
-            else:
-                to_save[str(path)] = self._old_known_files[path]
+        """
+        Appends all updates since the last save to the journal.
+        """
+
+        if not self._unjournaled:
+            return
+
+        text = "".join(
+            json.dumps([path, self._entry_to_json(entry)]) + "\n"
+            for path, entry in self._unjournaled)
+
+        self._compact_recovered_journal()
 
-        self._save(json.dumps(to_save, indent=2))
-        logger.debug(f"Incremental save to {style_path(self._path)} completed")
+        try:
+            with phase("known files save"):
+                if self._journal is None:
+                    self._journal = open(self._journal_path, "a")
+                self._journal.write(text)
+                self._journal.flush()
+                count(JOURNAL_APPENDS)
+        except OSError as e:
+            raise CatastrophicError(
+                style_error("Error appending to journal ") +
+                style_path(self._journal_path) + f": {e}")
+
+        self._unjournaled = []
+        # This runs once per written target
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug(f"Incremental save to "
+                         f"{style_path(self._journal_path)} completed")
 
     def find_forgotten_files(self) -> Set[Path]:
         """
@@ -81,25 +551,91 @@ class KnownFiles:
         are no longer known (i. e. have been forgotten).
         """
 
-        return set(self._old_known_files.keys() - self._new_known_files.keys())
+        return {Path(self._paths.paths[path_id])
+                for path_id in self._old_known_files.ids()
+                if path_id not in self._new_known_files and
+                path_id not in self._migrated_ids}
 
-    def save_final(self) -> None:
-        to_save: Dict[str, str] = {}
+    def checkpoint(self) -> None:
+        """
+        Saves all known files, including those that weren't modified this
+        round, and starts a new round. Files modified so far no longer
+        count as recently modified.
+
+        Unlike save_final, this never forgets any files, so it can be
+        used by long-running processes that only process some of the
+        config files each round.
+        """
+
+        # Migrated legacy entries are now known by the path of the link
+        for path_id in self._migrated_ids:
+            if path_id not in self._new_known_files:
+                self._old_known_files.remove(path_id)
+        self._migrated_ids = set()
 
-        for path, file_hash in self._new_known_files.items():
-            to_save[str(path)] = file_hash
+        self._old_known_files.update(self._new_known_files)
+        self._new_known_files = _EntryTable()
+        self._written_through_links = set()
 
-        self._save(json.dumps(to_save, indent=2))
+        self._save(self._dump(self._old_known_files))
+        self._unjournaled = []
+        self._remove_journal()
+        logger.debug(f"Checkpoint of {style_path(self._path)} completed")
+
+    def save_final(self) -> None:
+        self._save(self._dump(self._new_known_files))
+        self._unjournaled = []
+        self._remove_journal()
         logger.debug(f"Final save to {style_path(self._path)} completed")
 
+    def _dump(self, known_files: _EntryTable) -> str:
+        # Equivalent to json.dumps(..., indent=2), except that each file
+        # is on a single line. json.dumps is much slower with an indent.
+        lines = []
+        for path_id in known_files.ids():
+            entry = known_files.get(path_id)
+            assert entry is not None
+            path = json.dumps(self._paths.paths[path_id])
+            lines.append(f"    {path}: "
+                         f"{json.dumps(self._entry_to_json(entry))}")
+
+        if not lines:
+            return json.dumps({"version": KNOWN_FILES_VERSION, "files": {}},
+                              indent=2)
+
+        return ("{\n"
+                f'  "version": {KNOWN_FILES_VERSION},\n'
+                '  "files": {\n' +
+                ",\n".join(lines) +
+                "\n  }\n}")
+
     def _save(self, text: str) -> None:
         # Append a .tmp to the file name
         path = Path(*self._path.parts[:-1], self._path.name + ".tmp")
 
         try:
-            write_file(path, text)
-            path.replace(self._path)  # Assumed to be atomic
+            with phase("known files save"):
+                write_file(path, text)
+                path.replace(self._path)  # Assumed to be atomic
+                count(JSON_SAVES)
         except (WriteFileException, OSError) as e:
             raise CatastrophicError(
                 style_error("Error saving known files to ") +
                 style_path(path) + f": {e}")
+
+    def _remove_journal(self) -> None:
+        """
+        Must only be called once everything in the journal is contained
+        in the known files.
+        """
+
+        try:
+            if self._journal is not None:
+                self._journal.close()
+                self._journal = None
+            self._journal_path.unlink(missing_ok=True)
+            self._journal_recovered = False
+        except OSError as e:
+            raise CatastrophicError(
+                style_error("Error removing journal ") +
+                style_path(self._journal_path) + f": {e}")
@@ -0,0 +1,125 @@
+"""
+This module deploys binary files as links to the file in the config dir
+instead of copies (see the binary_mode config variable).
+
+Instead of a hash, the known files contain an entry like
+"symlink:/path/to/config/file" for a link, which can be checked without
+reading either file. Entries of hard links also contain the device and
+inode the link was created with, like "hardlink:2049:1234:/path/to/...".
+The config file may be replaced by a new file (for example by an editor
+or git), after which the link still refers to the old inode.
+"""
+
+import os
+from enum import Enum
+from pathlib import Path
+from typing import Optional, Tuple
+
+# The device and inode of a file
+_Identity = Tuple[int, int]
+
+__all__ = [
+    "BinaryMode",
+    "link_entry", "is_link_entry", "check_link", "create_link",
+]
+
+
+class BinaryMode(Enum):
+    COPY = "copy"
+    SYMLINK = "symlink"
+    HARDLINK = "hardlink"
+
+
+_LINK_MODES = {mode.value: mode for mode in BinaryMode
+               if mode != BinaryMode.COPY}
+
+
+def link_entry(mode: BinaryMode, source: Path) -> str:
+    """
+    The known files entry of a target that is a link to the source in
+    its current state.
+
+    May raise: OSError
+    """
+
+    if mode == BinaryMode.HARDLINK:
+        return _hardlink_entry(source, os.stat(source))
+    return f"{mode.value}:{os.path.abspath(source)}"
+
+
+def _hardlink_entry(source: Path, stat: os.stat_result) -> str:
+    return (f"{BinaryMode.HARDLINK.value}:{stat.st_dev}:{stat.st_ino}:"
+            f"{os.path.abspath(source)}")
+
+
+def _parse_link_entry(entry: str
+                      ) -> Optional[Tuple[BinaryMode, str,
+                                          Optional[_Identity]]]:
+    tag, sep, rest = entry.partition(":")
+    mode = _LINK_MODES.get(tag)
+    if not sep or mode is None:
+        return None
+
+    if mode == BinaryMode.HARDLINK:
+        dev, _, rest_after_dev = rest.partition(":")
+        ino, _, source = rest_after_dev.partition(":")
+        if dev.isdigit() and ino.isdigit():
+            return mode, source, (int(dev), int(ino))
+
+    # Entries of hard links from before their identity was recorded
+    # consist of just the source
+    return mode, rest, None
+
+
+def is_link_entry(entry: Optional[str]) -> bool:
+    return entry is not None and _parse_link_entry(entry) is not None
+
+
+def check_link(target: Path, entry: str) -> bool:
+    """
+    Whether the target is still the link the entry describes. Only looks
+    at the link itself and the inodes, never at the contents.
+
+    A hard link is compared with the inode it was created with, so it
+    still counts as unmodified after the source was replaced.
+    """
+
+    parsed = _parse_link_entry(entry)
+    if parsed is None:
+        return False
+    mode, source, identity = parsed
+
+    try:
+        if mode == BinaryMode.SYMLINK:
+            return os.readlink(target) == source
+
+        if identity is None:
+            source_stat = os.stat(source)
+            identity = (source_stat.st_dev, source_stat.st_ino)
+
+        target_stat = os.stat(target, follow_symlinks=False)
+        return (target_stat.st_dev, target_stat.st_ino) == identity
+    except OSError:
+        return False
+
+
+def create_link(mode: BinaryMode, source: Path, target: Path) -> str:
+    """
+    Replaces the target (if it exists) with a link to the source and
+    returns its known files entry.
+
+    May raise: OSError
+    """
+
+    assert mode != BinaryMode.COPY
+    source_path = os.path.abspath(source)
+
+    if os.path.lexists(target):
+        os.unlink(target)
+
+    if mode == BinaryMode.SYMLINK:
+        os.symlink(source_path, target)
+        return link_entry(mode, source)
+
+    os.link(source_path, target)
+    return _hardlink_entry(source, os.stat(target, follow_symlinks=False))
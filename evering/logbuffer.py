@@ -0,0 +1,72 @@
+"""
+This module allows holding back the log messages of a thread so they can
+be emitted later in one piece, for example to keep the messages about a
+file together while several files are processed in parallel.
+
+Log buffers only take effect on handlers that buffering was installed on
+(see install_log_buffering). Everywhere else, messages are emitted
+immediately as usual.
+"""
+
+import logging
+import threading
+from types import TracebackType
+from typing import List, Optional, Type
+
+__all__ = ["LogBuffer", "install_log_buffering"]
+
+_active = threading.local()
+
+
+class LogBuffer:
+    def __init__(self) -> None:
+        self.records: List[logging.LogRecord] = []
+
+    def __enter__(self) -> "LogBuffer":
+        _active.buffer = self
+        return self
+
+    def __exit__(self,
+                 exc_type: Optional[Type[BaseException]],
+                 exc_value: Optional[BaseException],
+                 traceback: Optional[TracebackType],
+                 ) -> None:
+        _active.buffer = None
+
+    def replay(self) -> None:
+        """
+        Emits all buffered messages in the current thread.
+        """
+
+        records, self.records = self.records, []
+        for record in records:
+            logging.getLogger(record.name).handle(record)
+
+
+class _BufferingFilter(logging.Filter):
+    def filter(self, record: logging.LogRecord) -> bool:
+        buffer: Optional[LogBuffer] = getattr(_active, "buffer", None)
+        if buffer is None:
+            return True
+
+        # With multiple handlers, the same record passes by several times
+        if not buffer.records or buffer.records[-1] is not record:
+            buffer.records.append(record)
+
+        return False
+
+
+_FILTER = _BufferingFilter()
+
+
+def install_log_buffering(logger: Optional[logging.Logger] = None) -> None:
+    """
+    Makes the handlers of a logger (the root logger by default) respect
+    log buffers.
+    """
+
+    if logger is None:
+        logger = logging.getLogger()
+
+    for handler in logger.handlers:
+        handler.addFilter(_FILTER)
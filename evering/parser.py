@@ -1,23 +1,36 @@
+import dis
+import re
 from abc import ABC
-from typing import Any, Dict, List, Optional, Tuple, Union
+from types import CodeType
+from typing import (AbstractSet, Any, FrozenSet, List, MutableMapping,
+                    Optional, Set, Tuple, Union)
 
-from .util import safer_eval
+from .util import ExecuteException, safer_compile, safer_eval
 
 """
 This parsing solution has the following structure:
 
 1. Separate header and config file content, if necessary
 2. Split up text into lines, if still necessary
-3. Parse each line individually
+3. Parse each line individually, compiling all expressions
 4. Use recursive descent approach to group the lines into blocks and if-blocks
-5. Evaluate the blocks recursively
+5. Generate a single python expression from the blocks and compile it
+6. Evaluate the compiled expression (or, as a reference, the blocks
+   recursively)
 """
 
 __all__ = [
     "split_header_and_rest",
     "ParseException", "Parser",
+    "DYNAMIC_LOOKUP_BUILTINS", "code_dependencies",
 ]
 
+# Builtins that can read variables without naming them. If code uses one
+# of these, its dependencies can't be known.
+DYNAMIC_LOOKUP_BUILTINS = frozenset({
+    "locals", "globals", "vars", "dir", "eval", "exec",
+})
+
 
 def split_header_and_rest(text: str) -> Tuple[List[str], List[str]]:
     lines = text.splitlines()
@@ -61,6 +74,20 @@ class Parser:
         self.expression_prefix = expression_prefix
         self.expression_suffix = expression_suffix
 
+        # Matches a stripped line if it is a statement. Either the first
+        # group is the name of a statement with argument and the second
+        # group is the argument, or the third group is the name of a
+        # statement without argument.
+        self.statement_regex = re.compile(
+            re.escape(statement_prefix) +
+            " (?:(if|elif)(.*)|(else|endif))",
+            re.DOTALL)
+
+        # Every expression compiled while parsing, in no particular order
+        self.expressions: List[CodeType] = []
+        self._dependencies: Optional[FrozenSet[str]] = None
+        self._attributes: Optional[FrozenSet[str]] = None
+
         # Split up the text into lines and parse those
         lines: List[Line] = []
         for i, text in enumerate(raw_lines):
@@ -70,56 +97,174 @@ class Parser:
         lines_queue = list(reversed(lines))
         self.main_block = Block(self, lines_queue)
 
-    def evaluate(self, local_vars: Dict[str, Any]) -> str:
+        self._code = self._compile()
+
+    def _compile(self) -> Optional[CodeType]:
+        """
+        Turns the entire template into a single python expression that
+        evaluates to the resulting text. The expression is evaluated
+        exactly like the individual expressions would be, so names are
+        looked up in the same places as in the reference interpreter.
+
+        Returns None if the generated expression can't be compiled (for
+        example because the if-blocks are nested too deeply), in which
+        case the template is interpreted instead.
+        """
+
+        source = f"''.join([{self.main_block.generate()}])"
+
+        try:
+            return compile(source, "<template>", "eval")
+        except (SyntaxError, RecursionError, MemoryError):
+            return None
+
+    @property
+    def dependencies(self) -> FrozenSet[str]:
+        """
+        The names of all variables the template might read when it is
+        evaluated, regardless of which branches are taken. This may
+        include names the template assigns to itself (using ":=") and
+        names of builtins, including DYNAMIC_LOOKUP_BUILTINS.
+        """
+
+        if self._dependencies is None:
+            names: Set[str] = set()
+            for code in self.expressions:
+                _collect_names(code, names)
+            self._dependencies = frozenset(names)
+
+        return self._dependencies
+
+    @property
+    def attributes(self) -> FrozenSet[str]:
+        """
+        The names of all attributes the template might look up on any
+        value, including methods it calls.
+        """
+
+        if self._attributes is None:
+            names: Set[str] = set()
+            for code in self.expressions:
+                _collect_names(code, names, _ATTRIBUTE_LOOKUP_OPS)
+            self._attributes = frozenset(names)
+
+        return self._attributes
+
+    def evaluate(self, local_vars: MutableMapping[str, Any]) -> str:
+        """
+        May raise: ExecuteException
+        """
+
+        if self._code is None:
+            return self.interpret(local_vars)
+
+        return safer_eval(self._code, local_vars)
+
+    def interpret(self, local_vars: MutableMapping[str, Any]) -> str:
+        """
+        Evaluates the blocks recursively. This is slower than evaluate()
+        but serves as the reference the compiled template must match.
+
+        May raise: ExecuteException
+        """
+
         lines = self.main_block.evaluate(local_vars)
         return "".join(f"{line}\n" for line in lines)
 
 
+def code_dependencies(code: CodeType) -> FrozenSet[str]:
+    """
+    The names of all variables a code object (for example a compiled
+    header) might read from its locals or globals.
+    """
+
+    names: Set[str] = set()
+    _collect_names(code, names)
+    return frozenset(names)
+
+
+def _collect_names(code: CodeType,
+                   names: Set[str],
+                   opnames: AbstractSet[str] = frozenset()
+                   ) -> None:
+    """
+    Adds the names of all variables that a code object (and the code
+    objects nested inside it, like lambdas and comprehensions) looks up
+    by name to the set. If opnames are given, the names used by those
+    opcodes are collected instead.
+    """
+
+    opnames = opnames or _NAME_LOOKUP_OPS
+    for instruction in dis.get_instructions(code):
+        if instruction.opname in opnames:
+            names.add(instruction.argval)
+
+    for const in code.co_consts:
+        if isinstance(const, CodeType):
+            _collect_names(const, names, opnames)
+
+
+# Opcodes that look up variables that aren't local to the code object
+_NAME_LOOKUP_OPS = {
+    "LOAD_NAME", "LOAD_GLOBAL", "LOAD_FROM_DICT_OR_GLOBALS",
+    "LOAD_CLASSDEREF", "LOAD_FROM_DICT_OR_DEREF",
+}
+
+# Opcodes that look up attributes (and methods) of values
+_ATTRIBUTE_LOOKUP_OPS = {"LOAD_ATTR", "LOAD_METHOD", "LOAD_SUPER_ATTR"}
+
+
+def _parenthesize(expression: str) -> str:
+    """
+    Wraps an expression (as it would be passed to eval()) so it can be
+    embedded into a larger expression. The newlines keep comments inside
+    the expression from swallowing the closing parenthesis.
+    """
+
+    stripped = expression.lstrip(" \t")
+    return f"(\n{stripped}\n)"
+
+
 # Line parsing (inline expressions)
 
 class Line(ABC):
     @staticmethod
     def parse(parser: Parser, text: str, line_number: int) -> "Line":
-        try:
-            return IfStatement(parser, text, line_number)
-        except ParseException:
-            pass
-
-        try:
-            return ElifStatement(parser, text, line_number)
-        except ParseException:
-            pass
-
-        try:
-            return ElseStatement(parser, text, line_number)
-        except ParseException:
-            pass
-
-        try:
-            return EndifStatement(parser, text, line_number)
-        except ParseException:
-            pass
+        """
+        May raise: ParseException
+        """
 
-        return ActualLine(parser, text, line_number)
+        match = parser.statement_regex.fullmatch(text.strip())
+        if match is None:
+            return ActualLine(parser, text, line_number)
+
+        name, argument, noarg_name = match.groups()
+        if name == "if":
+            return IfStatement(parser, argument.strip(), line_number)
+        elif name == "elif":
+            return ElifStatement(parser, argument.strip(), line_number)
+        elif noarg_name == "else":
+            return ElseStatement(parser, line_number)
+        else:
+            return EndifStatement(parser, line_number)
 
     def __init__(self, parser: Parser, line_number: int) -> None:
         self.parser = parser
         self.line_number = line_number
 
-    def _parse_statement(self,
-                         text: str,
-                         statement_name: str
-                         ) -> Optional[str]:
-        start = f"{self.parser.statement_prefix} {statement_name}"
-        text = text.strip()
-        if text.startswith(start):
-            return text[len(start):].strip()
-        else:
-            return None
+    def compile_expression(self, text: str) -> CodeType:
+        """
+        May raise: ParseException
+        """
+
+        # eval() ignores leading spaces and tabs, but compile() doesn't
+        try:
+            code = safer_compile(text.lstrip(" \t"), "eval", "<expression>")
+        except ExecuteException as e:
+            raise ParseException.on_line(self, f"Invalid expression: {e}")
 
-    def _parse_statement_noarg(self, text: str, statement_name: str) -> bool:
-        target = f"{self.parser.statement_prefix} {statement_name}"
-        return text.strip() == target
+        self.parser.expressions.append(code)
+        return code
 
 
 class ActualLine(Line):
@@ -131,12 +276,12 @@ class ActualLine(Line):
         super().__init__(parser, line_number)
         self.chunks = self._parse_chunks(text)
 
-    def _parse_chunks(self, text: str) -> List[Tuple[str, bool]]:
+    def _parse_chunks(self, text: str) -> List[Tuple[str, Optional[CodeType]]]:
         """
-        A chunk is a tuple (text, is_expression), where the first
-        argument is the text contained in the chunk and the second
-        argument a boolean that indicates whether this chunk is a
-        python expression (or just plain text).
+        A chunk is a tuple (text, code), where the first argument is
+        the text contained in the chunk and the second argument is the
+        compiled python expression if this chunk is an expression, or
+        None if it is just plain text.
 
         Because it simplifies the program logic, a chunk's text may
         also be the empty string.
@@ -144,14 +289,14 @@ class ActualLine(Line):
         May raise: ParseException
         """
 
-        chunks: List[Tuple[str, bool]] = []
+        chunks: List[Tuple[str, Optional[CodeType]]] = []
 
         i = 0
         while i < len(text):
             # Find expression prefix
             od = text.find(self.parser.expression_prefix, i)
             if od == -1:
-                chunks.append((text[i:], False))
+                chunks.append((text[i:], None))
                 break  # We've consumed the entire string.
             od_end = od + len(self.parser.expression_prefix)
 
@@ -166,13 +311,14 @@ class ActualLine(Line):
             cd_end = cd + len(self.parser.expression_suffix)
 
             # Split up into chunks
-            chunks.append((text[i:od], False))
-            chunks.append((text[od_end:cd], True))
+            expression = text[od_end:cd]
+            chunks.append((text[i:od], None))
+            chunks.append((expression, self.compile_expression(expression)))
             i = cd_end
 
         return chunks
 
-    def evaluate(self, local_vars: Dict[str, Any]) -> str:
+    def evaluate(self, local_vars: MutableMapping[str, Any]) -> str:
         """
         May raise: ExecuteException
         """
@@ -181,67 +327,71 @@ class ActualLine(Line):
                        for chunk in self.chunks)
 
     def _evaluate_chunk(self,
-                        chunk: Tuple[str, bool],
-                        local_vars: Dict[str, Any],
+                        chunk: Tuple[str, Optional[CodeType]],
+                        local_vars: MutableMapping[str, Any],
                         ) -> str:
         """
         May raise: ExecuteException
         """
 
-        if not chunk[1]:
+        if chunk[1] is None:
             return chunk[0]
 
-        return str(safer_eval(chunk[0], local_vars))
+        return str(safer_eval(chunk[1], local_vars))
 
-
-class IfStatement(Line):
-    def __init__(self, parser: Parser, text: str, line_number: int) -> None:
+    def generate(self) -> str:
         """
-        May raise: ParseException
+        Returns a python expression that evaluates to this line,
+        including the trailing newline.
         """
 
-        super().__init__(parser, line_number)
+        if all(code is None for _, code in self.chunks):
+            return repr("".join(text for text, _ in self.chunks) + "\n")
 
-        self.argument = self._parse_statement(text, "if")
-        if self.argument is None:
-            raise ParseException.on_line(self, "Not an 'if' statement")
+        parts: List[str] = []
+        for text, code in self.chunks:
+            if code is not None:
+                # Unlike str(), this doesn't look up any names, which the
+                # template's variables could shadow
+                parts.append(f"'%s' % ({_parenthesize(text)},)")
+            elif text:
+                parts.append(repr(text))
+        parts.append(repr("\n"))
 
+        return f"''.join(({', '.join(parts)}))"
 
-class ElifStatement(Line):
-    def __init__(self, parser: Parser, text: str, line_number: int) -> None:
-        """
-        May raise: ParseException
-        """
 
+class ConditionalStatement(Line):
+    def __init__(self,
+                 parser: Parser,
+                 argument: str,
+                 line_number: int
+                 ) -> None:
         super().__init__(parser, line_number)
+        self.argument = argument
 
-        self.argument = self._parse_statement(text, "elif")
-        if self.argument is None:
-            raise ParseException.on_line(self, "Not an 'elif' statement")
-
-
-class ElseStatement(Line):
-    def __init__(self, parser: Parser, text: str, line_number: int) -> None:
+    def compile_condition(self) -> Tuple[str, CodeType]:
         """
         May raise: ParseException
         """
 
-        super().__init__(parser, line_number)
+        return self.argument, self.compile_expression(self.argument)
 
-        if not self._parse_statement_noarg(text, "else"):
-            raise ParseException.on_line(self, "Not an 'else' statement")
 
+class IfStatement(ConditionalStatement):
+    pass
 
-class EndifStatement(Line):
-    def __init__(self, parser: Parser, text: str, line_number: int) -> None:
-        """
-        May raise: ParseException
-        """
 
-        super().__init__(parser, line_number)
+class ElifStatement(ConditionalStatement):
+    pass
 
-        if not self._parse_statement_noarg(text, "endif"):
-            raise ParseException.on_line(self, "Not an 'endif' statement")
+
+class ElseStatement(Line):
+    pass
+
+
+class EndifStatement(Line):
+    pass
 
 
 # Block parsing
@@ -267,7 +417,7 @@ class Block:
                 # itself.
                 break
 
-    def evaluate(self, local_vars: Dict[str, Any]) -> List[str]:
+    def evaluate(self, local_vars: MutableMapping[str, Any]) -> List[str]:
         lines: List[str] = []
 
         for element in self._elements:
@@ -278,6 +428,14 @@ class Block:
 
         return lines
 
+    def generate(self) -> str:
+        """
+        Returns the contents of a python list display whose elements
+        evaluate to the lines of this block.
+        """
+
+        return ", ".join(element.generate() for element in self._elements)
+
 
 class IfBlock(Block):
     def __init__(self, parser: Parser, lines_queue: List[Line]) -> None:
@@ -285,7 +443,10 @@ class IfBlock(Block):
         May raise: ParseException
         """
 
-        self._sections: List[Tuple[Block, Optional[str]]] = []
+        # Each section consists of a block and the condition under which
+        # it is evaluated, both as source text and compiled. The
+        # condition of an 'else' section is None.
+        self._sections: List[Tuple[Block, Optional[Tuple[str, CodeType]]]] = []
 
         if not lines_queue:
             raise ParseException("Unexpected end of file, expected 'if' "
@@ -303,7 +464,8 @@ class IfBlock(Block):
         if not isinstance(next_statement, IfStatement):  # Should never happen
             raise ParseException.on_line(next_statement, "Expected 'if' statement")
         lines_queue.pop()
-        self._sections.append((Block(parser, lines_queue), next_statement.argument))
+        condition = next_statement.compile_condition()
+        self._sections.append((Block(parser, lines_queue), condition))
 
         # Elif statements
         #
@@ -317,7 +479,8 @@ class IfBlock(Block):
             next_statement = lines_queue[-1]
             if not isinstance(next_statement, ElifStatement): break
             lines_queue.pop()
-            self._sections.append((Block(parser, lines_queue), next_statement.argument))
+            condition = next_statement.compile_condition()
+            self._sections.append((Block(parser, lines_queue), condition))
 
         # Optional else statement
         if lines_queue and isinstance(lines_queue[-1], ElseStatement):
@@ -330,9 +493,23 @@ class IfBlock(Block):
             raise ParseException.on_line(lines_queue[-1], "Expected 'end' statement")
         lines_queue.pop()
 
-    def evaluate(self, local_vars: Dict[str, Any]) -> List[str]:
+    def evaluate(self, local_vars: MutableMapping[str, Any]) -> List[str]:
         for entry in self._sections:
-            if entry[1] is None or safer_eval(entry[1], local_vars):
+            if entry[1] is None or safer_eval(entry[1][1], local_vars):
                 return entry[0].evaluate(local_vars)
 
         return []
+
+    def generate(self) -> str:
+        # The sections are turned into a chain of conditional
+        # expressions, which is then unpacked into the surrounding list.
+        result = "[]"
+        for block, condition in reversed(self._sections):
+            lines = f"[{block.generate()}]"
+            if condition is None:
+                result = lines
+            else:
+                condition_source = _parenthesize(condition[0])
+                result = f"{lines} if {condition_source} else {result}"
+
+        return f"*({result})"
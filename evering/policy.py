@@ -0,0 +1,103 @@
+"""
+This module decides what happens to targets that can't be overwritten
+without possibly losing data, because evering doesn't know their current
+contents.
+
+Instead of asking right away, conflicts can be resolved by a fixed rule
+or deferred until all other files were deployed, so the run never waits
+for input in the middle. The same goes for config files that can't be
+processed at all (see ErrorResolution).
+"""
+
+import os
+from dataclasses import dataclass, field
+from enum import Enum
+from pathlib import Path
+from typing import Dict, Mapping, Optional
+
+__all__ = [
+    "BACKUP_SUFFIX",
+    "Conflict", "Resolution", "ErrorResolution", "Policy",
+    "backup_file",
+]
+
+BACKUP_SUFFIX = ".evering-backup"
+
+
+class Conflict(Enum):
+    # The values are the names of the config variables (and, with dashes,
+    # of the command line options) that decide how to resolve a conflict
+    MODIFIED = "on_modified"
+    UNKNOWN = "on_unknown"
+    UNHASHABLE = "on_unhashable"
+
+    @property
+    def description(self) -> str:
+        return _DESCRIPTIONS[self]
+
+
+_DESCRIPTIONS = {
+    Conflict.MODIFIED: "a file that was modified since it was last "
+                       "overwritten",
+    Conflict.UNKNOWN: "an unknown file",
+    Conflict.UNHASHABLE: "a file that could not be hashed",
+}
+
+
+class Resolution(Enum):
+    # Ask the user right away
+    ASK = "ask"
+    # Ask the user once all other files were deployed
+    DEFER = "defer"
+    SKIP = "skip"
+    OVERWRITE = "overwrite"
+    # Rename the target (see backup_file) before overwriting it
+    BACKUP = "backup"
+
+
+class ErrorResolution(Enum):
+    """
+    What to do if a config file can't be processed, for example because
+    its header raises an exception.
+    """
+
+    # Ask the user whether to continue right away
+    ASK = "ask"
+    # Log the error and continue with the next file
+    SKIP = "skip"
+    ABORT = "abort"
+
+
+@dataclass
+class Policy:
+    # Conflicts that are missing here are resolved by asking
+    resolutions: Dict[Conflict, Resolution] = field(default_factory=dict)
+    on_error: ErrorResolution = ErrorResolution.ASK
+
+    def resolution(self, conflict: Conflict) -> Resolution:
+        return self.resolutions.get(conflict, Resolution.ASK)
+
+    def overridden(self,
+                   overrides: Mapping[Conflict, Resolution],
+                   on_error: Optional[ErrorResolution] = None
+                   ) -> "Policy":
+        return Policy({**self.resolutions, **overrides},
+                      on_error or self.on_error)
+
+
+def backup_file(path: Path) -> Path:
+    """
+    Renames a file by appending BACKUP_SUFFIX (and a number, so earlier
+    backups are never replaced) and returns the new path.
+
+    May raise: OSError
+    """
+
+    backup = path.with_name(path.name + BACKUP_SUFFIX)
+    number = 1
+    while os.path.lexists(backup):
+        backup = path.with_name(f"{path.name}{BACKUP_SUFFIX}.{number}")
+        number += 1
+
+    os.rename(path, backup)
+    return backup
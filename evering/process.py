@@ -1,78 +1,350 @@
-import hashlib
 import logging
+import os
 import shutil
+import stat
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
+from dataclasses import dataclass, field
 from pathlib import Path
-from typing import List, Optional
+from typing import (Collection, Deque, Dict, FrozenSet, Iterable, List,
+                    Optional, Tuple, Union)
 
 from .colors import style_error, style_path, style_warning
 from .config import Config
+from .copying import copy_file
+from .explore import FileInfo
+from .hashing import Hasher, hasher_for, split_hash
 from .known_files import KnownFiles
-from .parser import ParseException, Parser, split_header_and_rest
-from .prompt import prompt_yes_no
-from .util import (ExecuteException, LessCatastrophicError, ReadFileException,
-                   WriteFileException, read_file, safer_exec, write_file)
-
-__all__ = ["Processor"]
+from .links import (BinaryMode, check_link, create_link, is_link_entry,
+                    link_entry)
+from .logbuffer import LogBuffer
+from .parser import (DYNAMIC_LOOKUP_BUILTINS, ParseException, Parser,
+                     code_dependencies, split_header_and_rest)
+from .policy import (Conflict, ErrorResolution, Policy, Resolution,
+                     backup_file)
+from .profiling import FILES_STATED, count, phase, time_source, time_target
+from .prompt import prompt_choice, prompt_yes_no
+from .snapshots import Snapshots
+from .template_cache import PATH_IO_ATTRIBUTES, TemplateCache
+from .util import (CatastrophicError, ExecuteException, LessCatastrophicError,
+                   ReadFileException, WriteFileException, encode_text,
+                   read_file, safer_compile, write_file)
+
+__all__ = ["RenderedTarget", "PreparedFile", "DeferredConflict",
+           "Processor"]
 logger = logging.getLogger(__name__)
 
+ParserKey = Tuple[List[str], str, Tuple[str, str]]
+
+# The config variables that decide how a config file is processed, in
+# addition to the ones its header and template read
+PROCESSING_VARIABLES = frozenset({
+    "base_dir", "binary", "binary_mode", "targets", "action", "action_dir",
+    "statement_prefix", "expression_delimiters", "user", "host",
+})
+
+# The answers to the prompts in Processor.resolve_deferred
+_CHOICES = {
+    "o": Resolution.OVERWRITE,
+    "b": Resolution.BACKUP,
+    "s": Resolution.SKIP,
+}
+
+
+def _known_dependencies(names: FrozenSet[str]) -> Optional[FrozenSet[str]]:
+    """
+    Returns None (all variables might be read) if the names include a
+    builtin that can read variables without naming them.
+    """
+
+    if not names.isdisjoint(DYNAMIC_LOOKUP_BUILTINS):
+        return None
+    return names
+
+
+@dataclass
+class RenderedTarget:
+    path: Path
+    # The new contents of the target. None for binary files, which are
+    # copied instead.
+    data: Optional[bytes] = None
+    # The hash of the new contents, if known. For links, the known files
+    # entry of the link instead (see evering.links).
+    new_hash: Optional[str] = None
+    # If set, the target is a link to the config file instead of a copy
+    link: Optional[BinaryMode] = None
+    # Whether the contents came from the template cache
+    cached: bool = False
+    # If set, the target can't be deployed for this reason
+    error: Optional[str] = None
+
+
+@dataclass
+class PreparedFile:
+    """
+    A config file that was read, parsed and rendered for all its targets,
+    but not yet deployed.
+    """
+
+    path: Path
+    header_path: Optional[Path]
+    binary: bool = False
+    targets: List[RenderedTarget] = field(default_factory=list)
+    # If set, none of the targets can be deployed
+    error: Optional[LessCatastrophicError] = None
+    # The messages logged while preparing the file
+    logs: LogBuffer = field(default_factory=LogBuffer)
+    # The names of all config variables the result might depend on, or
+    # None if they are unknown
+    dependencies: Optional[FrozenSet[str]] = None
+
+
+@dataclass
+class DeferredConflict:
+    """
+    A target whose conflict is resolved once all other files were
+    deployed (see Resolution.DEFER).
+    """
+
+    conflict: Conflict
+    source: Path
+    rendered: RenderedTarget
+    # The hash of the target when the conflict was found. If it changes
+    # until the conflict is resolved, the target is skipped.
+    target_hash: Optional[str]
+
 
 class Processor:
-    def __init__(self, config: Config, known_files: KnownFiles) -> None:
+    """
+    Processing a config file happens in two steps: First, the file is
+    prepared, which doesn't touch any targets or the known files and may
+    happen in parallel for different files. Then, the prepared file is
+    deployed to its targets, which may ask the user questions and must
+    happen in the order the files were found.
+
+    Deferred conflicts are collected until resolve_deferred is called,
+    which process_files does at the end.
+    """
+
+    def __init__(self,
+                 config: Config,
+                 known_files: KnownFiles,
+                 cache: Optional[TemplateCache] = None,
+                 snapshots: Optional[Snapshots] = None,
+                 keep_parsers: bool = False,
+                 policy: Optional[Policy] = None,
+                 paranoid: bool = False,
+                 hasher: Optional[Hasher] = None
+                 ) -> None:
+        """
+        If keep_parsers is set, the parsed templates are kept in memory,
+        so a config file whose template didn't change doesn't need to be
+        parsed again the next time it is processed.
+
+        Unless paranoid is set, a target whose size, mtime, inode and
+        ctime didn't change since it was last hashed isn't hashed again.
+
+        New hashes are made with the hasher (SHA-256 by default), but
+        known hashes are always checked with the algorithm they were made
+        with.
+        """
+
         self.config = config
         self.known_files = known_files
+        self.cache = cache
+        self.snapshots = snapshots
+        self.policy = policy or Policy()
+        self.paranoid = paranoid
+        self.hasher = hasher or Hasher()
+
+        # The dependencies of each config file when it was last deployed
+        # (see PreparedFile)
+        self.dependencies: Dict[Path, Optional[FrozenSet[str]]] = {}
+
+        # The lines, statement prefix and expression delimiters each
+        # config file was last parsed with, and the result
+        self._parsers: Optional[Dict[Path, Tuple[ParserKey, Parser]]] = None
+        if keep_parsers:
+            self._parsers = {}
+
+        self._deferred: List[DeferredConflict] = []
+
+    def process_files(self,
+                      file_infos: Iterable[FileInfo],
+                      dry_run: bool = True,
+                      jobs: int = 1,
+                      incremental: bool = False
+                      ) -> None:
+        """
+        Processes config files in the order they are given. If one of
+        them fails, the policy's on_error decides whether to continue.
+
+        Up to jobs files are prepared in parallel, but they are deployed
+        one after another in order, so prompts and messages don't get
+        mixed up and the outcome doesn't depend on timing.
+
+        If incremental is set, files that didn't change since the last
+        run are skipped (see Snapshots).
+
+        Deferred conflicts are resolved after all files were deployed.
+
+        May raise: CatastrophicError
+        """
+
+        # A file is either skipped, in which case its unchanged targets
+        # are remembered, or being prepared.
+        pending: Deque[Tuple[Path,
+                             Union[List[Path], "Future[PreparedFile]"]]]
+        pending = deque()
+
+        # Without workers, each file is deployed right after it was
+        # prepared
+        executor = None
+        max_pending = 0
+        if jobs > 1:
+            executor = ThreadPoolExecutor(max_workers=jobs)
+            max_pending = 2 * jobs
+
+        def submit(file_info: FileInfo) -> "Future[PreparedFile]":
+            if executor is not None:
+                return executor.submit(self.prepare_file, file_info.path,
+                                       file_info.header)
+
+            future: "Future[PreparedFile]" = Future()
+            future.set_result(self.prepare_file(file_info.path,
+                                                file_info.header))
+            return future
+
+        def deploy_next() -> None:
+            path, item = pending.popleft()
+
+            if isinstance(item, list):
+                if logger.isEnabledFor(logging.DEBUG):
+                    logger.debug(
+                        f"Skipping unchanged file {style_path(path)}")
+                for target in item:
+                    self.known_files.keep_file(target)
+                return
+
+            try:
+                self.deploy_file(item.result(), dry_run)
+            except LessCatastrophicError as e:
+                logger.error(e)
+
+                on_error = self.policy.on_error
+                if on_error == ErrorResolution.ASK:
+                    choice = prompt_choice("[C]ontinue to the next file or "
+                                           "[A]bort the program?", "Ca")
+                    if choice == "a":
+                        on_error = ErrorResolution.ABORT
+
+                if on_error == ErrorResolution.ABORT:
+                    raise CatastrophicError("Aborted")
+
+        try:
+            for file_info in file_infos:
+                targets = None
+                if incremental and self.snapshots is not None:
+                    with phase("incremental check"):
+                        targets = self.snapshots.unchanged_targets(
+                            file_info.path, file_info.header,
+                            self.known_files)
+
+                if targets is not None:
+                    pending.append((file_info.path, targets))
+                else:
+                    pending.append((file_info.path, submit(file_info)))
+
+                # Don't prepare too far ahead of the files being deployed
+                while len(pending) > max_pending:
+                    deploy_next()
+
+            while pending:
+                deploy_next()
+
+            self.resolve_deferred(dry_run)
+        finally:
+            if executor is not None:
+                executor.shutdown(wait=False, cancel_futures=True)
 
     def process_file(self,
                      path: Path,
                      header_path: Optional[Path] = None,
                      dry_run: bool = True
                      ) -> None:
-        logger.info(f"{style_path(path)}:")
+        """
+        May raise: LessCatastrophicError
+        """
 
-        config = self.config.copy()
-        config.filename = path.name
+        self.deploy_file(self.prepare_file(path, header_path), dry_run)
 
-        if header_path is None:
-            self._process_file_without_header(path, config, dry_run)
-        else:
-            self._process_file_with_header(path, header_path, config, dry_run)
+    # Preparing
+
+    def prepare_file(self,
+                     path: Path,
+                     header_path: Optional[Path] = None
+                     ) -> PreparedFile:
+        prepared = PreparedFile(path, header_path)
 
-    def _process_file_without_header(self,
-                                     path: Path,
-                                     config: Config,
-                                     dry_run: bool
+        with prepared.logs, time_source(path):
+            config = self.config.copy()
+            config.filename = path.name
+
+            try:
+                if header_path is None:
+                    self._prepare_file_without_header(prepared, config)
+                else:
+                    self._prepare_file_with_header(prepared, config)
+            except LessCatastrophicError as e:
+                prepared.error = e
+
+        return prepared
+
+    def _prepare_file_without_header(self,
+                                     prepared: PreparedFile,
+                                     config: Config
                                      ) -> None:
-        logger.debug(f"Processing file {style_path(path)} without header")
+        path = prepared.path
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug(
+                f"Processing file {style_path(path)} without header")
 
         try:
-            text = read_file(path)
+            with phase("read"):
+                text = read_file(path)
         except ReadFileException as e:
             raise LessCatastrophicError(
                 style_error("Could not read file ") +
                 style_path(path) + f": {e}")
 
         header, lines = split_header_and_rest(text)
+        header_text = "\n".join(header)
 
         try:
-            safer_exec("\n".join(header), config.local_vars)
+            self._exec_header(prepared, header_text, config)
         except ExecuteException as e:
             raise LessCatastrophicError(
                 style_error("Could not parse header of file ") +
                 style_path(path) + f": {e}")
 
-        self._process_parseable(lines, config, path, dry_run)
+        self._prepare_parseable(prepared, lines, header_text, config)
 
-    def _process_file_with_header(self,
-                                  path: Path,
-                                  header_path: Path,
-                                  config: Config,
-                                  dry_run: bool
+    def _prepare_file_with_header(self,
+                                  prepared: PreparedFile,
+                                  config: Config
                                   ) -> None:
-        logger.debug(f"Processing file {style_path(path)} "
-                     f"with header {style_path(header_path)}")
+        path = prepared.path
+        header_path = prepared.header_path
+        assert header_path is not None
+
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug(f"Processing file {style_path(path)} "
+                         f"with header {style_path(header_path)}")
 
         try:
-            header_text = read_file(header_path)
-            safer_exec(header_text, config.local_vars)
+            with phase("read"):
+                header_text = read_file(header_path)
+            self._exec_header(prepared, header_text, config)
         except ReadFileException as e:
             raise LessCatastrophicError(
                 style_error("Could not load header file ") +
@@ -83,187 +355,636 @@ class Processor:
                 style_path(header_path) + f": {e}")
 
         if config.binary:
-            self._process_binary(path, config, dry_run)
+            self._prepare_binary(prepared, config)
         else:
             try:
-                lines = read_file(path).splitlines()
+                with phase("read"):
+                    lines = read_file(path).splitlines()
             except ReadFileException as e:
                 raise LessCatastrophicError(
                     style_error("Could not load file ") +
                     style_path(path) + f": {e}")
 
-            self._process_parseable(lines, config, path, dry_run)
+            self._prepare_parseable(prepared, lines, header_text, config)
 
-    def _process_binary(self,
-                        path: Path,
-                        config: Config,
-                        dry_run: bool
-                        ) -> None:
-        logger.debug("Processing as a binary file")
+    def _exec_header(self,
+                     prepared: PreparedFile,
+                     header_text: str,
+                     config: Config
+                     ) -> None:
+        """
+        May raise: ExecuteException
+        """
 
-        if not config.targets:
-            logger.info("  (no targets)")
-            return
+        with phase("header exec"):
+            code = safer_compile(header_text, "exec")
+            prepared.dependencies = _known_dependencies(
+                PROCESSING_VARIABLES | code_dependencies(code))
+            config.execute(code)
 
-        for target in config.targets:
-            logger.info(f"  -> {style_path(target)}")
+    def _prepare_binary(self, prepared: PreparedFile, config: Config) -> None:
+        logger.debug("Processing as a binary file")
 
-            if not self._justify_target(target):
-                logger.info("Skipping this target")
-                continue
+        prepared.binary = True
 
-            if dry_run:
-                continue
+        targets = config.targets
+        if not targets:
+            return
 
+        mode = config.binary_mode
+        if mode != BinaryMode.COPY:
             try:
-                target.parent.mkdir(parents=True, exist_ok=True)
-            except IOError as e:
-                logger.warning(
-                    style_warning("Could not create target directory") +
-                    f": {e}"
-                )
-                continue
+                entry = link_entry(mode, prepared.path)
+            except OSError as e:
+                raise LessCatastrophicError(
+                    style_error("Could not stat file ") +
+                    style_path(prepared.path) + f": {e}")
+            for target in targets:
+                prepared.targets.append(RenderedTarget(target, new_hash=entry,
+                                                       link=mode))
+            return
 
-            try:
-                shutil.copy(path, target)
-            except (IOError, shutil.SameFileError) as e:
-                logger.warning(style_warning("Could not copy") + f": {e}")
-                continue
+        source_hash = self._obtain_hash(prepared.path)
+        for target in targets:
+            prepared.targets.append(RenderedTarget(target,
+                                                   new_hash=source_hash))
+
+    def _parse(self,
+               lines: List[str],
+               config: Config,
+               source: Path
+               ) -> Parser:
+        key = (lines, config.statement_prefix, config.expression_delimiters)
+        if self._parsers is not None:
+            entry = self._parsers.get(source)
+            if entry is not None and entry[0] == key:
+                logger.debug("Using the already parsed template")
+                return entry[1]
 
-            try:
-                shutil.copymode(path, target)
-            except shutil.Error as e:
-                logger.warning(style_warning("Could not copy permissions") +
-                               f": {e}")
+        try:
+            with phase("parse"):
+                parser = Parser(
+                    lines,
+                    statement_prefix=key[1],
+                    expression_prefix=key[2][0],
+                    expression_suffix=key[2][1],
+                )
+        except ParseException as e:
+            raise LessCatastrophicError(
+                style_error("Could not parse file ") +
+                style_path(source) + f": {e}")
 
-            self._update_known_hash(target)
+        if self._parsers is not None:
+            self._parsers[source] = (key, parser)
 
-    def _process_parseable(self,
+        return parser
+
+    def _prepare_parseable(self,
+                           prepared: PreparedFile,
                            lines: List[str],
-                           config: Config,
-                           source: Path,
-                           dry_run: bool
+                           header: str,
+                           config: Config
                            ) -> None:
-        if not config.targets:
-            logger.info("  (no targets)")
+        source = prepared.path
+
+        targets = config.targets
+        if not targets:
             return
 
-        for target in config.targets:
-            logger.info(f"  -> {style_path(target)}")
+        # The template only depends on the file and its header, not on
+        # the target, so it is parsed once and evaluated per target. If
+        # every target can be served from the cache, it isn't parsed at
+        # all.
+        parser: Optional[Parser] = None
 
-            if not self._justify_target(target):
-                logger.info("Skipping this target")
-                continue
+        # The template's key, dependencies and the path attributes it
+        # might access the file system with, if the cache is used
+        cache_info: Optional[Tuple[str, Collection[str],
+                                   Collection[str]]] = None
 
-            config_copy = config.copy()
-            config_copy.target = target
+        if self.cache is None:
+            parser = self._parse(lines, config, source)
+        else:
+            template_key = self.cache.template_key(
+                lines, config.statement_prefix, config.expression_delimiters)
+            cached = self.cache.get_dependencies(template_key)
+            if cached is None:
+                parser = self._parse(lines, config, source)
+                self.cache.put_dependencies(template_key, parser.dependencies,
+                                            parser.attributes)
+                cache_info = (template_key, parser.dependencies,
+                              PATH_IO_ATTRIBUTES.intersection(
+                                  parser.attributes))
+            else:
+                cache_info = (template_key, *cached)
+
+        if prepared.dependencies is not None:
+            if parser is not None:
+                template_dependencies = parser.dependencies
+            else:
+                assert cache_info is not None
+                template_dependencies = frozenset(cache_info[1])
+            prepared.dependencies = _known_dependencies(
+                prepared.dependencies | template_dependencies)
+
+        for target in targets:
+            with time_target(target):
+                rendered = RenderedTarget(target)
+                prepared.targets.append(rendered)
+
+                config_copy = config.copy()
+                config_copy.target = target
+
+                render_key: Optional[str] = None
+                text: Optional[str] = None
+                if self.cache is not None and cache_info is not None:
+                    render_key = self.cache.render_key(
+                        cache_info[0], header, cache_info[1], cache_info[2],
+                        config_copy.local_vars)
+                    if render_key is not None:
+                        text = self.cache.get_render(render_key)
+
+                if text is not None:
+                    rendered.cached = True
+                else:
+                    if parser is None:
+                        parser = self._parse(lines, config, source)
+
+                    try:
+                        with phase("evaluate"):
+                            text = parser.evaluate(config_copy.local_vars)
+                    except ExecuteException as e:
+                        rendered.error = (style_warning("Could not compile ") +
+                                          style_path(target) + f": {e}")
+                        continue
+
+                    if self.cache is not None and render_key is not None:
+                        self.cache.put_render(render_key, text)
+
+                try:
+                    rendered.data = encode_text(text)
+                except WriteFileException as e:
+                    rendered.error = (style_warning("Could not encode ") +
+                                      style_path(target) + f": {e}")
+                    continue
+
+                with phase("hash"):
+                    rendered.new_hash = self.hasher.hash_bytes(
+                        rendered.data)
+
+    # Deploying
+
+    def deploy_file(self, prepared: PreparedFile, dry_run: bool) -> None:
+        """
+        May raise: LessCatastrophicError
+        """
+
+        with time_source(prepared.path):
+            self._deploy_file(prepared, dry_run)
+
+    def _deploy_file(self, prepared: PreparedFile, dry_run: bool) -> None:
+        logger.info(f"{style_path(prepared.path)}:")
+        prepared.logs.replay()
+
+        self.dependencies[prepared.path] = prepared.dependencies
+
+        if prepared.error is not None:
+            raise prepared.error
+
+        if not prepared.targets:
+            logger.info("  (no targets)")
 
-            try:
-                parser = Parser(
-                    lines,
-                    statement_prefix=config.statement_prefix,
-                    expression_prefix=config.expression_delimiters[0],
-                    expression_suffix=config.expression_delimiters[1],
-                )
-            except ParseException as e:
-                logger.warning(style_warning("Could not parse ") +
-                               style_path(target) + f": {e}")
-                continue
+        deployed: List[Path] = []
+        for rendered in prepared.targets:
+            logger.info(f"  -> {style_path(rendered.path)}")
+
+            with time_target(rendered.path):
+                if self._deploy_target(prepared, rendered, dry_run):
+                    deployed.append(rendered.path)
+
+        # Only config files that were completely deployed may be skipped
+        # in later incremental runs.
+        if (self.snapshots is not None and not dry_run and
+                len(deployed) == len(prepared.targets)):
+            self.snapshots.record(prepared.path, prepared.header_path,
+                                  deployed)
+
+    def _deploy_target(self,
+                       prepared: PreparedFile,
+                       rendered: RenderedTarget,
+                       dry_run: bool
+                       ) -> bool:
+        """
+        Returns whether the target was successfully deployed.
+        """
+
+        source = prepared.path
+        target = rendered.path
+
+        if rendered.cached:
+            logger.debug("Using the cached result")
+
+        if rendered.error is not None:
+            logger.warning(rendered.error)
+            return False
+
+        # The target's hash, if it was already computed
+        target_hash: Optional[str] = None
+        if rendered.new_hash is not None:
+            up_to_date, target_hash, target_stat = self._is_up_to_date(
+                source, rendered)
+            if up_to_date:
+                self._keep_target(source, target, rendered.new_hash,
+                                  target_stat, dry_run)
+                return True
+
+        if self._is_blocked(target):
+            logger.info("Skipping this target")
+            return False
+
+        conflict, target_hash = self._find_conflict(target, target_hash)
+        if conflict is None:
+            resolution = Resolution.OVERWRITE
+        else:
+            resolution = self._resolve_conflict(conflict, target)
+
+        if resolution == Resolution.DEFER:
+            assert conflict is not None
+            logger.info("Deciding about this target at the end")
+            self._deferred.append(
+                DeferredConflict(conflict, source, rendered, target_hash))
+            return False
+
+        return self._overwrite_target(source, rendered, resolution, dry_run)
+
+    def _overwrite_target(self,
+                          source: Path,
+                          rendered: RenderedTarget,
+                          resolution: Resolution,
+                          dry_run: bool
+                          ) -> bool:
+        """
+        Returns whether the target was successfully overwritten.
+        """
+
+        target = rendered.path
+
+        if resolution == Resolution.SKIP:
+            logger.info("Skipping this target")
+            return False
+
+        if dry_run:
+            return False
 
+        if resolution == Resolution.BACKUP:
             try:
-                text = parser.evaluate(config_copy.local_vars)
-            except ExecuteException as e:
-                logger.warning(style_warning("Could not compile ") +
-                               style_path(target) + f": {e}")
-                continue
+                backup = backup_file(target)
+            except OSError as e:
+                logger.warning(style_warning("Could not back up target") +
+                               f": {e}")
+                return False
+            logger.info(f"Backed up the target to {style_path(backup)}")
+
+        with phase("write"):
+            target_hash = self._write_target(source, rendered)
+        if target_hash is None:
+            return False
+
+        self._update_known_hash(target, target_hash)
+        return True
+
+    def resolve_deferred(self, dry_run: bool) -> None:
+        """
+        Resolves all deferred conflicts with a single decision, unless the
+        user chooses to decide for each target separately.
+        """
+
+        deferred, self._deferred = self._deferred, []
+        if not deferred:
+            return
+
+        logger.info(f"{len(deferred)} target(s) need a decision:")
+        for item in deferred:
+            logger.info(f"  {style_path(item.rendered.path)} is "
+                        f"{item.conflict.description}")
+
+        if dry_run:
+            return
+
+        choice = prompt_choice("[O]verwrite all, [B]ack up and overwrite "
+                               "all, [S]kip all or [D]ecide for each?",
+                               "obSd").lower()
+
+        for item in deferred:
+            target = item.rendered.path
+            logger.info(f"{style_path(item.source)}:")
+            logger.info(f"  -> {style_path(target)}")
 
-            if dry_run:
-                continue
+            if choice == "d":
+                choice_for_target = prompt_choice(
+                    "[O]verwrite, [B]ack up and overwrite or [S]kip?",
+                    "obS").lower()
+                resolution = _CHOICES[choice_for_target]
+            else:
+                resolution = _CHOICES[choice]
+
+            with time_target(target):
+                # Another file might have been deployed to the same
+                # target in the meantime
+                if resolution != Resolution.SKIP and (
+                        self._is_blocked(target) or
+                        self._find_conflict(target) !=
+                        (item.conflict, item.target_hash)):
+                    logger.warning(style_warning(
+                        "The target changed in the meantime, skipping it"))
+                    continue
+
+                self._overwrite_target(item.source, item.rendered,
+                                       resolution, dry_run=False)
+
+    def _write_target(self,
+                      source: Path,
+                      rendered: RenderedTarget
+                      ) -> Optional[str]:
+        """
+        Writes, copies or links the new contents to the target and returns
+        their hash (or known files entry), or None if that failed.
+        """
+
+        target = rendered.path
 
+        try:
+            target.parent.mkdir(parents=True, exist_ok=True)
+        except IOError as e:
+            logger.warning(
+                style_warning("Could not create target directory") +
+                f": {e}"
+            )
+            return None
+
+        if rendered.link is not None:
             try:
-                target.parent.mkdir(parents=True, exist_ok=True)
-            except IOError as e:
-                logger.warning(
-                    style_warning("Could not create target directory") +
-                    f": {e}"
-                )
-                continue
+                return create_link(rendered.link, source, target)
+            except OSError as e:
+                logger.warning(style_warning("Could not link") + f": {e}")
+                return None
+
+        # Writing to a link that evering created would overwrite the config
+        # file it links to
+        if is_link_entry(self.known_files.get_hash(target)):
+            try:
+                target.unlink(missing_ok=True)
+            except OSError as e:
+                logger.warning(style_warning("Could not remove link") +
+                               f": {e}")
+                return None
 
+        if rendered.data is None:
+            try:
+                # The source was already hashed while preparing, so it
+                # doesn't need to be read again if the file system can copy
+                # it by itself
+                result = copy_file(source, target, rendered.new_hash,
+                                   hasher=self.hasher)
+            except WriteFileException as e:
+                logger.warning(style_warning("Could not copy") + f": {e}")
+                return None
+            if logger.isEnabledFor(logging.DEBUG):
+                logger.debug(f"Copied {result.size} bytes using "
+                             f"{result.method.value}")
+            target_hash = result.hash
+        else:
             try:
-                write_file(target, text)
+                write_file(target, rendered.data)
             except WriteFileException as e:
                 logger.warning(style_warning("Could not write to target") +
                                f": {e}")
-                continue
+                return None
+            assert rendered.new_hash is not None
+            target_hash = rendered.new_hash
 
-            try:
-                shutil.copymode(source, target)
-            except shutil.Error as e:
-                logger.warning(style_warning("Could not copy permissions") +
-                               f": {e}")
+        try:
+            shutil.copymode(source, target)
+        except shutil.Error as e:
+            logger.warning(style_warning("Could not copy permissions") +
+                           f": {e}")
 
-            self._update_known_hash(target)
+        return target_hash
 
-    def _obtain_hash(self, path: Path) -> Optional[str]:
-        BLOCK_SIZE = 2**16
+    def _obtain_hash(self,
+                     path: Path,
+                     hasher: Optional[Hasher] = None
+                     ) -> Optional[str]:
+        try:
+            with phase("hash"):
+                return (hasher or self.hasher).hash_file(path)
+        except ReadFileException:
+            return None
+
+    def _is_up_to_date(self,
+                       source: Path,
+                       rendered: RenderedTarget
+                       ) -> Tuple[bool, Optional[str],
+                                  Optional[os.stat_result]]:
+        """
+        Whether the target already has exactly the new contents and
+        hasn't been modified since it was last written. Also returns the
+        target's hash and stat (see _hash_target), if they were taken, so
+        a modified target doesn't need to be hashed again.
+        """
+
+        target = rendered.path
+        new_hash = rendered.new_hash
+        assert new_hash is not None
+
+        if self.known_files.was_recently_modified(target):
+            return False, None, None  # Leave the warning to _is_blocked
+
+        known_hash = self.known_files.get_hash(target)
+        if known_hash is None:
+            return False, None, None
+
+        if is_link_entry(new_hash):
+            if known_hash != new_hash:
+                return False, None, None
+            return self._check_link(target, new_hash), None, None
+
+        if self._comparable_hash(source, rendered, known_hash) != known_hash:
+            return False, None, None
+
+        target_hash, target_stat = self._hash_target(target)
+        return target_hash == known_hash, target_hash, target_stat
+
+    def _comparable_hash(self,
+                         source: Path,
+                         rendered: RenderedTarget,
+                         known_hash: str
+                         ) -> Optional[str]:
+        """
+        Returns the hash of the new contents, made with the same algorithm
+        as the known hash. After the hash algorithm was changed, this
+        hashes the new contents again (once per target, since the target
+        is then known by its new hash), so unchanged targets don't need
+        to be rewritten.
+        """
+
+        new_hash = rendered.new_hash
+        assert new_hash is not None
+
+        algorithm, hex_digest = split_hash(new_hash)
+        known_algorithm, known_hex_digest = split_hash(known_hash)
+        if (algorithm == known_algorithm and
+                len(hex_digest) == len(known_hex_digest)):
+            return new_hash
+
+        hasher = hasher_for(known_hash)
+        if hasher is None:
+            return None
+
+        with phase("hash"):
+            if rendered.data is not None:
+                return hasher.hash_bytes(rendered.data)
+        return self._obtain_hash(source, hasher)
+
+    def _check_link(self, target: Path, entry: str) -> bool:
+        """
+        Whether the target is still the link described by its known files
+        entry. Doesn't read any contents.
+        """
+
+        count(FILES_STATED)
+        return check_link(target, entry)
+
+    def _hash_target(self,
+                     target: Path
+                     ) -> Tuple[Optional[str], Optional[os.stat_result]]:
+        """
+        Returns the hash of the target's contents and its stat from
+        before it was hashed. Unless paranoid, the known hash is trusted
+        without reading the target if the stat didn't change since it was
+        recorded along with the hash. The target is hashed with the same
+        algorithm as its known hash, so the two can be compared.
+        """
 
         try:
-            h = hashlib.sha256()
+            count(FILES_STATED)
+            target_stat = os.stat(target)
+        except OSError:
+            return None, None
+
+        if (not self.paranoid and
+                self.known_files.matches_stat(target, target_stat)):
+            return self.known_files.get_hash(target), target_stat
+
+        known_hash = self.known_files.get_hash(target)
+        hasher = None if known_hash is None else hasher_for(known_hash)
+        return self._obtain_hash(target, hasher), target_stat
+
+    def _keep_target(self,
+                     source: Path,
+                     target: Path,
+                     target_hash: str,
+                     target_stat: Optional[os.stat_result],
+                     dry_run: bool
+                     ) -> None:
+        """
+        Deploys a target that is already up to date without writing to
+        it, so its mtime doesn't change. If given, the target's stat is
+        remembered so it doesn't need to be hashed next time.
+        """
 
-            with open(path, "rb") as f:
-                while True:
-                    block = f.read(BLOCK_SIZE)
-                    if not block:
-                        break
-                    h.update(block)
+        logger.debug("Target is already up to date")
 
-            return h.hexdigest()
+        # Links share their permissions with the config file anyway
+        if (not dry_run and target_stat is not None and
+                not is_link_entry(target_hash)):
+            try:
+                count(FILES_STATED)
+                source_mode = stat.S_IMODE(os.stat(source).st_mode)
+                if stat.S_IMODE(target_stat.st_mode) != source_mode:
+                    shutil.copymode(source, target)
+                    target_stat = None  # The ctime changed
+            except (OSError, shutil.Error) as e:
+                logger.warning(style_warning("Could not copy permissions") +
+                               f": {e}")
 
-        except IOError:
-            return None
+        self.known_files.update_file(target, target_hash, target_stat)
+
+    def _is_blocked(self, target: Path) -> bool:
+        """
+        Whether the target must not be overwritten, no matter the policy.
+        """
 
-    def _justify_target(self, target: Path) -> bool:
         if not target.exists():
-            return True
+            return False
 
         if not target.is_file():
             logger.warning(style_warning("The target is a directory"))
-            return False
+            return True
 
         if self.known_files.was_recently_modified(target):
             logger.warning(style_warning("This target was already overwritten "
                                          "earlier"))
-            return False
+            return True
 
-        target_hash = self._obtain_hash(target)
-        if target_hash is None:
-            return prompt_yes_no("Overwriting a file that could not be "
-                                 "hashed, continue?", False)
+        return False
+
+    def _resolve_conflict(self,
+                          conflict: Conflict,
+                          target: Path
+                          ) -> Resolution:
+        resolution = self.policy.resolution(conflict)
+        if resolution != Resolution.ASK:
+            logger.info(f"The target is {conflict.description}, resolving "
+                        f"with {resolution.value!r}")
+            return resolution
+
+        if prompt_yes_no(f"Overwriting {conflict.description}, continue?",
+                         False):
+            return Resolution.OVERWRITE
+        return Resolution.SKIP
+
+    def _find_conflict(self,
+                       target: Path,
+                       target_hash: Optional[str] = None
+                       ) -> Tuple[Optional[Conflict], Optional[str]]:
+        """
+        Returns the conflict overwriting the target would cause (if any)
+        and the target's current hash (if known). If the target's hash
+        was already computed (see _hash_target), it isn't hashed again.
+        """
+
+        # Links may point to files that no longer exist
+        if not os.path.lexists(target):
+            return None, None
 
         known_target_hash = self.known_files.get_hash(target)
-        if known_target_hash is None:
-            return prompt_yes_no("Overwriting an unknown file, continue?",
-                                 False)
+        if (known_target_hash is not None and
+                is_link_entry(known_target_hash) and
+                self._check_link(target, known_target_hash)):
+            return None, known_target_hash
 
-        # The following condition is phrased awkwardly because I just
-        # feel better if the final statement in this function is not a
-        # 'return True'. After all, returning True here might cause
-        # loss of important configuration data.
+        if target_hash is None:
+            target_hash, _ = self._hash_target(target)
+        if target_hash is None:
+            return Conflict.UNHASHABLE, None
+
+        if known_target_hash is None:
+            return Conflict.UNKNOWN, target_hash
 
         if target_hash == known_target_hash:
             # We're positive that this file hasn't changed since we've
             # last seen it.
-            return True
+            return None, target_hash
 
-        return prompt_yes_no("Overwriting a file that was modified since it "
-                             "was last overwritten, continue?", False)
+        return Conflict.MODIFIED, target_hash
 
-    def _update_known_hash(self, target: Path) -> None:
-        target_hash = self._obtain_hash(target)
-        if target_hash is None:
-            raise LessCatastrophicError(
-                style_error("Could not obtain hash of target file ") +
-                style_path(target))
+    def _update_known_hash(self, target: Path, target_hash: str) -> None:
+        """
+        Remembers the hash of what was just written to the target. The
+        hash is computed while writing, so the target doesn't need to be
+        read again.
+        """
 
         self.known_files.update_file(target, target_hash)
         self.known_files.save_incremental()
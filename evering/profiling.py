@@ -0,0 +1,248 @@
+"""
+This module measures where a run spends its time (see --profile).
+
+The time is split into phases like parsing or writing, and some
+operations that are expensive on slow file systems are counted. As long
+as profiling wasn't started, all functions in this module do nothing and
+cost next to nothing.
+"""
+
+import contextlib
+import threading
+import time
+from dataclasses import dataclass
+from pathlib import Path
+from types import TracebackType
+from typing import Any, ContextManager, Dict, List, Optional, Tuple, Type
+
+__all__ = [
+    "FILES_STATED", "DIRS_LISTED", "BYTES_READ", "BYTES_WRITTEN",
+    "JSON_SAVES", "JOURNAL_APPENDS",
+    "PhaseStats", "Profile",
+    "start_profiling", "stop_profiling", "profiling",
+    "phase", "count", "time_source", "time_target",
+]
+
+# Bump this whenever the JSON format changes in an incompatible way
+PROFILE_VERSION = 1
+
+# Counters
+FILES_STATED = "files stat'ed"
+DIRS_LISTED = "directories listed"
+BYTES_READ = "bytes read"
+BYTES_WRITTEN = "bytes written"
+JSON_SAVES = "JSON saves"
+JOURNAL_APPENDS = "journal appends"
+
+
+@dataclass
+class PhaseStats:
+    wall: float = 0.0
+    cpu: float = 0.0
+    count: int = 0
+
+    def to_json(self) -> Dict[str, Any]:
+        return {
+            "wall_seconds": self.wall,
+            "cpu_seconds": self.cpu,
+            "count": self.count,
+        }
+
+
+class Profile:
+    def __init__(self) -> None:
+        self._wall_start = time.perf_counter()
+        self._cpu_start = time.process_time()
+        self._wall_end: Optional[float] = None
+        self._cpu_end: Optional[float] = None
+
+        # Files are processed by several threads at once
+        self._lock = threading.Lock()
+
+        self.phases: Dict[str, PhaseStats] = {}
+        self.counters: Dict[str, int] = {}
+        # The total time spent on each config file and target
+        self.sources: Dict[Path, float] = {}
+        self.targets: Dict[Path, float] = {}
+
+    def stop(self) -> None:
+        self._wall_end = time.perf_counter()
+        self._cpu_end = time.process_time()
+
+    @property
+    def wall(self) -> float:
+        end = self._wall_end
+        if end is None:
+            end = time.perf_counter()
+        return end - self._wall_start
+
+    @property
+    def cpu(self) -> float:
+        end = self._cpu_end
+        if end is None:
+            end = time.process_time()
+        return end - self._cpu_start
+
+    def add_phase(self, name: str, wall: float, cpu: float) -> None:
+        with self._lock:
+            stats = self.phases.get(name)
+            if stats is None:
+                stats = PhaseStats()
+                self.phases[name] = stats
+
+            stats.wall += wall
+            stats.cpu += cpu
+            stats.count += 1
+
+    def add_count(self, name: str, amount: int) -> None:
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + amount
+
+    def add_time(self,
+                 times: Dict[Path, float],
+                 path: Path,
+                 seconds: float
+                 ) -> None:
+        with self._lock:
+            times[path] = times.get(path, 0.0) + seconds
+
+    @staticmethod
+    def _slowest(times: Dict[Path, float],
+                 top: int
+                 ) -> List[Tuple[Path, float]]:
+        return sorted(times.items(), key=lambda item: -item[1])[:top]
+
+    def to_json(self, top: int) -> Dict[str, Any]:
+        return {
+            "version": PROFILE_VERSION,
+            "wall_seconds": self.wall,
+            "cpu_seconds": self.cpu,
+            "phases": {name: stats.to_json()
+                       for name, stats in self.phases.items()},
+            "counters": dict(self.counters),
+            "slowest_sources": [
+                {"path": str(path), "seconds": seconds}
+                for path, seconds in self._slowest(self.sources, top)],
+            "slowest_targets": [
+                {"path": str(path), "seconds": seconds}
+                for path, seconds in self._slowest(self.targets, top)],
+        }
+
+    def format_table(self, top: int) -> str:
+        lines = [
+            f"Total: {self.wall * 1000:.1f} ms wall, "
+            f"{self.cpu * 1000:.1f} ms CPU",
+            "",
+            "Phase (summed over all threads)  Wall (ms)   CPU (ms)   Count",
+        ]
+        for name, stats in self.phases.items():
+            lines.append(f"{name:<32} {stats.wall * 1000:>9.1f} "
+                         f"{stats.cpu * 1000:>10.1f} {stats.count:>7}")
+
+        if self.counters:
+            lines.append("")
+            for name, amount in self.counters.items():
+                lines.append(f"{name:<32} {amount:>9}")
+
+        for title, times in [("config files", self.sources),
+                             ("targets", self.targets)]:
+            if times:
+                lines.append("")
+                lines.append(f"Slowest {title}:")
+                for path, seconds in self._slowest(times, top):
+                    lines.append(f"{seconds * 1000:>9.1f} ms  {path}")
+
+        return "\n".join(lines)
+
+
+_profile: Optional[Profile] = None
+
+
+def start_profiling() -> Profile:
+    global _profile
+    _profile = Profile()
+    return _profile
+
+
+def profiling() -> bool:
+    return _profile is not None
+
+
+def stop_profiling() -> Optional[Profile]:
+    global _profile
+    profile, _profile = _profile, None
+    if profile is not None:
+        profile.stop()
+    return profile
+
+
+class _Timer:
+    def __init__(self,
+                 profile: Profile,
+                 phase_name: Optional[str] = None,
+                 times: Optional[Dict[Path, float]] = None,
+                 path: Optional[Path] = None
+                 ) -> None:
+        self._profile = profile
+        self._phase_name = phase_name
+        self._times = times
+        self._path = path
+        self._wall_start = 0.0
+        self._cpu_start = 0.0
+
+    def __enter__(self) -> None:
+        self._wall_start = time.perf_counter()
+        # The CPU time of the current thread only, since other threads
+        # might be busy with other phases in the meantime
+        self._cpu_start = time.thread_time()
+
+    def __exit__(self,
+                 exc_type: Optional[Type[BaseException]],
+                 exc_value: Optional[BaseException],
+                 traceback: Optional[TracebackType],
+                 ) -> None:
+        wall = time.perf_counter() - self._wall_start
+        cpu = time.thread_time() - self._cpu_start
+
+        if self._phase_name is not None:
+            self._profile.add_phase(self._phase_name, wall, cpu)
+        if self._times is not None and self._path is not None:
+            self._profile.add_time(self._times, self._path, wall)
+
+
+_NOT_PROFILING = contextlib.nullcontext()
+
+
+def phase(name: str) -> ContextManager[None]:
+    """
+    Measures the time spent in a phase, like parsing or writing.
+    """
+
+    if _profile is None:
+        return _NOT_PROFILING
+    return _Timer(_profile, phase_name=name)
+
+
+def count(name: str, amount: int = 1) -> None:
+    if _profile is not None:
+        _profile.add_count(name, amount)
+
+
+def time_source(path: Path) -> ContextManager[None]:
+    """
+    Measures the time spent on a config file.
+    """
+
+    if _profile is None:
+        return _NOT_PROFILING
+    return _Timer(_profile, times=_profile.sources, path=path)
+
+
+def time_target(path: Path) -> ContextManager[None]:
+    """
+    Measures the time spent on a target.
+    """
+
+    if _profile is None:
+        return _NOT_PROFILING
+    return _Timer(_profile, times=_profile.targets, path=path)
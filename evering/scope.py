@@ -0,0 +1,109 @@
+"""
+This module contains the layered variable scopes config files and
+templates are executed in.
+
+Copying a config used to deep-copy all of its variables, once per config
+file and once more per target. A scope instead starts out empty and
+looks up everything it doesn't contain in its parent. A value is only
+copied into the scope the first time it is read from the parent, so the
+cost of a copy depends on the variables that are actually used, not on
+the size of the config.
+"""
+
+import copy
+import types
+from pathlib import PurePath
+from typing import (Any, Dict, Iterator, Mapping, MutableMapping, Optional,
+                    Set)
+
+__all__ = ["Scope"]
+
+# Values of these types are shared instead of copied. Most of them can't
+# be modified, deepcopy() wouldn't copy functions and types either, and
+# modules don't tend to deepcopy well.
+IMMUTABLE_TYPES = (type(None), bool, int, float, complex, str, bytes,
+                   PurePath, types.ModuleType, types.FunctionType,
+                   types.BuiltinFunctionType, type)
+
+_MISSING = object()
+
+
+class Scope(MutableMapping[str, Any]):
+    """
+    A mutable mapping that is isolated from its parent in the same way a
+    deep copy of the parent would be: Changes to the scope, including
+    changes to mutable values read from it, never affect the parent.
+
+    Modules are shared instead of copied, since they don't tend to
+    deepcopy well.
+
+    The parent must not be modified while the scope is in use.
+    """
+
+    def __init__(self, parent: Optional[Mapping[str, Any]] = None) -> None:
+        self._parent = parent
+        # The variables that were set in or copied into this scope
+        self._layer: Dict[str, Any] = {}
+        # The parent's variables that were deleted in this scope
+        self._deleted: Set[str] = set()
+
+    def _peek(self, key: str) -> Any:
+        """
+        Looks up a variable without copying it. The result must not be
+        modified.
+        """
+
+        value = self._layer.get(key, _MISSING)
+        if value is not _MISSING or key in self._deleted:
+            return value
+
+        if isinstance(self._parent, Scope):
+            return self._parent._peek(key)
+        elif self._parent is not None:
+            return self._parent.get(key, _MISSING)
+        else:
+            return _MISSING
+
+    def __getitem__(self, key: str) -> Any:
+        value = self._layer.get(key, _MISSING)
+        if value is not _MISSING:
+            return value
+
+        value = self._peek(key)
+        if value is _MISSING:
+            raise KeyError(key)
+
+        if not isinstance(value, IMMUTABLE_TYPES):
+            value = copy.deepcopy(value)
+            self._layer[key] = value
+
+        return value
+
+    def __setitem__(self, key: str, value: Any) -> None:
+        self._layer[key] = value
+        self._deleted.discard(key)
+
+    def __delitem__(self, key: str) -> None:
+        if key not in self:
+            raise KeyError(key)
+
+        self._layer.pop(key, None)
+        self._deleted.add(key)
+
+    def __contains__(self, key: object) -> bool:
+        return isinstance(key, str) and self._peek(key) is not _MISSING
+
+    def __iter__(self) -> Iterator[str]:
+        yield from self._layer
+
+        if self._parent is not None:
+            for key in self._parent:
+                if key not in self._layer and key not in self._deleted:
+                    yield key
+
+    def __len__(self) -> int:
+        return sum(1 for _ in self)
+
+    def __repr__(self) -> str:
+        variables = {key: self._peek(key) for key in self}
+        return f"Scope({variables!r})"
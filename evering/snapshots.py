@@ -0,0 +1,341 @@
+"""
+This module remembers the state of every config file, header file and
+target after it was processed, so that later runs can skip config files
+that haven't changed (see --incremental).
+
+A file is considered unchanged if its size, mtime and inode are the same
+as before. If they differ but the size doesn't, or if the file was
+modified so shortly before it was recorded that an unnoticed change
+within the same mtime tick is possible, its hash decides instead.
+"""
+
+import hashlib
+import json
+import logging
+import os
+import time
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Any, Dict, List, Optional
+
+from .colors import style_error, style_path
+from .hashing import Hasher
+from .known_files import KnownFiles
+from .profiling import FILES_STATED, JSON_SAVES, count, phase
+from .util import (CatastrophicError, ReadFileException, WriteFileException,
+                   write_file)
+
+__all__ = ["FileSnapshot", "SourceSnapshot", "Snapshots"]
+logger = logging.getLogger(__name__)
+
+# Bump this whenever a change to evering may change the result of
+# processing an unchanged config file.
+SNAPSHOT_VERSION = 2
+
+# Files modified less than this long before they were recorded might be
+# modified again without their mtime changing, depending on the file
+# system's timestamp resolution.
+RACY_WINDOW_NS = 2 * 10**9
+
+# Snapshot hashes are only compared with each other, so they always use
+# the default algorithm
+_hasher = Hasher()
+
+
+@dataclass
+class FileSnapshot:
+    size: int
+    mtime_ns: int
+    inode: int
+    # Only recorded for config and header files, not for targets
+    hash: Optional[str] = None
+
+    @staticmethod
+    def of(path: Path, with_hash: bool) -> "FileSnapshot":
+        """
+        May raise: OSError, ReadFileException
+        """
+
+        count(FILES_STATED)
+        stat = os.stat(path)
+        file_hash = _hasher.hash_file(path) if with_hash else None
+        return FileSnapshot(stat.st_size, stat.st_mtime_ns, stat.st_ino,
+                            file_hash)
+
+    def matches(self, stat: os.stat_result) -> bool:
+        return (self.size == stat.st_size and
+                self.mtime_ns == stat.st_mtime_ns and
+                self.inode == stat.st_ino)
+
+    def to_json(self) -> List[Any]:
+        return [self.size, self.mtime_ns, self.inode, self.hash]
+
+    @staticmethod
+    def from_json(raw: Any) -> "FileSnapshot":
+        """
+        May raise: ValueError
+        """
+
+        if not isinstance(raw, list) or len(raw) != 4:
+            raise ValueError(f"Invalid file snapshot {raw!r}")
+
+        size, mtime_ns, inode, file_hash = raw
+        if not all(isinstance(n, int) for n in (size, mtime_ns, inode)):
+            raise ValueError(f"Invalid file snapshot {raw!r}")
+        if file_hash is not None and not isinstance(file_hash, str):
+            raise ValueError(f"Invalid file snapshot {raw!r}")
+
+        return FileSnapshot(size, mtime_ns, inode, file_hash)
+
+
+@dataclass
+class SourceSnapshot:
+    recorded_ns: int
+    source: FileSnapshot
+    header_path: Optional[Path]
+    header: Optional[FileSnapshot]
+    targets: Dict[Path, FileSnapshot]
+
+    def to_json(self) -> Dict[str, Any]:
+        header = None
+        if self.header_path is not None and self.header is not None:
+            header = [str(self.header_path), self.header.to_json()]
+
+        return {
+            "recorded_ns": self.recorded_ns,
+            "source": self.source.to_json(),
+            "header": header,
+            "targets": {str(path): snapshot.to_json()
+                        for path, snapshot in self.targets.items()},
+        }
+
+    @staticmethod
+    def from_json(raw: Any) -> "SourceSnapshot":
+        """
+        May raise: ValueError
+        """
+
+        if not isinstance(raw, dict):
+            raise ValueError(f"Invalid snapshot {raw!r}")
+
+        recorded_ns = raw.get("recorded_ns")
+        if not isinstance(recorded_ns, int):
+            raise ValueError(f"Invalid recording time {recorded_ns!r}")
+
+        source = FileSnapshot.from_json(raw.get("source"))
+
+        header_path = None
+        header = None
+        raw_header = raw.get("header")
+        if raw_header is not None:
+            if not isinstance(raw_header, list) or len(raw_header) != 2:
+                raise ValueError(f"Invalid header snapshot {raw_header!r}")
+            if not isinstance(raw_header[0], str):
+                raise ValueError(f"Invalid header path {raw_header[0]!r}")
+            header_path = Path(raw_header[0])
+            header = FileSnapshot.from_json(raw_header[1])
+
+        raw_targets = raw.get("targets")
+        if not isinstance(raw_targets, dict):
+            raise ValueError(f"Invalid targets {raw_targets!r}")
+        targets = {Path(path): FileSnapshot.from_json(snapshot)
+                   for path, snapshot in raw_targets.items()}
+
+        return SourceSnapshot(recorded_ns, source, header_path, header,
+                              targets)
+
+
+class Snapshots:
+    @staticmethod
+    def describe_environment(config_file: Path, user: str, host: str) -> str:
+        """
+        Returns a string that changes whenever all config files need to
+        be processed again, no matter whether they changed.
+
+        May raise: ReadFileException
+        """
+
+        text = json.dumps([SNAPSHOT_VERSION, _hasher.hash_file(config_file),
+                           user, host])
+        return hashlib.sha256(text.encode()).hexdigest()
+
+    def __init__(self, path: Path, environment: Optional[str]) -> None:
+        """
+        If the environment is None or differs from the one the
+        snapshots were recorded in, all old snapshots are ignored.
+
+        May raise: CatastrophicError
+        """
+
+        self._path = path
+        self._environment = environment
+        self._old_snapshots: Dict[Path, SourceSnapshot] = {}
+        self._new_snapshots: Dict[Path, SourceSnapshot] = {}
+
+        try:
+            with open(self._path) as f:
+                self._read_snapshots(f.read())
+        except FileNotFoundError:
+            logger.debug(f"File {style_path(self._path)} does not exist, "
+                         "creating a new file on the first upcoming save")
+        except (OSError, ValueError) as e:
+            raise CatastrophicError(
+                style_error("Could not load snapshots from ") +
+                style_path(self._path) + f": {e}")
+
+    def _read_snapshots(self, text: str) -> None:
+        raw_snapshots = json.loads(text)
+
+        if not isinstance(raw_snapshots, dict):
+            raise ValueError("Root level structure is not a dictionary")
+
+        environment = raw_snapshots.get("environment")
+        if self._environment is None or environment != self._environment:
+            logger.debug("The config file or environment changed, ignoring "
+                         "old snapshots")
+            return
+
+        raw_files = raw_snapshots.get("files")
+        if not isinstance(raw_files, dict):
+            raise ValueError("Files are not a dictionary")
+
+        for path, raw_snapshot in raw_files.items():
+            snapshot = SourceSnapshot.from_json(raw_snapshot)
+            self._old_snapshots[Path(path)] = snapshot
+
+    def _compare(self,
+                 path: Path,
+                 snapshot: FileSnapshot,
+                 recorded_ns: int
+                 ) -> Optional[bool]:
+        """
+        Returns None if the file changed. Otherwise, returns whether the
+        snapshot can be kept as it is (True) or only the contents are
+        still the same, so the snapshot should be recorded again (False).
+        """
+
+        try:
+            count(FILES_STATED)
+            stat = os.stat(path)
+        except OSError:
+            return None
+
+        racy = snapshot.mtime_ns >= recorded_ns - RACY_WINDOW_NS
+        if snapshot.matches(stat) and not racy:
+            return True
+
+        if snapshot.size != stat.st_size or snapshot.hash is None:
+            return None
+
+        # The mtime is unreliable, so compare the contents instead
+        try:
+            if _hasher.hash_file(path) == snapshot.hash:
+                return False
+        except ReadFileException:
+            pass
+
+        return None
+
+    def unchanged_targets(self,
+                          path: Path,
+                          header_path: Optional[Path],
+                          known_files: KnownFiles
+                          ) -> Optional[List[Path]]:
+        """
+        If neither the config file nor its header file changed since
+        they were last recorded and all their targets still look the same
+        on disk, keeps the old snapshot and returns the targets.
+        Otherwise, returns None.
+        """
+
+        snapshot = self._old_snapshots.get(path)
+        if snapshot is None or snapshot.header_path != header_path:
+            return None
+
+        up_to_date = self._compare(path, snapshot.source,
+                                   snapshot.recorded_ns)
+        if up_to_date is None:
+            return None
+
+        if header_path is not None and snapshot.header is not None:
+            header_up_to_date = self._compare(header_path, snapshot.header,
+                                              snapshot.recorded_ns)
+            if header_up_to_date is None:
+                return None
+            up_to_date = up_to_date and header_up_to_date
+
+        for target, target_snapshot in snapshot.targets.items():
+            if known_files.get_hash(target) is None:
+                return None
+
+            try:
+                count(FILES_STATED)
+                if not target_snapshot.matches(os.stat(target)):
+                    return None
+            except OSError:
+                return None
+
+        targets = list(snapshot.targets)
+        if up_to_date:
+            self._new_snapshots[path] = snapshot
+        else:
+            self.record(path, header_path, targets)
+
+        return targets
+
+    def record(self,
+               path: Path,
+               header_path: Optional[Path],
+               targets: List[Path]
+               ) -> None:
+        """
+        Records the current state of a config file that was just
+        processed, along with its header file and the targets it was
+        written to.
+        """
+
+        recorded_ns = time.time_ns()
+
+        try:
+            source = FileSnapshot.of(path, with_hash=True)
+            header = None
+            if header_path is not None:
+                header = FileSnapshot.of(header_path, with_hash=True)
+            target_snapshots = {target: FileSnapshot.of(target, False)
+                                for target in targets}
+        except (OSError, ReadFileException) as e:
+            logger.debug(f"Could not record snapshot of {style_path(path)}: "
+                         f"{e}")
+            return
+
+        self._new_snapshots[path] = SourceSnapshot(
+            recorded_ns, source, header_path, header, target_snapshots)
+
+    def save(self) -> None:
+        """
+        Saves the snapshots recorded or kept this round. Snapshots of
+        config files that weren't seen this round are forgotten.
+
+        May raise: CatastrophicError
+        """
+
+        text = json.dumps({
+            "environment": self._environment,
+            "files": {str(path): snapshot.to_json()
+                      for path, snapshot in self._new_snapshots.items()},
+        })
+
+        # Append a .tmp to the file name
+        path = Path(*self._path.parts[:-1], self._path.name + ".tmp")
+
+        try:
+            with phase("snapshots save"):
+                write_file(path, text)
+                path.replace(self._path)  # Assumed to be atomic
+                count(JSON_SAVES)
+        except (WriteFileException, OSError) as e:
+            raise CatastrophicError(
+                style_error("Error saving snapshots to ") +
+                style_path(path) + f": {e}")
+
+        logger.debug(f"Saved snapshots to {style_path(self._path)}")
@@ -0,0 +1,345 @@
+"""
+This module contains a persistent cache for rendered templates.
+
+The cache is content-addressed: A template is identified by a hash of
+its text and the delimiters it was parsed with. For each template, the
+cache remembers the names of the variables the template depends on. The
+rendered text is then identified by a hash of the template, the header
+and the values of exactly those variables.
+
+This only works if the values are plain data whose representation fully
+determines the template's output. As soon as a template depends on
+anything else (a module, a function defined in the config, a builtin
+with side effects, ...), it is rendered without the cache. Paths are
+plain data too, unless the template might use them to access the file
+system (like target.exists()).
+"""
+
+import builtins
+import hashlib
+import json
+import logging
+import threading
+from pathlib import Path, PurePath
+from typing import (Any, Collection, Dict, Iterable, List, Mapping, Optional,
+                    Set, Tuple, Union)
+
+from .colors import style_error, style_path
+from .profiling import JSON_SAVES, count, phase
+from .util import CatastrophicError, WriteFileException, write_file
+
+__all__ = ["PATH_IO_ATTRIBUTES", "TemplateCache"]
+logger = logging.getLogger(__name__)
+
+# Bump this whenever the parser or the cache format changes in a way that
+# makes old cache entries invalid.
+CACHE_VERSION = 3
+
+# Builtins whose result only depends on their arguments
+PURE_BUILTINS = {
+    "abs", "all", "any", "ascii", "bin", "bool", "bytes", "chr", "dict",
+    "divmod", "enumerate", "filter", "float", "format", "frozenset", "hex",
+    "int", "isinstance", "issubclass", "len", "list", "map", "max", "min",
+    "oct", "ord", "pow", "range", "repr", "reversed", "round", "set",
+    "slice", "sorted", "str", "sum", "tuple", "zip",
+}
+
+# Types whose repr() is a faithful representation of their value
+SCALAR_TYPES = (type(None), bool, int, float, complex, str, bytes)
+
+# Attributes of concrete paths that access the file system
+PATH_IO_ATTRIBUTES = frozenset(dir(Path)) - frozenset(dir(PurePath))
+
+# In the dependencies of a template, path I/O attributes are marked with
+# this prefix, which variable names can't start with
+ATTRIBUTE_PREFIX = "."
+
+Entry = Union[str, List[str]]
+
+
+class _NotCacheable(Exception):
+    pass
+
+
+class TemplateCache:
+    def __init__(self, path: Path, max_size: int) -> None:
+        """
+        May raise: CatastrophicError
+        """
+
+        self._path = path
+        self._max_size = max_size
+
+        # Both dependency lists and rendered texts, ordered from least to
+        # most recently used
+        self._entries: Dict[str, Entry] = {}
+        self._size = 0
+        self._modified = False
+        # Config files may be rendered by several threads at once
+        self._lock = threading.Lock()
+
+        try:
+            with open(self._path) as f:
+                self._read_entries(f.read())
+        except FileNotFoundError:
+            logger.debug(f"File {style_path(self._path)} does not exist, "
+                         "creating a new file on the first upcoming save")
+        except (OSError, ValueError) as e:
+            raise CatastrophicError(
+                style_error("Could not load template cache from ") +
+                style_path(self._path) + f": {e}")
+
+        self._loaded_keys = list(self._entries)
+
+    def _read_entries(self, text: str) -> None:
+        raw_cache = json.loads(text)
+
+        if not isinstance(raw_cache, dict):
+            raise ValueError("Root level structure is not a dictionary")
+
+        if raw_cache.get("version") != CACHE_VERSION:
+            logger.debug(f"Discarding outdated template cache at "
+                         f"{style_path(self._path)}")
+            self._modified = True
+            return
+
+        entries = raw_cache.get("entries")
+        if not isinstance(entries, dict):
+            raise ValueError("Entries are not a dictionary")
+
+        for key, entry in entries.items():
+            is_names = (isinstance(entry, list) and
+                        all(isinstance(name, str) for name in entry))
+            if not isinstance(entry, str) and not is_names:
+                raise ValueError(f"Invalid entry {key!r}")
+
+            self._entries[key] = entry
+            self._size += self._entry_size(entry)
+
+    # Keys
+
+    @staticmethod
+    def _hash(*parts: Any) -> str:
+        text = json.dumps([CACHE_VERSION, *parts])
+        return hashlib.sha256(text.encode()).hexdigest()
+
+    def template_key(self,
+                     lines: List[str],
+                     statement_prefix: str,
+                     expression_delimiters: Tuple[str, str],
+                     ) -> str:
+        return self._hash("template", lines, statement_prefix,
+                          list(expression_delimiters))
+
+    def render_key(self,
+                   template_key: str,
+                   header: str,
+                   dependencies: Iterable[str],
+                   io_attributes: Collection[str],
+                   local_vars: Mapping[str, Any],
+                   ) -> Optional[str]:
+        """
+        Returns None if the rendered template can't be cached because
+        the values it depends on aren't plain data. The io_attributes
+        are the PATH_IO_ATTRIBUTES the template uses. If there are any,
+        concrete paths aren't plain data either.
+        """
+
+        io_attribute = min(io_attributes, default=None)
+
+        values: List[Tuple[str, str]] = []
+        try:
+            for name in sorted(dependencies):
+                fingerprint = self._fingerprint_name(name, local_vars,
+                                                     io_attribute)
+                values.append((name, fingerprint))
+        except _NotCacheable as e:
+            logger.debug(f"Not caching the rendered template: {e}")
+            return None
+
+        return self._hash("render", template_key, header, values)
+
+    @classmethod
+    def _fingerprint_name(cls,
+                          name: str,
+                          local_vars: Mapping[str, Any],
+                          io_attribute: Optional[str] = None
+                          ) -> str:
+        """
+        May raise: _NotCacheable
+        """
+
+        if name in local_vars:
+            return cls._fingerprint(local_vars[name], set(), io_attribute)
+        elif name in PURE_BUILTINS:
+            return "<builtin>"
+        elif hasattr(builtins, name):
+            raise _NotCacheable(f"it uses the builtin {name!r}")
+        else:
+            # Either this raises a NameError (and the result isn't cached
+            # anyway) or the template assigns the variable itself.
+            return "<undefined>"
+
+    @classmethod
+    def fingerprint(cls, value: Any) -> Optional[str]:
+        """
+        Returns a string that uniquely represents a plain data value, or
+        None if the value isn't plain data.
+        """
+
+        try:
+            return cls._fingerprint(value, set())
+        except _NotCacheable:
+            return None
+
+    @classmethod
+    def _fingerprint(cls,
+                     value: Any,
+                     seen: Set[int],
+                     io_attribute: Optional[str] = None
+                     ) -> str:
+        """
+        Returns a string that uniquely represents a plain data value. If
+        an io_attribute is given, concrete paths don't count as plain
+        data, since the template might access the file system through
+        that attribute.
+
+        May raise: _NotCacheable
+        """
+
+        value_type = type(value)
+
+        if value_type in SCALAR_TYPES:
+            return repr(value)
+
+        if isinstance(value, PurePath):
+            if io_attribute is not None and isinstance(value, Path):
+                raise _NotCacheable(f"it might use {io_attribute!r} to "
+                                    f"access the path {str(value)!r}")
+            return f"{value_type.__name__}({str(value)!r})"
+
+        if id(value) in seen:
+            raise _NotCacheable("it depends on a recursive data structure")
+        seen = seen | {id(value)}
+
+        if value_type in (list, tuple):
+            items = (cls._fingerprint(item, seen, io_attribute)
+                     for item in value)
+            return f"{value_type.__name__}[{', '.join(items)}]"
+
+        if value_type in (set, frozenset):
+            # The order of the items matters, since the template might
+            # iterate over them.
+            items = (cls._fingerprint(item, seen, io_attribute)
+                     for item in value)
+            return f"{value_type.__name__}{{{', '.join(items)}}}"
+
+        if value_type is dict:
+            items = (f"{cls._fingerprint(key, seen, io_attribute)}: "
+                     f"{cls._fingerprint(item, seen, io_attribute)}"
+                     for key, item in value.items())
+            return f"dict{{{', '.join(items)}}}"
+
+        raise _NotCacheable(
+            f"it depends on a value of type {value_type.__name__!r}")
+
+    # Entries
+
+    @staticmethod
+    def _entry_size(entry: Entry) -> int:
+        if isinstance(entry, str):
+            return len(entry)
+        else:
+            return sum(len(name) for name in entry)
+
+    def _get(self, key: str) -> Optional[Entry]:
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is not None:
+                self._entries[key] = entry  # Mark as most recently used
+            return entry
+
+    def _put(self, key: str, entry: Entry) -> None:
+        with self._lock:
+            self._put_unlocked(key, entry)
+
+    def _put_unlocked(self, key: str, entry: Entry) -> None:
+        old_entry = self._entries.pop(key, None)
+        if old_entry is not None:
+            self._size -= self._entry_size(old_entry)
+
+        self._entries[key] = entry
+        self._size += self._entry_size(entry)
+        self._modified = True
+
+        # Evict the least recently used entries, but never the new one
+        while self._size > self._max_size and len(self._entries) > 1:
+            oldest_key = next(iter(self._entries))
+            self._size -= self._entry_size(self._entries.pop(oldest_key))
+
+    def get_dependencies(self,
+                         template_key: str
+                         ) -> Optional[Tuple[List[str], List[str]]]:
+        """
+        Returns the names of the variables the template depends on and
+        the PATH_IO_ATTRIBUTES it uses (see render_key).
+        """
+
+        entry = self._get(template_key)
+        if not isinstance(entry, list):
+            return None
+
+        names = [name for name in entry
+                 if not name.startswith(ATTRIBUTE_PREFIX)]
+        io_attributes = [name[len(ATTRIBUTE_PREFIX):] for name in entry
+                         if name.startswith(ATTRIBUTE_PREFIX)]
+        return names, io_attributes
+
+    def put_dependencies(self,
+                         template_key: str,
+                         dependencies: Collection[str],
+                         attributes: Collection[str]
+                         ) -> None:
+        """
+        Of the attributes, only the PATH_IO_ATTRIBUTES are remembered.
+        """
+
+        io_attributes = PATH_IO_ATTRIBUTES.intersection(attributes)
+        self._put(template_key,
+                  sorted(dependencies) +
+                  sorted(ATTRIBUTE_PREFIX + name for name in io_attributes))
+
+    def get_render(self, render_key: str) -> Optional[str]:
+        entry = self._get(render_key)
+        return entry if isinstance(entry, str) else None
+
+    def put_render(self, render_key: str, text: str) -> None:
+        self._put(render_key, text)
+
+    def save(self) -> None:
+        """
+        May raise: CatastrophicError
+        """
+
+        if not self._modified and list(self._entries) == self._loaded_keys:
+            logger.debug("Template cache unchanged, not saving")
+            return
+
+        text = json.dumps({"version": CACHE_VERSION, "entries": self._entries})
+
+        # Append a .tmp to the file name
+        path = Path(*self._path.parts[:-1], self._path.name + ".tmp")
+
+        try:
+            with phase("template cache save"):
+                write_file(path, text)
+                path.replace(self._path)  # Assumed to be atomic
+                count(JSON_SAVES)
+        except (WriteFileException, OSError) as e:
+            raise CatastrophicError(
+                style_error("Error saving template cache to ") +
+                style_path(path) + f": {e}")
+
+        self._loaded_keys = list(self._entries)
+        self._modified = False
+        logger.debug(f"Saved template cache to {style_path(self._path)}")
@@ -1,40 +1,22 @@
-import copy
 import getpass
+import locale
+import os
 import socket
 import types
 from pathlib import Path
-from typing import Any, Dict
+from typing import Any, MutableMapping, Union
+
+from .profiling import BYTES_READ, BYTES_WRITTEN, count, profiling
 
 __all__ = [
-    "copy_local_variables",
     "get_user", "get_host",
-    "ExecuteException", "safer_exec", "safer_eval",
+    "ExecuteException", "safer_compile", "safer_exec", "safer_eval",
     "ReadFileException", "read_file",
-    "WriteFileException", "write_file",
+    "WriteFileException", "encode_text", "write_file",
     "CatastrophicError", "LessCatastrophicError",
 ]
 
 
-def copy_local_variables(local: Dict[str, Any]) -> Dict[str, Any]:
-    """
-    Attempts to deep-copy a set of local variables, but keeping
-    modules at the top level alone, since they don't tend to deepcopy
-    well.
-
-    May raise: Not sure at the moment
-    """
-
-    local_copy = {}
-
-    for key, value in local.items():
-        if isinstance(value, types.ModuleType):
-            local_copy[key] = value
-        else:
-            local_copy[key] = copy.deepcopy(value)
-
-    return local_copy
-
-
 def get_user() -> str:
     return getpass.getuser()
 
@@ -47,7 +29,24 @@ class ExecuteException(Exception):
     pass
 
 
-def safer_exec(code: str, local_vars: Dict[str, Any]) -> None:
+def safer_compile(code: str, mode: str,
+                  filename: str = "<string>") -> types.CodeType:
+    """
+    Compiles code once so it can be passed to safer_exec or safer_eval
+    repeatedly without being recompiled every time.
+
+    May raise: ExecuteException
+    """
+
+    try:
+        return compile(code, filename, mode)
+    except (SyntaxError, ValueError) as e:
+        raise ExecuteException(e)
+
+
+def safer_exec(code: Union[str, types.CodeType],
+               local_vars: MutableMapping[str, Any]
+               ) -> None:
     """
     May raise: ExecuteException
     """
@@ -58,7 +57,9 @@ def safer_exec(code: str, local_vars: Dict[str, Any]) -> None:
         raise ExecuteException(e)
 
 
-def safer_eval(code: str, local_vars: Dict[str, Any]) -> Any:
+def safer_eval(code: Union[str, types.CodeType],
+               local_vars: MutableMapping[str, Any]
+               ) -> Any:
     """
     May raise: ExecuteException
     """
@@ -80,23 +81,48 @@ def read_file(path: Path) -> str:
 
     try:
         with open(path.expanduser()) as f:
+            if profiling():
+                count(BYTES_READ, os.fstat(f.fileno()).st_size)
             return f.read()
     except OSError as e:
         raise ReadFileException(e)
 
 
+BLOCK_SIZE = 2**16
+
+
 class WriteFileException(Exception):
     pass
 
 
-def write_file(path: Path, text: str) -> None:
+def encode_text(text: str) -> bytes:
     """
+    Encodes text the same way writing it to a file in text mode would.
+
     May raise: WriteFileException
     """
 
     try:
-        with open(path.expanduser(), "w") as f:
-            f.write(text)
+        return text.encode(locale.getpreferredencoding(False))
+    except UnicodeEncodeError as e:
+        raise WriteFileException(e)
+
+
+def write_file(path: Path, text: Union[str, bytes]) -> None:
+    """
+    May raise: WriteFileException
+    """
+
+    try:
+        if isinstance(text, bytes):
+            with open(path.expanduser(), "wb") as f:
+                f.write(text)
+                count(BYTES_WRITTEN, len(text))
+        else:
+            with open(path.expanduser(), "w") as f:
+                f.write(text)
+                if profiling():
+                    count(BYTES_WRITTEN, f.tell())
     except OSError as e:
         raise WriteFileException(e)
 
@@ -0,0 +1,601 @@
+"""
+This module contains the --watch mode, which keeps running after
+processing all config files and processes them again whenever they
+change.
+
+The config, the known files, the template cache and the parsed
+templates are kept in memory between rounds, and only the config files
+that actually changed are processed again. If a header file changes,
+only its config file is processed again. If the config file itself
+changes, only the config files that depend on variables whose values
+changed are processed again.
+
+Changes are detected with inotify if it is available and by regularly
+looking at the files' mtimes otherwise.
+"""
+
+import ctypes
+import ctypes.util
+import logging
+import os
+import select
+import struct
+import time
+from abc import ABC, abstractmethod
+from pathlib import Path
+from typing import Any, Dict, Iterator, Mapping, Optional, Set, Tuple
+
+from .colors import style_error, style_path, style_warning
+from .config import Config, ConfigurationException
+from .explore import FileInfo, explore_dir, find_config_files, list_dir
+from .known_files import KnownFiles
+from .policy import Conflict, ErrorResolution, Resolution
+from .process import Processor
+from .template_cache import TemplateCache
+
+__all__ = ["Watcher", "InotifyWatcher", "PollingWatcher", "create_watcher",
+           "WatchSession", "changed_variables", "watch"]
+logger = logging.getLogger(__name__)
+
+# Editors often save a file in several steps. After a change, wait this
+# long for further changes before processing anything.
+DEBOUNCE_SECONDS = 0.05
+
+POLL_INTERVAL_SECONDS = 1.0
+
+# From <sys/inotify.h>
+IN_MODIFY = 0x00000002
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+IN_CLOEXEC = 0o2000000
+IN_NONBLOCK = 0o4000
+
+INOTIFY_DIR_MASK = (IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM |
+                    IN_MOVED_TO | IN_CREATE | IN_DELETE | IN_DELETE_SELF |
+                    IN_MOVE_SELF | IN_ONLYDIR)
+
+# struct inotify_event without the trailing name
+INOTIFY_EVENT = struct.Struct("iIII")
+
+
+class Watcher(ABC):
+    """
+    Watches directories for changes to their entries.
+    """
+
+    @abstractmethod
+    def watch_dir(self, path: Path) -> None:
+        """
+        Starts watching a directory (but not its subdirectories). The
+        directory is no longer watched once it is removed.
+
+        May raise: OSError
+        """
+
+        pass
+
+    @abstractmethod
+    def wait(self, timeout: Optional[float]) -> Optional[Set[Path]]:
+        """
+        Waits for changes and returns the paths that changed. A path
+        inside a watched directory changes when it is created, removed,
+        renamed or written to. Returns an empty set if the timeout passed
+        without any changes, and None if some changes may have been
+        missed.
+        """
+
+        pass
+
+    def close(self) -> None:
+        pass
+
+
+class InotifyWatcher(Watcher):
+    def __init__(self) -> None:
+        """
+        May raise: OSError
+        """
+
+        libc_name = ctypes.util.find_library("c")
+        if libc_name is None:
+            raise OSError("Could not find the C library")
+
+        try:
+            self._libc = ctypes.CDLL(libc_name, use_errno=True)
+            self._libc.inotify_init1.argtypes = [ctypes.c_int]
+            self._libc.inotify_add_watch.argtypes = [
+                ctypes.c_int, ctypes.c_char_p, ctypes.c_uint32]
+        except AttributeError:
+            raise OSError("inotify is not supported")
+
+        self._fd = self._libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self._fd < 0:
+            self._raise_errno()
+
+        # The directory each watch descriptor belongs to
+        self._dirs: Dict[int, Path] = {}
+
+    @staticmethod
+    def _raise_errno() -> None:
+        errno = ctypes.get_errno()
+        raise OSError(errno, os.strerror(errno))
+
+    def watch_dir(self, path: Path) -> None:
+        wd = self._libc.inotify_add_watch(self._fd, os.fsencode(path),
+                                          INOTIFY_DIR_MASK)
+        if wd < 0:
+            self._raise_errno()
+
+        self._dirs[wd] = path
+
+    def wait(self, timeout: Optional[float]) -> Optional[Set[Path]]:
+        ready, _, _ = select.select([self._fd], [], [], timeout)
+        if not ready:
+            return set()
+
+        changed: Set[Path] = set()
+        missed_changes = False
+
+        while True:
+            try:
+                data = os.read(self._fd, 64 * 1024)
+            except BlockingIOError:
+                break
+
+            offset = 0
+            while offset < len(data):
+                wd, mask, _, length = INOTIFY_EVENT.unpack_from(data, offset)
+                offset += INOTIFY_EVENT.size
+                name = data[offset:offset + length].rstrip(b"\0")
+                offset += length
+
+                if mask & IN_Q_OVERFLOW:
+                    missed_changes = True
+                    continue
+
+                path = self._dirs.get(wd)
+                if mask & IN_IGNORED:
+                    self._dirs.pop(wd, None)
+                if path is None:
+                    continue
+
+                changed.add(path / os.fsdecode(name) if name else path)
+
+        return None if missed_changes else changed
+
+    def close(self) -> None:
+        os.close(self._fd)
+
+
+class PollingWatcher(Watcher):
+    def __init__(self, interval: float = POLL_INTERVAL_SECONDS) -> None:
+        self._interval = interval
+        self._dirs: Set[Path] = set()
+        # The size, mtime and inode of every entry of the watched
+        # directories
+        self._state: Dict[Path, Tuple[int, int, int]] = {}
+
+    def watch_dir(self, path: Path) -> None:
+        self._state.update(self._scan_dir(path))
+        self._dirs.add(path)
+
+    @staticmethod
+    def _scan_dir(path: Path) -> Dict[Path, Tuple[int, int, int]]:
+        """
+        May raise: OSError
+        """
+
+        state = {}
+        with os.scandir(path) as entries:
+            for entry in entries:
+                try:
+                    stat = entry.stat()
+                except OSError:
+                    continue
+                state[path / entry.name] = (stat.st_size, stat.st_mtime_ns,
+                                            stat.st_ino)
+        return state
+
+    def _scan(self) -> Dict[Path, Tuple[int, int, int]]:
+        state = {}
+        for path in list(self._dirs):
+            try:
+                state.update(self._scan_dir(path))
+            except OSError:
+                self._dirs.discard(path)
+        return state
+
+    def wait(self, timeout: Optional[float]) -> Optional[Set[Path]]:
+        deadline = None if timeout is None else time.monotonic() + timeout
+
+        while True:
+            state = self._scan()
+            changed = {path for path in state.keys() | self._state.keys()
+                       if state.get(path) != self._state.get(path)}
+            self._state = state
+            if changed:
+                return changed
+
+            delay = self._interval
+            if deadline is not None:
+                delay = min(delay, deadline - time.monotonic())
+                if delay <= 0:
+                    return set()
+
+            time.sleep(delay)
+
+
+def create_watcher() -> Watcher:
+    try:
+        return InotifyWatcher()
+    except OSError as e:
+        logger.debug(f"Could not use inotify, polling for changes instead: "
+                     f"{e}")
+        return PollingWatcher()
+
+
+class WatchSession:
+    """
+    Everything that is kept in memory while watching.
+    """
+
+    def __init__(self,
+                 config: Config,
+                 watcher: Watcher,
+                 jobs: int,
+                 use_cache: bool,
+                 policy_overrides: Mapping[Conflict, Resolution],
+                 error_override: Optional[ErrorResolution],
+                 paranoid: bool
+                 ) -> None:
+        """
+        May raise: CatastrophicError, ConfigurationException
+        """
+
+        self.config = config
+        self.config_file = Path(os.path.abspath(config.config_file))
+        self.config_dir = config.config_dir
+
+        self.known_files = KnownFiles(config.known_files)
+
+        self.cache = None
+        if use_cache:
+            self.cache = TemplateCache(config.template_cache,
+                                       config.template_cache_size)
+
+        self._policy_overrides = policy_overrides
+        self._error_override = error_override
+        self.processor = Processor(
+            config, self.known_files, self.cache, keep_parsers=True,
+            policy=config.policy.overridden(policy_overrides,
+                                            error_override),
+            paranoid=paranoid, hasher=config.hasher)
+
+        self._watcher = watcher
+        self._jobs = jobs
+        self._settings = self._get_settings(config)
+
+        # All config files and the directories they were found in
+        self._files: Dict[Path, FileInfo] = {}
+        self._dirs: Set[Path] = set()
+
+        self._watch(self.config_file.parent)
+
+    def _get_settings(self, config: Config) -> Tuple[Any, ...]:
+        """
+        Everything about the config that the session depends on besides
+        the config files.
+
+        May raise: ConfigurationException
+        """
+
+        # The paths are relative if the config file was given as a
+        # relative path
+        settings = (Path(os.path.abspath(config.config_file)),
+                    Path(os.path.abspath(config.config_dir)),
+                    Path(os.path.abspath(config.known_files)))
+        if self.cache is None:
+            return settings
+        return settings + (Path(os.path.abspath(config.template_cache)),
+                           config.template_cache_size)
+
+    def _watch(self, path: Path) -> None:
+        try:
+            self._watcher.watch_dir(path)
+        except OSError as e:
+            logger.warning(style_warning("Could not watch ") +
+                           style_path(path) + f" for changes: {e}")
+
+    def _on_dir(self, path: Path) -> None:
+        self._dirs.add(path)
+        self._watch(path)
+
+    def process_all(self) -> None:
+        """
+        May raise: CatastrophicError
+        """
+
+        self._files = {}
+        self._dirs = set()
+
+        def discover() -> Iterator[FileInfo]:
+            for file_info in find_config_files(self.config_dir,
+                                               self._on_dir):
+                self._files[file_info.path] = file_info
+                yield file_info
+
+        self.processor.process_files(discover(), dry_run=False,
+                                     jobs=self._jobs)
+        self._finish_round()
+
+    def process_changes(self, changed: Set[Path]) -> None:
+        """
+        May raise: CatastrophicError
+        """
+
+        old_files = dict(self._files)
+
+        affected_dirs = {path.parent for path in changed
+                         if path.parent in self._dirs}
+        for path in sorted(affected_dirs):
+            self._rescan_dir(path)
+
+        for path in old_files.keys() - self._files.keys():
+            logger.info(f"{style_path(path)} was removed")
+
+        # New files, changed files and files whose header changed
+        file_infos = [file_info for path, file_info in self._files.items()
+                      if path in changed or file_info.header in changed or
+                      old_files.get(path) != file_info]
+        if not file_infos:
+            return
+
+        self.processor.process_files(file_infos, dry_run=False,
+                                     jobs=self._jobs)
+        self._finish_round()
+
+    def apply_config(self, config: Config) -> bool:
+        """
+        Switches to a new version of the config and processes the config
+        files that depend on variables whose values changed. Returns
+        False (and does nothing) if the session can't be used with the
+        new config, for example because the config dir changed.
+
+        May raise: CatastrophicError, ConfigurationException
+        """
+
+        if self._get_settings(config) != self._settings:
+            return False
+
+        policy = config.policy.overridden(self._policy_overrides,
+                                          self._error_override)
+        hasher = config.hasher
+
+        changed = changed_variables(self.config.local_vars,
+                                    config.local_vars)
+        logger.debug(f"Changed variables: {', '.join(sorted(changed))}")
+
+        self.config = config
+        self.processor.config = config
+        self.processor.policy = policy
+        self.processor.hasher = hasher
+
+        file_infos = []
+        for path, file_info in self._files.items():
+            dependencies = self.processor.dependencies.get(path)
+            if dependencies is None or not dependencies.isdisjoint(changed):
+                file_infos.append(file_info)
+            else:
+                logger.debug(f"{style_path(path)} doesn't depend on any "
+                             "changed variables")
+
+        logger.info(f"Processing {len(file_infos)} of {len(self._files)} "
+                    "files again")
+        if not file_infos:
+            return True
+
+        self.processor.process_files(file_infos, dry_run=False,
+                                     jobs=self._jobs)
+        self._finish_round()
+        return True
+
+    def _rescan_dir(self, path: Path) -> None:
+        for file_path in [p for p in self._files if p.parent == path]:
+            del self._files[file_path]
+
+        try:
+            files, subdirs = list_dir(path)
+        except OSError:
+            self._forget_dir(path)
+            return
+
+        for file_info in files:
+            self._files[file_info.path] = file_info
+
+        for subdir in [d for d in self._dirs if d.parent == path]:
+            if subdir not in subdirs:
+                self._forget_dir(subdir)
+
+        for subdir in subdirs:
+            if subdir in self._dirs:
+                continue
+
+            try:
+                for file_info in explore_dir(subdir, self._on_dir):
+                    self._files[file_info.path] = file_info
+            except OSError as e:
+                logger.warning(style_warning("Could not descend into "
+                                             "folder ") +
+                               style_path(subdir) + f": {e}")
+
+    def _forget_dir(self, path: Path) -> None:
+        self._dirs = {d for d in self._dirs
+                      if d != path and path not in d.parents}
+        self._files = {p: file_info for p, file_info in self._files.items()
+                       if path not in p.parents}
+
+    def _finish_round(self) -> None:
+        """
+        May raise: CatastrophicError
+        """
+
+        self.known_files.checkpoint()
+        if self.cache is not None:
+            self.cache.save()
+
+    def _wait_for_changes(self) -> Optional[Set[Path]]:
+        changed = self._watcher.wait(None)
+
+        while changed:
+            more = self._watcher.wait(DEBOUNCE_SECONDS)
+            if more is None:
+                return None
+            if not more:
+                break
+            changed |= more
+
+        return changed
+
+    def run(self) -> Optional[Set[Path]]:
+        """
+        Processes config files as they change, until the config file
+        itself changes. Returns the other paths that changed along with
+        it, or None if some changes may have been missed.
+
+        May raise: CatastrophicError
+        """
+
+        logger.info(f"Watching {style_path(self.config_dir)} for changes")
+
+        while True:
+            changed = self._wait_for_changes()
+
+            if changed is None:
+                logger.info("Some changes may have been missed, processing "
+                            "all files again")
+                self.process_all()
+            elif self.config_file in changed:
+                return changed - {self.config_file}
+            else:
+                self.process_changes(changed)
+
+
+def changed_variables(old_vars: Mapping[str, Any],
+                      new_vars: Mapping[str, Any]
+                      ) -> Set[str]:
+    """
+    Returns the names of all variables that were added, removed or
+    changed. Values that aren't plain data (like functions defined in
+    the config) count as changed unless they are the same object.
+    """
+
+    changed = set()
+
+    for name in old_vars.keys() | new_vars.keys():
+        if name not in old_vars or name not in new_vars:
+            changed.add(name)
+            continue
+
+        old_value = old_vars[name]
+        new_value = new_vars[name]
+        if old_value is new_value:
+            continue
+
+        old_fingerprint = TemplateCache.fingerprint(old_value)
+        if (old_fingerprint is None or
+                old_fingerprint != TemplateCache.fingerprint(new_value)):
+            changed.add(name)
+
+    return changed
+
+
+def watch(config_file: Optional[Path],
+          jobs: int,
+          use_cache: bool,
+          policy_overrides: Mapping[Conflict, Resolution],
+          error_override: Optional[ErrorResolution],
+          paranoid: bool
+          ) -> None:
+    """
+    May raise: CatastrophicError, ConfigurationException
+    """
+
+    # The config file is reloaded from its absolute path, so it is loaded
+    # from there in the first place too. Otherwise, the relative paths in
+    # the first config wouldn't match the absolute ones after reloading.
+    if config_file is not None:
+        config_file = Path(os.path.abspath(config_file))
+    config = Config.load_config_file(config_file)
+    watcher = create_watcher()
+    session: Optional[WatchSession] = None
+
+    try:
+        while True:
+            if session is None:
+                session = WatchSession(config, watcher, jobs, use_cache,
+                                       policy_overrides, error_override,
+                                       paranoid)
+                session.process_all()
+
+            changed = session.run()
+
+            logger.info("The config file changed, reloading it")
+            config, changed = _reload_config(session.config_file, watcher,
+                                             changed)
+
+            if not session.apply_config(config):
+                logger.info("The locations of evering's files changed, "
+                            "starting over")
+                watcher.close()
+                watcher = create_watcher()
+                session = None
+            elif changed is None:
+                logger.info("Some changes may have been missed, processing "
+                            "all files again")
+                session.process_all()
+            elif changed:
+                # For example, templates that changed in the same git
+                # checkout as the config file
+                session.process_changes(changed)
+    except KeyboardInterrupt:
+        logger.info("Stopped watching")
+    finally:
+        watcher.close()
+
+
+def _reload_config(config_file: Path,
+                   watcher: Watcher,
+                   changed: Optional[Set[Path]]
+                   ) -> Tuple[Config, Optional[Set[Path]]]:
+    """
+    Loads the config file again, waiting for it to be fixed if it can't
+    be loaded. Other paths that change in the meantime are added to the
+    changed paths, which become None if some changes may have been
+    missed.
+    """
+
+    while True:
+        try:
+            return Config.load_config_file(config_file), changed
+        except ConfigurationException as e:
+            logger.error(e)
+            logger.error(style_error("Waiting for the config file to change"))
+
+        while True:
+            more = watcher.wait(None)
+            if more is None:
+                changed = None
+                break
+            if changed is not None:
+                changed |= more - {config_file}
+            if config_file in more:
+                break
@@ -0,0 +1,104 @@
+"""
+Checks that known files from before the format was versioned are still
+understood.
+"""
+
+import json
+from pathlib import Path
+
+from evering.known_files import KnownFiles
+
+HASH = "0" * 64
+
+
+def write_legacy(tmp_path: Path) -> Path:
+    """
+    Writes known files like before the format was versioned, with a
+    target that is a symlink (link_t) known by the path of the file it
+    links to (real).
+    """
+
+    out = tmp_path / "out"
+    out.mkdir()
+    (out / "real").write_text("hello\n")
+    (out / "link_t").symlink_to("real")
+
+    path = tmp_path / "known_files"
+    path.write_text(json.dumps({str(out / "real"): HASH}))
+    return path
+
+
+def test_legacy_symlink_target_is_known(tmp_path: Path) -> None:
+    known_files = KnownFiles(write_legacy(tmp_path))
+    link = tmp_path / "out" / "link_t"
+
+    assert known_files.get_hash(link) == f"sha256:{HASH}"
+    known_files.keep_file(link)
+    assert known_files.find_forgotten_files() == set()
+
+    known_files.save_final()
+    saved = json.loads((tmp_path / "known_files").read_text())
+    assert saved == {"version": 2,
+                     "files": {str(link): f"sha256:{HASH}"}}
+
+
+def test_legacy_entry_of_rewritten_target_is_not_forgotten(
+        tmp_path: Path) -> None:
+    known_files = KnownFiles(write_legacy(tmp_path))
+    link = tmp_path / "out" / "link_t"
+
+    known_files.update_file(link, f"sha256:{'1' * 64}")
+    assert known_files.find_forgotten_files() == set()
+
+
+def test_legacy_file_behind_symlink_is_still_known(tmp_path: Path) -> None:
+    # Both the link and the file it links to are targets
+    known_files = KnownFiles(write_legacy(tmp_path))
+    link = tmp_path / "out" / "link_t"
+    real = tmp_path / "out" / "real"
+
+    known_files.keep_file(link)
+    assert known_files.get_hash(real) == f"sha256:{HASH}"
+    known_files.keep_file(real)
+    assert known_files.find_forgotten_files() == set()
+
+
+def test_versioned_symlink_target_is_not_resolved(tmp_path: Path) -> None:
+    path = write_legacy(tmp_path)
+    real = tmp_path / "out" / "real"
+    path.write_text(json.dumps({"version": 2,
+                                "files": {str(real): f"sha256:{HASH}"}}))
+
+    known_files = KnownFiles(path)
+    assert known_files.get_hash(tmp_path / "out" / "link_t") is None
+    assert known_files.find_forgotten_files() == {real}
+
+
+def test_writes_through_user_symlinks_are_noticed(tmp_path: Path) -> None:
+    out = tmp_path / "out"
+    out.mkdir()
+    (out / "real").write_text("hello\n")
+    (out / "link_t").symlink_to("real")
+    (out / "other_t").symlink_to("real")
+
+    for written, other in ((out / "real", out / "link_t"),
+                           (out / "link_t", out / "real"),
+                           (out / "link_t", out / "other_t")):
+        known_files = KnownFiles(tmp_path / "known_files")
+        assert not known_files.was_recently_modified(other)
+        known_files.update_file(written, f"sha256:{HASH}")
+        assert known_files.was_recently_modified(other)
+
+
+def test_managed_symlinks_are_not_written_through(tmp_path: Path) -> None:
+    source = tmp_path / "source"
+    source.write_text("hello\n")
+    first = tmp_path / "first"
+    second = tmp_path / "second"
+    first.symlink_to(source)
+    second.symlink_to(source)
+
+    known_files = KnownFiles(tmp_path / "known_files")
+    known_files.update_file(first, f"symlink:{source}")
+    assert not known_files.was_recently_modified(second)
+    assert not known_files.was_recently_modified(source)
@@ -0,0 +1,186 @@
+"""
+Checks that compiled templates (Parser.evaluate) render exactly like the
+reference interpreter (Parser.interpret).
+"""
+
+import random
+from typing import Any, Dict, List, Optional
+
+import pytest
+
+from evering.parser import Parser
+
+VARIABLES: Dict[str, Any] = {
+    "user": "root",
+    "host": "laptop",
+    "n": 7,
+    "names": ["alpha", "beta"],
+}
+
+
+def make_parser(lines: List[str]) -> Parser:
+    return Parser(lines,
+                  statement_prefix="#",
+                  expression_prefix="{{",
+                  expression_suffix="}}")
+
+
+def render_both(parser: Parser,
+                variables: Optional[Dict[str, Any]] = None
+                ) -> str:
+    """
+    Renders the template with both backends, each with its own copy of
+    the variables, and checks that they agree.
+    """
+
+    variables = VARIABLES if variables is None else variables
+    compiled_vars = dict(variables)
+    interpreted_vars = dict(variables)
+
+    compiled = parser.evaluate(compiled_vars)
+    interpreted = parser.interpret(interpreted_vars)
+
+    assert compiled.encode() == interpreted.encode()
+    assert compiled_vars == interpreted_vars
+    return compiled
+
+
+def test_plain_text() -> None:
+    lines = ["plain", "", "  indented  ", "'quotes' \"and\" \\backslashes"]
+    parser = make_parser(lines)
+    assert parser._code is not None
+    assert render_both(parser) == "".join(f"{line}\n" for line in lines)
+
+
+def test_empty_template() -> None:
+    assert render_both(make_parser([])) == ""
+
+
+@pytest.mark.parametrize("user, host, expected", [
+    ("root", "laptop", "a\nroot on laptop\n"),
+    ("root", "desktop", "a\nb\n"),
+    ("joe", "laptop", "c\nd\n"),
+    ("joe", "server", "e\n"),
+])
+def test_if_elif_else_nesting(user: str, host: str, expected: str) -> None:
+    parser = make_parser([
+        "# if user == 'root'",
+        "a",
+        "  # if host.startswith('laptop')",
+        "{{ user }} on {{ host }}",
+        "  # else",
+        "b",
+        "  # endif",
+        "# elif host == 'laptop'",
+        "c",
+        "  # if n > 5",
+        "d",
+        "  # endif",
+        "# else",
+        "e",
+        "# endif",
+    ])
+    variables = {**VARIABLES, "user": user, "host": host}
+    assert render_both(parser, variables) == expected
+
+
+def test_empty_blocks() -> None:
+    parser = make_parser([
+        "# if n > 5",
+        "# elif n > 3",
+        "# else",
+        "# endif",
+        "end",
+    ])
+    assert render_both(parser) == "end\n"
+
+
+def test_walrus() -> None:
+    parser = make_parser([
+        "{{ (total := n * 2) }}",
+        "# if (half := total // 2) == n",
+        "{{ total }} {{ half }}",
+        "# endif",
+    ])
+    assert render_both(parser) == "14\n14 7\n"
+
+
+def test_comments_in_expressions() -> None:
+    parser = make_parser([
+        "{{ n # the number }} and {{ user # the user }}",
+        "# if n > 5 # a comment in a condition",
+        "big",
+        "# endif",
+    ])
+    assert render_both(parser) == "7 and root\nbig\n"
+
+
+def test_tuple_expressions() -> None:
+    parser = make_parser([
+        "{{ 1, 2 }}",
+        "{{ user, }}",
+        "{{ (*names, n) }}",
+        "# if names, n",
+        "tuples are truthy",
+        "# endif",
+    ])
+    assert render_both(parser) == (
+        "(1, 2)\n('root',)\n('alpha', 'beta', 7)\ntuples are truthy\n")
+
+
+def test_leading_whitespace_in_expressions() -> None:
+    parser = make_parser(["{{  \tuser}}", "# if  \tn", "x", "# endif"])
+    assert render_both(parser) == "root\nx\n"
+
+
+def test_shadowed_builtins() -> None:
+    parser = make_parser(["{{ n }} and {{ user }}", "{{ str(n) }}"])
+    variables = {**VARIABLES, "str": lambda o: "HIJACK"}
+    assert render_both(parser, variables) == "7 and root\nHIJACK\n"
+
+
+def test_deep_nesting_falls_back_to_interpreter() -> None:
+    depth = 200
+    lines = ([f"# if n > {i % 5}" for i in range(depth)] +
+             ["{{ user }}"] +
+             ["# endif"] * depth)
+    parser = make_parser(lines)
+
+    assert parser._code is None
+    assert render_both(parser) == "root\n"
+
+
+def generate_template(rng: random.Random, depth: int = 0) -> List[str]:
+    expressions = ["user", "n * 2", "names", "(m := n + 1)", "n, user",
+                   "host # comment", "'{{'", "f'{n:03}'"]
+    conditions = ["n > 5", "user == 'joe'", "names", "(c := n % 2)",
+                  "host, # comment"]
+
+    lines: List[str] = []
+    for _ in range(rng.randint(0, 5)):
+        if depth < 4 and rng.random() < 0.3:
+            lines.append(f"# if {rng.choice(conditions)}")
+            lines.extend(generate_template(rng, depth + 1))
+            for _ in range(rng.randint(0, 2)):
+                lines.append(f"# elif {rng.choice(conditions)}")
+                lines.extend(generate_template(rng, depth + 1))
+            if rng.random() < 0.5:
+                lines.append("# else")
+                lines.extend(generate_template(rng, depth + 1))
+            lines.append("# endif")
+        else:
+            chunks = []
+            for _ in range(rng.randint(0, 3)):
+                chunks.append(rng.choice(["text", " ", "'", "\\", "é"]))
+                chunks.append(f"{{{{ {rng.choice(expressions)} }}}}")
+            lines.append("".join(chunks))
+
+    return lines
+
+
+@pytest.mark.parametrize("seed", range(200))
+def test_random_templates(seed: int) -> None:
+    rng = random.Random(seed)
+    parser = make_parser(generate_template(rng))
+    assert parser._code is not None
+    render_both(parser)
@@ -0,0 +1,35 @@
+"""
+Checks how targets are deployed when evering is run on a config.
+"""
+
+import subprocess
+import sys
+from pathlib import Path
+
+
+def run_evering(tmp_path: Path, answers: str) -> None:
+    subprocess.run([sys.executable, "-m", "evering",
+                    "-c", str(tmp_path / "config.py")],
+                   cwd=Path(__file__).parent.parent,
+                   input=answers, text=True, check=True,
+                   capture_output=True)
+
+
+def test_deferred_conflicts_with_default_answers(tmp_path: Path) -> None:
+    config_dir = tmp_path / "config"
+    config_dir.mkdir()
+    (config_dir / "file").write_text(
+        'targets = [base_dir / "out"]\n'
+        "===\n"
+        "new\n")
+    (tmp_path / "config.py").write_text('config_dir = "config"\n'
+                                        'on_unknown = "defer"\n')
+
+    # Both the batch prompt and the per-target prompt default to skipping
+    for answers in ("\n", "d\n\n"):
+        (tmp_path / "out").write_text("mine\n")
+        run_evering(tmp_path, answers)
+        assert (tmp_path / "out").read_text() == "mine\n"
+
+    run_evering(tmp_path, "o\n")
+    assert (tmp_path / "out").read_text() == "new\n"
@@ -0,0 +1,100 @@
+"""
+Checks that the template cache never serves a rendered template whose
+output might have changed.
+"""
+
+import subprocess
+import sys
+from pathlib import Path, PurePosixPath
+from typing import Any, List, Optional
+
+from evering.parser import Parser
+from evering.template_cache import TemplateCache
+
+
+def render_key(tmp_path: Path,
+               template: List[str],
+               **local_vars: Any
+               ) -> Optional[str]:
+    """
+    Stores the template's dependencies in a fresh cache and returns the
+    render key for the variables, like the processor does.
+    """
+
+    cache = TemplateCache(tmp_path / "template_cache", 10**6)
+    parser = Parser(template, "#", "{{", "}}")
+    cache.put_dependencies("template", parser.dependencies,
+                           parser.attributes)
+
+    cached = cache.get_dependencies("template")
+    assert cached is not None
+    dependencies, io_attributes = cached
+    return cache.render_key("template", "", dependencies, io_attributes,
+                            local_vars)
+
+
+def test_paths_are_plain_data(tmp_path: Path) -> None:
+    template = ["{{ target.name }} in {{ base_dir / 'sub' }}"]
+    key = render_key(tmp_path, template,
+                     target=tmp_path / "a", base_dir=tmp_path)
+    assert key is not None
+
+
+def test_path_io_is_not_cacheable(tmp_path: Path) -> None:
+    for template in (["{{ (base_dir / 'secret').read_text() }}"],
+                     ["# if target.exists()", "x", "# endif"],
+                     ["{{ [p.stat() for p in paths] }}"]):
+        key = render_key(tmp_path, template, target=tmp_path / "a",
+                         base_dir=tmp_path, paths=[tmp_path / "b"])
+        assert key is None
+
+
+def test_pure_paths_stay_cacheable(tmp_path: Path) -> None:
+    # Pure paths can't access the file system, whatever the template
+    # does with them
+    template = ["{{ target.name }} {{ target.exists }}"]
+    key = render_key(tmp_path, template, target=PurePosixPath("/a"))
+    assert key is not None
+
+
+def test_read_file_in_template_is_not_cached(tmp_path: Path) -> None:
+    config_dir = tmp_path / "config"
+    config_dir.mkdir()
+    (tmp_path / "secret").write_text("old\n")
+    (config_dir / "file").write_text(
+        'targets = [base_dir / "out"]\n'
+        "===\n"
+        '{{ (base_dir / "secret").read_text().strip() }}\n')
+    (tmp_path / "config.py").write_text('config_dir = "config"\n')
+
+    def run() -> str:
+        subprocess.run([sys.executable, "-m", "evering",
+                        "-c", str(tmp_path / "config.py")],
+                       cwd=Path(__file__).parent.parent,
+                       stdin=subprocess.DEVNULL, check=True,
+                       capture_output=True)
+        return (tmp_path / "out").read_text()
+
+    assert run() == "old\n"
+    (tmp_path / "secret").write_text("new\n")
+    assert run() == "new\n"
+
+
+def test_first_run_stores_render(tmp_path: Path) -> None:
+    config_dir = tmp_path / "config"
+    config_dir.mkdir()
+    (config_dir / "file").write_text(
+        'targets = [base_dir / "out"]\n'
+        "===\n"
+        "{{ target.name }}\n")
+    (tmp_path / "config.py").write_text('config_dir = "config"\n')
+
+    def run() -> str:
+        return subprocess.run([sys.executable, "-m", "evering", "-v",
+                               "-c", str(tmp_path / "config.py")],
+                              cwd=Path(__file__).parent.parent,
+                              stdin=subprocess.DEVNULL, check=True,
+                              capture_output=True, text=True).stderr
+
+    assert "to access the path" not in run()
+    assert "Using the cached result" in run()
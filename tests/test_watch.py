@@ -0,0 +1,99 @@
+"""
+Checks that watching reprocesses everything that changed, even if the
+config file changed at the same time.
+"""
+
+from pathlib import Path
+from typing import Callable, List, Optional, Set
+
+import pytest
+
+from evering import watch as watch_module
+from evering.watch import Watcher, watch
+
+Batch = Callable[[], Set[Path]]
+
+
+class FakeWatcher(Watcher):
+    """
+    Delivers each batch of changes after making them, then stops
+    watching.
+    """
+
+    def __init__(self, batches: List[Batch]) -> None:
+        self._batches = batches
+
+    def watch_dir(self, path: Path) -> None:
+        pass
+
+    def wait(self, timeout: Optional[float]) -> Optional[Set[Path]]:
+        if timeout is not None:
+            return set()  # Nothing more within the debounce time
+        if not self._batches:
+            raise KeyboardInterrupt
+        return self._batches.pop(0)()
+
+    def close(self) -> None:
+        pass
+
+
+def run_watch(tmp_path: Path,
+              monkeypatch: pytest.MonkeyPatch,
+              batches: List[Batch]
+              ) -> None:
+    watcher = FakeWatcher(batches)
+    monkeypatch.setattr(watch_module, "create_watcher", lambda: watcher)
+    watch(tmp_path / "config.py", jobs=1, use_cache=False,
+          policy_overrides={}, error_override=None, paranoid=False)
+
+
+def write_config(tmp_path: Path, text: str) -> None:
+    (tmp_path / "config.py").write_text('config_dir = "config"\n' + text)
+
+
+def write_file(tmp_path: Path, text: str) -> None:
+    (tmp_path / "config" / "f").write_text(
+        f'targets = [base_dir / "out"]\n===\n{text}\n')
+
+
+@pytest.fixture
+def config(tmp_path: Path) -> Path:
+    (tmp_path / "config").mkdir()
+    write_config(tmp_path, "")
+    write_file(tmp_path, "v1")
+    return tmp_path
+
+
+def test_changes_along_with_config_file(config: Path,
+                                        monkeypatch: pytest.MonkeyPatch
+                                        ) -> None:
+    def checkout() -> Set[Path]:
+        write_config(config, "unused = 1\n")
+        write_file(config, "v2")
+        (config / "config" / "g").write_text(
+            'targets = [base_dir / "out_g"]\n===\nnew\n')
+        return {config / "config.py", config / "config" / "f",
+                config / "config" / "g"}
+
+    run_watch(config, monkeypatch, [checkout])
+    assert (config / "out").read_text() == "v2\n"
+    assert (config / "out_g").read_text() == "new\n"
+
+
+def test_changes_while_config_file_is_broken(config: Path,
+                                             monkeypatch: pytest.MonkeyPatch
+                                             ) -> None:
+    def break_config() -> Set[Path]:
+        write_config(config, "this is not python\n")
+        return {config / "config.py"}
+
+    def change_file() -> Set[Path]:
+        write_file(config, "v2")
+        return {config / "config" / "f"}
+
+    def fix_config() -> Set[Path]:
+        write_config(config, "")
+        return {config / "config.py"}
+
+    run_watch(config, monkeypatch, [break_config, change_file, fix_config])
+    assert (config / "out").read_text() == "v2\n"